@@ -0,0 +1,86 @@
+import numpy as np
+
+# Alternating least squares steps over the ratings matrix files of similarity.RatingsMatrix.
+# Keep this module free of app imports, it is re-imported by every worker process
+
+
+def normal_equations(fixed, columns, stars, counts, regularization: float):
+    # Per row of a chunk: (Y^T Y + regularization * n I, Y^T r) over the row's ratings.
+    # Rows with about the same number of ratings (within 2x) are zero padded to the same
+    # length and multiplied as one batch.
+    n_factors = fixed.shape[1]
+    gram = np.zeros((len(counts), n_factors, n_factors))
+    rhs = np.zeros((len(counts), n_factors))
+    rated = counts > 0
+    vectors = np.asarray(fixed[columns], dtype=np.float64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    buckets = np.ceil(np.log2(np.maximum(counts, 1))).astype(np.int64)
+    for bucket in np.unique(buckets[rated]):
+        rows = np.flatnonzero((buckets == bucket) & rated)
+        offsets = np.arange(counts[rows].max())
+        present = offsets < counts[rows, None]
+        positions = np.where(present, starts[rows, None] + offsets, 0)
+        padded = vectors[positions] * present[:, :, None]
+        gram[rows] = np.matmul(padded.transpose(0, 2, 1), padded)
+        rhs[rows] = np.einsum("rkf,rk->rf", padded, stars[positions] * present)
+    gram += regularization * np.maximum(counts, 1)[:, None, None] * np.eye(n_factors)
+    return gram, rhs, rated
+
+
+def solve_rows(paths: dict, start: int, end: int, regularization: float, max_ratings: int):
+    # Solves rows [start, end) of paths["out"] with the other side's factors held fixed.
+    # Every input is memory mapped, the solutions are written in place.
+    indptr = np.load(paths["indptr"], mmap_mode="r")
+    indices = np.load(paths["indices"], mmap_mode="r")
+    stars = np.load(paths["stars"], mmap_mode="r")
+    fixed = np.load(paths["fixed"], mmap_mode="r")
+    out = np.load(paths["out"], mmap_mode="r+")
+    row = start
+    while row < end:
+        # As many rows as fit in max_ratings ratings, a heavier row is a chunk of its own
+        last = max(row + 1, int(np.searchsorted(indptr, indptr[row] + max_ratings, side="right")) - 1)
+        last = min(last, end)
+        first_rating, last_rating = indptr[row], indptr[last]
+        counts = np.diff(indptr[row:last + 1])
+        if last - row == 1 and counts[0] > max_ratings:
+            gram, rhs, rated = heavy_row(fixed, indices, stars, first_rating, last_rating, regularization, max_ratings)
+        else:
+            gram, rhs, rated = normal_equations(
+                fixed, indices[first_rating:last_rating], np.asarray(stars[first_rating:last_rating], dtype=np.float64),
+                counts, regularization,
+            )
+        solution = np.linalg.solve(gram, rhs[:, :, None])[:, :, 0]
+        solution[~rated] = 0
+        out[row:last] = solution
+        row = last
+    out.flush()
+
+
+def heavy_row(fixed, indices, stars, first_rating: int, last_rating: int, regularization: float, max_ratings: int):
+    # One row with more than max_ratings ratings, accumulated a slice at a time
+    n_factors = fixed.shape[1]
+    gram = np.zeros((1, n_factors, n_factors))
+    rhs = np.zeros((1, n_factors))
+    for first in range(first_rating, last_rating, max_ratings):
+        last = min(first + max_ratings, last_rating)
+        vectors = np.asarray(fixed[indices[first:last]], dtype=np.float64)
+        gram[0] += vectors.T @ vectors
+        rhs[0] += vectors.T @ np.asarray(stars[first:last], dtype=np.float64)
+    gram[0] += regularization * (last_rating - first_rating) * np.eye(n_factors)
+    return gram, rhs, np.ones(1, dtype=bool)
+
+
+def squared_error(paths: dict, start: int, end: int, max_ratings: int):
+    # (sum of squared errors, ratings) of rows [start, end) against the current factors
+    indptr = np.load(paths["indptr"], mmap_mode="r")
+    indices = np.load(paths["indices"], mmap_mode="r")
+    stars = np.load(paths["stars"], mmap_mode="r")
+    rows = np.load(paths["out"], mmap_mode="r")
+    columns = np.load(paths["fixed"], mmap_mode="r")
+    total = 0.0
+    for first in range(int(indptr[start]), int(indptr[end]), max_ratings):
+        last = min(first + max_ratings, int(indptr[end]))
+        owners = np.searchsorted(indptr, np.arange(first, last), side="right") - 1
+        predicted = np.einsum("ij,ij->i", rows[owners], columns[indices[first:last]])
+        total += float(np.square(predicted - stars[first:last]).sum())
+    return total, int(indptr[end] - indptr[start])
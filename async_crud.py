@@ -0,0 +1,179 @@
+import models
+import schemas
+from typing import Optional
+from models import Movie, Rating, Comment
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload
+from sqlalchemy.orm.attributes import set_committed_value
+from crud import (
+    MOVIE_DETAIL_OPTIONS, MOVIE_SUMMARY_COLUMNS, build_comment_tree, comment_thread_query, delete_owned_movie,
+    existing_rating, insert_new_rating, movies_in_order, rating_aggregates_delta, rating_summary, rating_summary_query,
+    similar_movies_query, update_owned_movie, update_rating,
+)
+from autocomplete import title_index
+from content_index import content_index
+from pagination import movies_page_query
+from search import search_movies_query, search_terms
+
+# Async mirror of crud.py. An AsyncSession cannot lazy load, so every relationship
+# a response schema touches is loaded up front.
+
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate, hashed_password: str):
+    db_user = models.User(
+        username=user.username,
+        full_name=user.full_name,
+        email=user.email,
+        hashed_password=hashed_password
+    )
+    db.add(db_user)
+    await db.commit()
+    return db_user
+
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
+
+async def get_user(db: AsyncSession, user_id: int):
+    return await db.get(models.User, user_id)
+
+
+async def create_movie(db: AsyncSession, movie: schemas.MovieCreate, user_id: int):
+    db_movie = models.Movie(
+        **movie.model_dump(exclude_unset=True, exclude_none=True),
+        owner_id=user_id
+    )
+    db.add(db_movie)
+    await db.commit()
+    title_index.add(db_movie.id, db_movie.title)
+    content_index.add(db_movie.id, db_movie.description)
+    return db_movie
+
+
+async def get_movie(db: AsyncSession, movie_id: int):
+    result = await db.execute(
+        select(Movie).options(*MOVIE_DETAIL_OPTIONS).where(Movie.id == movie_id)
+    )
+    return result.scalars().first()
+
+
+async def get_movie_json(db: AsyncSession, movie_id: int):
+    movie = await get_movie(db, movie_id)
+    return schemas.Movie.model_validate(movie).model_dump_json() if movie else None
+
+
+async def get_movies(db: AsyncSession, limit: int=10, after=None, sort: str="id"):
+    # Keyset pagination, returns up to limit + 1 rows (see pagination.movies_page)
+    result = await db.execute(movies_page_query(limit, after, sort))
+    return result.scalars().all()
+
+
+async def movie_titles(db: AsyncSession):
+    return (await db.execute(select(Movie.id, Movie.title, Movie.rating_count))).all()
+
+
+async def search_movies(db: AsyncSession, q: str, limit: int=10, after=None):
+    terms = search_terms(q)
+    if not terms:
+        return []
+    return (await db.execute(search_movies_query(db.bind.dialect.name, terms, limit, after))).all()
+
+
+async def get_similar_movies(db: AsyncSession, movie_id: int, limit: int=10):
+    return (await db.execute(similar_movies_query(movie_id, limit))).all()
+
+
+async def get_movie_summaries(db: AsyncSession, movie_ids):
+    return (await db.execute(select(*MOVIE_SUMMARY_COLUMNS).where(Movie.id.in_(movie_ids)))).all()
+
+
+async def rated_movie_ids(db: AsyncSession, user_id: int):
+    return (await db.scalars(select(Rating.movie_id).where(Rating.user_id == user_id))).all()
+
+
+async def movie_exists(db: AsyncSession, movie_id: int) -> bool:
+    return await db.scalar(select(Movie.id).where(Movie.id == movie_id)) is not None
+
+
+async def update_movie(db: AsyncSession, movie_id: int, user_id: int, movie_update: schemas.MovieUpdate):
+    row = (await db.execute(update_owned_movie(movie_id, user_id, movie_update))).first()
+    await db.commit()
+    if row is None:
+        return None
+    title_index.add(row.id, row.title, row.rating_count)
+    content_index.add(row.id, row.description)
+    return dict(row._mapping)
+
+
+async def delete_movie(db: AsyncSession, movie_id: int, user_id: int) -> bool:
+    *detach, delete_statement = delete_owned_movie(movie_id, user_id)
+    for statement in detach:
+        await db.execute(statement)
+    deleted = await db.scalar(delete_statement)
+    await db.commit()
+    if deleted is None:
+        return False
+    title_index.remove(movie_id)
+    content_index.remove(movie_id)
+    return True
+
+
+async def upsert_rating(db: AsyncSession, rating: schemas.RatingCreate, user_id: int):
+    rating_id = await db.scalar(insert_new_rating(db.bind.dialect.name, rating, user_id))
+    old_stars = None
+    if rating_id is None:
+        row = (await db.execute(existing_rating(rating.movie_id, user_id))).first()
+        if row is None:
+            await db.rollback()
+            return None
+        rating_id, old_stars = row
+        await db.execute(update_rating(rating_id, rating))
+    if old_stars != rating.stars:
+        await db.execute(rating_aggregates_delta(rating.movie_id, rating.stars, old_stars))
+    await db.commit()
+    if old_stars is None:
+        title_index.rated(rating.movie_id)
+    return {**rating.model_dump(), "id": rating_id, "user_id": user_id, "created": old_stars is None}
+
+
+async def get_rating_summary(db: AsyncSession, movie_id: int):
+    row = (await db.execute(rating_summary_query(movie_id))).first()
+    return rating_summary(row) if row else None
+
+
+async def get_movie_ratings(db: AsyncSession, movie_id: int):
+    result = await db.execute(select(Rating).options(raiseload("*")).where(Rating.movie_id == movie_id))
+    return result.scalars().all()
+
+
+async def create_comment(db: AsyncSession, comment: schemas.CommentCreate, movie_id: int, user_id: int):
+    if comment.parent_comment_id is not None:
+        parent_comment = await db.get(models.Comment, comment.parent_comment_id)
+        if not parent_comment:
+            raise HTTPException(status_code=400, detail="Parent comment not found")
+
+    db_comment = models.Comment(
+        text=comment.text,
+        movie_id=movie_id,
+        user_id=user_id,
+        parent_comment_id=comment.parent_comment_id
+    )
+    db.add(db_comment)
+    await db.commit()
+    # A new comment has no replies yet
+    set_committed_value(db_comment, "children", [])
+    return db_comment
+
+
+async def get_comments_for_movie(db: AsyncSession, movie_id: int, max_depth: Optional[int]=None,
+                                 limit: Optional[int]=None, replies_limit: Optional[int]=None):
+    rows = (await db.execute(comment_thread_query(movie_id))).all()
+    return build_comment_tree(rows, max_depth, limit, replies_limit)
+
+
+async def get_comment_by_id(db: AsyncSession, comment_id: int):
+    return await db.get(Comment, comment_id)
@@ -0,0 +1,296 @@
+import async_crud, schemas
+from typing import Optional, List, Literal
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi.responses import Response
+from fastapi.security import OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
+from auth import authenticate_user_async, create_access_token, get_current_user_async, token_claims
+from database import AsyncSessionLocal, get_async_db
+from hashing import hashing_service
+from logging_config import logger
+from response_cache import response_cache
+from singleflight import movie_flights
+from pagination import MAX_COMMENT_DEPTH, MAX_PAGE_SIZE, decode_cursor, movies_page
+from search import SEARCH_SORT, search_page
+from autocomplete import AUTOCOMPLETE_MAX_LIMIT, title_index
+from similarity import SIMILAR_TOP_K
+from recommendations import RECOMMEND_TOP_N, recommendation_store
+from content_index import CONTENT_TOP_K, content_index
+
+# Async routes, mounted by main.py instead of the sync ones when USE_ASYNC_DB is set
+router = APIRouter()
+
+
+# CREATE USERS ENDPOINT
+@router.post("/signup", response_model=schemas.User)
+async def signup(user: schemas.UserCreate, db: AsyncSession=Depends(get_async_db)):
+    db_user = await async_crud.get_user_by_username(db, user.username)
+    if db_user:
+        logger.warning("Attempted signup with existing username: %s", user.username)
+        raise HTTPException(status_code=400, detail="Username already registered")
+    hashed_password = await hashing_service.hash_async(user.password)
+    new_user = await async_crud.create_user(db=db, user=user, hashed_password=hashed_password)
+    logger.info("User signed up successfully: %s", user.username)
+    return new_user
+
+# USERS LOGIN ENDPOINT
+@router.post("/login")
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_user_async(db, form_data.username, form_data.password)
+    if not user:
+        logger.warning("Attempted login with Incorrect username or password")
+        raise HTTPException(
+            status_code=401,
+            detail="Incorrect username or password",
+            headers= {"WWW-Authenticate": "Bearer"}
+        )
+    access_token = create_access_token(data=token_claims(user))
+    logger.info("User logged in successfully: %s", user.username)
+    return {
+        "access_token": access_token,
+        "token_type": "bearer"
+    }
+
+
+# USERS LIST  MOVIE ENDPOINT {AUTHENTICATED ACCESS}
+@router.post("/movies")
+async def create_movie(movie: schemas.MovieCreate, user: schemas.User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    try:
+        new_movie = await async_crud.create_movie(
+            db=db,
+            movie=movie,
+            user_id=user.id
+        )
+        response_cache.invalidate("movies")
+        logger.info("Movie listed successfully: %s by user %s", movie.title, user.username)
+        return new_movie
+    except Exception as e:
+        logger.error("Failed to list movie: %s. Error: %s", movie.title, str(e))
+        raise HTTPException(status_code=500, detail="Failed to list movie")
+
+
+# VIEW ALL MOVIES {public access}
+@router.get("/movies/", response_model=schemas.MoviePage)
+async def get_movies(
+    db: AsyncSession = Depends(get_async_db),
+    after: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    sort: Literal["id", "title"] = "id"
+):
+    cursor = decode_cursor(after, sort) if after else None
+    movies = await async_crud.get_movies(db, limit=limit, after=cursor, sort=sort)
+    page = movies_page(movies, limit, sort)
+    logger.info("Movies retrieved: %d", len(page["items"]))
+    return page
+
+# SEARCH MOVIES by title and description {public access}
+@router.get("/movies/search", response_model=schemas.MoviePage)
+async def search_movies(
+    q: str = Query(..., min_length=1, max_length=200),
+    db: AsyncSession = Depends(get_async_db),
+    after: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE)
+):
+    cursor = decode_cursor(after, SEARCH_SORT) if after else None
+    rows = await async_crud.search_movies(db, q, limit=limit, after=cursor)
+    page = search_page(rows, limit)
+    logger.info("Movie search returned %d movies", len(page["items"]))
+    return page
+
+# AUTOCOMPLETE movie titles, most rated first {public access}
+@router.get("/movies/autocomplete", response_model=List[schemas.MovieSuggestion])
+async def autocomplete_movies(
+    prefix: str = Query(..., min_length=1, max_length=100),
+    db: AsyncSession = Depends(get_async_db),
+    limit: int = Query(10, ge=1, le=AUTOCOMPLETE_MAX_LIMIT)
+):
+    if not title_index.loaded:
+        title_index.start_build()
+        rows = await async_crud.movie_titles(db)
+        # Sorting every title takes seconds at a million movies, off the event loop
+        await run_in_threadpool(title_index.build_once, lambda: rows)
+    return title_index.suggest(prefix, limit)
+
+# SIMILAR MOVIES, from the ratings {public access}
+@router.get("/movies/{movie_id}/similar", response_model=List[schemas.SimilarMovie])
+async def similar_movies(
+    movie_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    limit: int = Query(10, ge=1, le=SIMILAR_TOP_K)
+):
+    return await async_crud.get_similar_movies(db, movie_id, limit=limit)
+
+# SIMILAR MOVIES by description {public access}
+@router.get("/movies/{movie_id}/similar-content", response_model=List[schemas.SimilarMovie])
+async def similar_content(
+    movie_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    limit: int = Query(10, ge=1, le=CONTENT_TOP_K)
+):
+    picks = content_index.similar(movie_id, limit)
+    if not picks:
+        return []
+    movies = await async_crud.get_movie_summaries(db, [other for other, _ in picks])
+    return async_crud.movies_in_order(movies, picks)
+
+# RECOMMENDED MOVIES for the current user, from the last trained model
+@router.get("/me/recommendations", response_model=List[schemas.RecommendedMovie])
+async def recommend_movies(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_user_async),
+    limit: int = Query(10, ge=1, le=RECOMMEND_TOP_N)
+):
+    rated = set(await async_crud.rated_movie_ids(db, current_user.id))
+    picks = recommendation_store.recommend(current_user.id, rated, limit)
+    if not picks:
+        return []
+    movies = await async_crud.get_movie_summaries(db, [movie_id for movie_id, _ in picks])
+    return async_crud.movies_in_order(movies, picks)
+
+# GET A MOVIE {public access}
+@router.get("/movie/{movie_id}", response_model=schemas.Movie)
+async def get_movie(movie_id: int):
+    # Concurrent lookups of the same movie share one fetch and serialization. The fetch
+    # opens its own session, it outlives the request that started it when that one is
+    # cancelled while others wait for the result.
+    async def fetch():
+        async with AsyncSessionLocal() as db:
+            return await async_crud.get_movie_json(db, movie_id)
+
+    body = await movie_flights.do_async(movie_id, fetch)
+    if body is None:
+        logger.warning("Attempted getting movie that does not exist")
+        raise HTTPException(status_code=404, detail="Movie not found")
+    logger.info("Movie retrieved successfully")
+    return Response(body, media_type="application/json")
+
+# Edit a movie (only by the user who listed it)
+@router.put("/movies/{movie_id}", response_model=schemas.Movie)
+async def update_movie(
+    movie_id: int,
+    movie_update: schemas.MovieUpdate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_user_async)
+):
+    movie = await async_crud.update_movie(db=db, movie_id=movie_id, user_id=current_user.id, movie_update=movie_update)
+    if movie is None:
+        if not await async_crud.movie_exists(db, movie_id):
+            logger.warning("Movie not found for update: %d", movie_id)
+            raise HTTPException(status_code=404, detail="Movie not found")
+        logger.warning("Unauthorized update attempt by user %s for movie %d", current_user.username, movie_id)
+        raise HTTPException(status_code=403, detail="Not authorized to update this movie")
+    response_cache.invalidate("movies", f"movie:{movie_id}")
+    logger.info("Movie updated successfully: %d by user %s", movie_id, current_user.username)
+    # The updated row has no owner loaded, the owner is the current user
+    return schemas.Movie.model_validate({**movie, "owner": current_user})
+
+
+# Delete a movie (only by the user who listed it)
+@router.delete("/movies/{movie_id}")
+async def delete_movie(
+    movie_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_user_async)
+):
+    if not await async_crud.delete_movie(db=db, movie_id=movie_id, user_id=current_user.id):
+        if not await async_crud.movie_exists(db, movie_id):
+            logger.warning("Movie not found for deletion: %d", movie_id)
+            raise HTTPException(status_code=404, detail="Movie not found")
+        logger.warning("Unauthorized delete attempt by user %s for movie %d", current_user.username, movie_id)
+        raise HTTPException(status_code=403, detail="Not authorized to delete movie")
+    response_cache.invalidate("movies", f"movie:{movie_id}", f"ratings:{movie_id}", f"comments:{movie_id}")
+    logger.info("Movie deleted successfully: %d by user %s", movie_id, current_user.username)
+    return {"Movie Deleted Successfully"}
+
+
+# Rate a movie (authenticated access)
+
+@router.post("/movies/{movie_id}/rate", response_model=schemas.RatingResult)
+async def rate_movie(
+    movie_id: int,
+    rating: schemas.RatingCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_user_async)
+):
+    # The movie in the URL is authoritative, the body's movie_id is ignored
+    rating = rating.model_copy(update={"movie_id": movie_id})
+    # Rating again replaces the user's earlier rating, checked in one INSERT ... ON CONFLICT
+    db_rating = await async_crud.upsert_rating(db=db, rating=rating, user_id=current_user.id)
+    if db_rating is None:
+        logger.warning("Movie not found when attempting to rate: movie_id=%d", movie_id)
+        raise HTTPException(status_code=404, detail="Movie not found")
+    # Only this movie's entries: the list and search pages show its aggregates too, but
+    # clearing them on every rating would leave nothing cached, they expire by TTL
+    response_cache.invalidate(f"movie:{movie_id}", f"ratings:{movie_id}")
+    logger.info("Movie rated successfully: movie_id=%d, user_id=%d, stars=%d, created=%s",
+                movie_id, current_user.id, rating.stars, db_rating["created"])
+    return db_rating
+
+# Get ratings for a movie
+@router.get("/movies/{movie_id}/ratings/", response_model=List[schemas.Rating])
+async def get_movie_ratings(movie_id: int, db: AsyncSession = Depends(get_async_db)):
+    ratings = await async_crud.get_movie_ratings(db=db, movie_id=movie_id)
+    logger.info("Retrieved %d ratings for movie_id=%d", len(ratings), movie_id)
+    return ratings
+
+# Get the rating aggregates of a movie, read from the movie row (no scan of ratings)
+@router.get("/movies/{movie_id}/rating-summary", response_model=schemas.RatingSummary)
+async def get_rating_summary(movie_id: int, db: AsyncSession = Depends(get_async_db)):
+    summary = await async_crud.get_rating_summary(db=db, movie_id=movie_id)
+    if not summary:
+        logger.warning("Attempted getting rating summary of movie that does not exist: movie_id=%d", movie_id)
+        raise HTTPException(status_code=404, detail="Movie not found")
+    return summary
+
+# Add a comment to a movie (authenticated access)
+@router.post("/movies/{movie_id}/comments", response_model=schemas.Comment)
+async def add_comment(
+    movie_id: int,
+    comment: schemas.CommentCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_user_async)
+):
+    movie = await async_crud.get_movie(db, movie_id)
+    if not movie:
+        logger.warning("Attempted to add comment to non-existent movie: movie_id=%d", movie_id)
+        raise HTTPException(status_code=404, detail="Movie not found")
+    db_comment = await async_crud.create_comment(db=db, comment=comment, movie_id=movie_id, user_id=current_user.id)
+    response_cache.invalidate(f"comments:{movie_id}")
+    logger.info("Comment added to movie: movie_id=%d, user_id=%d, comment_id=%d", movie_id, current_user.id, db_comment.id)
+    return db_comment
+
+# View comments for a movie (public access), as a tree of root comments
+@router.get("/movies/{movie_id}/comments", response_model=List[schemas.Comment])
+async def view_comments(
+    movie_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    max_depth: int = Query(MAX_COMMENT_DEPTH, ge=0, le=MAX_COMMENT_DEPTH),
+    limit: Optional[int] = Query(None, ge=1),
+    replies_limit: Optional[int] = Query(None, ge=1)
+):
+    comments = await async_crud.get_comments_for_movie(
+        db=db, movie_id=movie_id, max_depth=max_depth, limit=limit, replies_limit=replies_limit
+    )
+    logger.info("Retrieved %d root comments for movie_id=%d", len(comments), movie_id)
+    return comments
+
+# Add comment to a comment i.e nested comments (authenticated access)
+@router.post("/comments/{comment_id}/reply", response_model=schemas.Comment)
+async def reply_to_comment(
+    comment_id: int,
+    comment: schemas.CommentCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.User = Depends(get_current_user_async)
+):
+    parent_comment = await async_crud.get_comment_by_id(db, comment_id)
+    if not parent_comment:
+        logger.warning("Attempted to reply to non-existent comment: comment_id=%d", comment_id)
+        raise HTTPException(status_code=404, detail="parent comment not found")
+
+    # The comment in the URL is the parent, whatever the body says
+    comment = comment.model_copy(update={"parent_comment_id": comment_id})
+    db_comment = await async_crud.create_comment(db=db, comment=comment, movie_id=parent_comment.movie_id, user_id=current_user.id)
+    response_cache.invalidate(f"comments:{db_comment.movie_id}")
+    logger.info("Reply added to comment: parent_comment_id=%d, user_id=%d, reply_comment_id=%d", comment_id, current_user.id, db_comment.id)
+    return db_comment
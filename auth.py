@@ -3,14 +3,20 @@ import os
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import event, inspect
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 
 import crud
-from database import SessionLocal, get_db
+import async_crud
+import models
+import schemas
+from cache import TTLCache
+from hashing import pwd_context, hashing_service
+from database import SessionLocal, get_db, get_async_db
 
 load_dotenv()
 
@@ -18,12 +24,33 @@ SECRET_KEY = os.environ.get('SECRET_KEY')  # Change this in production
 ALGORITHM = os.environ.get('ALGORITHM')
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES'))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Put the user id in issued tokens ("uid" claim) so a principal cache miss is a primary key lookup
+TOKEN_USER_ID = os.environ.get('TOKEN_USER_ID', 'false').lower() in ('1', 'true', 'yes')
+
+# Authenticated principals (schemas.User) keyed by token subject, PRINCIPAL_CACHE_TTL=0 disables it
+principal_cache = TTLCache(
+    maxsize=int(os.environ.get('PRINCIPAL_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('PRINCIPAL_CACHE_TTL', 60)),
+)
+
+
+def invalidate_principal(username: str):
+    principal_cache.invalidate(username)
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _user_changed(mapper, connection, target):
+    # Drop the cached principal under the old and the new username
+    for username in (*inspect(target).attrs.username.history.deleted, target.username):
+        invalidate_principal(username)
+
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    # bcrypt runs on the hashing process pool, see hashing.py
+    return hashing_service.verify(plain_password, hashed_password)
 
 
 def authenticate_user(db: Session, username: str, password: str):
@@ -33,6 +60,13 @@ def authenticate_user(db: Session, username: str, password: str):
     return user
 
 
+async def authenticate_user_async(db: AsyncSession, username: str, password: str):
+    user = await async_crud.get_user_by_username(db, username)
+    if not user or not await hashing_service.verify_async(password, user.hashed_password):
+        return False
+    return user
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta]=None):
     to_encode = data.copy()
     if expires_delta:
@@ -44,20 +78,60 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta]=None):
     return encoded_jwt
 
 
-def get_current_user(db: Session=Depends(get_db), token: str=Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
+def token_claims(user) -> dict:
+    data = {"sub": user.username}
+    if TOKEN_USER_ID:
+        data["uid"] = user.id
+    return data
+
+
+def credentials_exception():
+    return HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def decode_token(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
-    user = crud.get_user_by_username(db, username=username)
-    if user is None:
-        raise credentials_exception
-    return user
+        raise credentials_exception()
+    username: str = payload.get("sub")
+    if username is None:
+        raise credentials_exception()
+    return username, payload.get("uid")
+
+
+def cache_principal(username: str, user):
+    # Cache a detached snapshot, never the session-bound ORM object
+    if user is None or user.username != username:
+        raise credentials_exception()
+    principal = schemas.User.model_validate(user)
+    principal_cache.set(username, principal)
+    return principal
+
+
+def get_current_user(db: Session=Depends(get_db), token: str=Depends(oauth2_scheme)):
+    username, user_id = decode_token(token)
+    principal = principal_cache.get(username)
+    if principal is not None:
+        return principal
+    if user_id is not None:
+        user = crud.get_user(db, user_id)
+    else:
+        user = crud.get_user_by_username(db, username=username)
+    return cache_principal(username, user)
+
+
+async def get_current_user_async(db: AsyncSession=Depends(get_async_db), token: str=Depends(oauth2_scheme)):
+    username, user_id = decode_token(token)
+    principal = principal_cache.get(username)
+    if principal is not None:
+        return principal
+    if user_id is not None:
+        user = await async_crud.get_user(db, user_id)
+    else:
+        user = await async_crud.get_user_by_username(db, username=username)
+    return cache_principal(username, user)
@@ -0,0 +1,183 @@
+import heapq
+import os
+import threading
+from collections import OrderedDict
+
+from sortedcontainers import SortedList
+
+# Type-ahead over movie titles, served from memory. Each process keeps its own index: it
+# is built from the movies table at startup (or on the first lookup) and follows the
+# writes made through crud.py in this process. Writes from other processes and bulk
+# loads show up after a restart.
+
+# Build the index when the app starts, instead of on the first lookup
+AUTOCOMPLETE_WARMUP = os.environ.get("AUTOCOMPLETE_WARMUP", "true").lower() in ("1", "true", "yes")
+# Largest number of suggestions a lookup returns
+AUTOCOMPLETE_MAX_LIMIT = int(os.environ.get("AUTOCOMPLETE_MAX_LIMIT", 20))
+# Prefixes matching more titles than this have their ranked suggestions cached
+AUTOCOMPLETE_SCAN_LIMIT = int(os.environ.get("AUTOCOMPLETE_SCAN_LIMIT", 256))
+AUTOCOMPLETE_CACHE_SIZE = int(os.environ.get("AUTOCOMPLETE_CACHE_SIZE", 10000))
+
+# Sorts after every character, prefix + END bounds the titles starting with prefix
+END = chr(0x10FFFF)
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def normalize_prefix(prefix: str) -> str:
+    # A typed space ends the word: "star " matches "Star Wars" but not "Starling"
+    normalized = normalize(prefix)
+    return normalized + " " if normalized and prefix[-1].isspace() else normalized
+
+
+class TitleIndex:
+    # Titles sorted by their normalized form, a prefix is a contiguous range found by
+    # bisection. Suggestions are the most rated titles of the range.
+    # Safe to share between the threadpool workers that run sync routes.
+
+    def __init__(self, scan_limit: int=AUTOCOMPLETE_SCAN_LIMIT, cache_size: int=AUTOCOMPLETE_CACHE_SIZE,
+                 max_limit: int=AUTOCOMPLETE_MAX_LIMIT):
+        self.scan_limit = scan_limit
+        self.cache_size = cache_size
+        self.max_limit = max_limit
+        self._keys = SortedList()  # (normalized title, movie id)
+        # movie id -> (title, normalized title, rating count). Tuples, not lists: the cyclic
+        # GC stops tracking them, a full collection would otherwise walk every title
+        self._movies = {}
+        # prefix -> ranked movie ids, for prefixes matching more than scan_limit titles
+        self._top = OrderedDict()
+        self._lock = threading.Lock()
+        # Held for a whole first build, lookups stay on _lock
+        self._build_lock = threading.Lock()
+        # Writes since start_build(), (method, args) replayed on the built index: its rows
+        # may have been read before them
+        self._pending = None
+        self.loaded = False
+
+    def start_build(self):
+        # Call before reading the rows of a build, writes from now on are kept for it
+        with self._lock:
+            if not self.loaded and self._pending is None:
+                self._pending = []
+
+    def build(self, rows):
+        # rows are (id, title, rating_count), replaces the whole index. A replayed rating
+        # the rows already counted counts twice until the next build, it only moves the
+        # movie up a little in the ranking.
+        movies = {movie_id: (title, normalize(title), rating_count) for movie_id, title, rating_count in rows}
+        keys = SortedList((movie[1], movie_id) for movie_id, movie in movies.items())
+        with self._lock:
+            self._keys = keys
+            self._movies = movies
+            self._top.clear()
+            self.loaded = True
+            pending, self._pending = self._pending or [], None
+            for method, args in pending:
+                method(*args)
+
+    def build_once(self, load):
+        # Builds from load() unless the index is loaded. Concurrent first lookups wait for
+        # one build instead of each reading and sorting every title.
+        with self._build_lock:
+            if not self.loaded:
+                self.start_build()
+                self.build(load())
+
+    def clear(self):
+        # Back to not loaded, the next lookup builds it again
+        with self._lock:
+            self._keys = SortedList()
+            self._movies = {}
+            self._top.clear()
+            self._pending = None
+            self.loaded = False
+
+    def _rank(self, movie_id: int):
+        # Most rated first, the older movie on a tie
+        return self._movies[movie_id][2], -movie_id
+
+    def _ranked(self, lo: int, hi: int, limit: int):
+        ids = (movie_id for _, movie_id in self._keys.islice(lo, hi))
+        return heapq.nlargest(limit, ids, key=self._rank)
+
+    def suggest(self, prefix: str, limit: int=10):
+        prefix = normalize_prefix(prefix)
+        with self._lock:
+            ids = self._top.get(prefix)
+            if ids is not None:
+                self._top.move_to_end(prefix)
+            else:
+                lo = self._keys.bisect_left((prefix,))
+                hi = self._keys.bisect_left((prefix + END,))
+                if hi - lo <= self.scan_limit:
+                    ids = self._ranked(lo, hi, limit)
+                else:
+                    ids = self._ranked(lo, hi, self.max_limit)
+                    self._top[prefix] = ids
+                    while len(self._top) > self.cache_size:
+                        self._top.popitem(last=False)
+            return [
+                {"id": movie_id, "title": self._movies[movie_id][0], "rating_count": self._movies[movie_id][2]}
+                for movie_id in ids[:limit]
+            ]
+
+    def _invalidate(self, movie_id: int, normalized: str):
+        # Drop the cached suggestions of this title's prefixes the change can affect:
+        # those listing the movie, or with a free slot or a lower ranked last entry
+        rank = self._rank(movie_id) if movie_id in self._movies else None
+        for end in range(len(normalized) + 1):
+            ids = self._top.get(normalized[:end])
+            if ids is None:
+                continue
+            if movie_id in ids or rank is None or len(ids) < self.max_limit or rank > self._rank(ids[-1]):
+                del self._top[normalized[:end]]
+
+    def _remove(self, movie_id: int):
+        movie = self._movies.get(movie_id)
+        if movie is not None:
+            self._invalidate(movie_id, movie[1])
+            self._keys.remove((movie[1], movie_id))
+            del self._movies[movie_id]
+        return movie
+
+    def _write(self, method, *args):
+        # Applied to a loaded index, kept for the build in progress, else dropped (the
+        # next build reads it)
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((method, args))
+            if self.loaded:
+                method(*args)
+
+    def _add(self, movie_id: int, title: str, rating_count: int):
+        self._remove(movie_id)
+        normalized = normalize(title)
+        self._movies[movie_id] = (title, normalized, rating_count)
+        self._keys.add((normalized, movie_id))
+        self._invalidate(movie_id, normalized)
+
+    def _rated(self, movie_id: int, change: int):
+        movie = self._movies.get(movie_id)
+        if movie is not None:
+            title, normalized, rating_count = movie
+            self._movies[movie_id] = (title, normalized, rating_count + change)
+            self._invalidate(movie_id, normalized)
+
+    def add(self, movie_id: int, title: str, rating_count: int=0):
+        # New or renamed movie
+        self._write(self._add, movie_id, title, rating_count)
+
+    def remove(self, movie_id: int):
+        self._write(self._remove, movie_id)
+
+    def rated(self, movie_id: int, change: int=1):
+        # A new rating moves the movie up in the suggestions
+        self._write(self._rated, movie_id, change)
+
+    def stats(self) -> dict:
+        return {"titles": len(self._movies), "cached_prefixes": len(self._top)}
+
+
+title_index = TitleIndex()
@@ -0,0 +1,119 @@
+"""Compare the sync (psycopg2 + threadpool) and async (asyncpg) request paths.
+
+Starts the app with uvicorn once per mode against the database in DB_URL (a local
+Postgres) and drives GET /movie/{id} and POST /movies/{id}/rate with a fixed number
+of concurrent clients, reporting requests/sec and p99 latency for each.
+
+    python bench/async_vs_sync.py --concurrency 500 --duration 20
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def start_server(use_async: bool, port: int):
+    env = dict(os.environ, USE_ASYNC_DB="true" if use_async else "false")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("server did not start")
+
+
+async def seed(client: httpx.AsyncClient):
+    name = f"bench_{uuid.uuid4().hex[:12]}"
+    await client.post("/signup", json={
+        "username": name, "password": "benchpass", "full_name": "Bench User", "email": f"{name}@example.com"
+    })
+    response = await client.post("/login", data={"username": name, "password": "benchpass"})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = await client.post("/movies", json={"title": "Bench Movie", "description": "benchmark"}, headers=headers)
+    return response.json()["id"], headers
+
+
+async def run_load(client: httpx.AsyncClient, concurrency: int, duration: float, method: str, url: str, **kwargs):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def bench_mode(use_async: bool, port: int, concurrency: int, duration: float):
+    proc = start_server(use_async, port)
+    try:
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            movie_id, headers = await seed(client)
+            return {
+                "GET /movie/{id}": await run_load(client, concurrency, duration, "GET", f"/movie/{movie_id}"),
+                "POST /movies/{id}/rate": await run_load(
+                    client, concurrency, duration, "POST", f"/movies/{movie_id}/rate",
+                    json={"movie_id": movie_id, "stars": 4}, headers=headers,
+                ),
+            }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per endpoint")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{'mode':<6} {'endpoint':<24} {'requests':>9} {'errors':>7} {'req/s':>9} {'p99 ms':>9}")
+    for mode, use_async in (("sync", False), ("async", True)):
+        results = asyncio.run(bench_mode(use_async, args.port, args.concurrency, args.duration))
+        for endpoint, r in results.items():
+            print(f"{mode:<6} {endpoint:<24} {r['requests']:>9} {r['errors']:>7} {r['rps']:>9.1f} {r['p99_ms']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
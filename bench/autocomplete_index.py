@@ -0,0 +1,92 @@
+"""Memory footprint and lookup latency of the in-memory title autocomplete index.
+
+Builds an autocomplete.TitleIndex from --titles synthetic titles (datagen words,
+like generate-data movies) or, with --db, from the movies table in DB_URL. Reports
+the build time, the memory the index holds (tracemalloc) in total and per million
+titles, and the latency of --lookups random prefixes of 1 to 6 characters: cold
+(first lookup of a prefix) and warm (repeated, large prefixes answered from cache).
+
+    python bench/autocomplete_index.py --titles 1000000
+    python bench/autocomplete_index.py --db
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autocomplete import TitleIndex  # noqa: E402
+
+
+def synthetic_titles(count: int, rng):
+    import datagen
+
+    for movie_id in range(1, count + 1):
+        yield movie_id, f"{datagen.words(rng, rng.randint(1, 4)).title()} {movie_id}", int(rng.paretovariate(1.2)) - 1
+
+
+def database_titles():
+    import crud
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        return crud.movie_titles(db)
+    finally:
+        db.close()
+
+
+def percentile(samples, fraction: float) -> float:
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def time_lookups(index, prefixes):
+    samples = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        index.suggest(prefix, 10)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--titles", type=int, default=1_000_000)
+    parser.add_argument("--db", action="store_true", help="index the movies table in DB_URL instead")
+    parser.add_argument("--lookups", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = database_titles() if args.db else list(synthetic_titles(args.titles, rng))
+    start = time.perf_counter()
+    index = TitleIndex()
+    index.build(rows)
+    build_seconds = time.perf_counter() - start
+    # Built a second time to measure it, tracemalloc slows allocation down
+    tracemalloc.start()
+    measured = TitleIndex()
+    measured.build(rows)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del measured
+
+    titles = index.stats()["titles"]
+    print(f"titles: {titles:,}, build: {build_seconds:.1f} s")
+    print(f"memory: {held / 2**20:,.0f} MiB, {held / titles * 1e6 / 2**20 if titles else 0:,.0f} MiB per million titles")
+
+    prefixes = [title[:rng.randint(1, 6)] for _, title, _ in rng.choices(rows, k=args.lookups)] if rows else []
+    print(f"{'lookups':<8} {'count':>8} {'p50 us':>9} {'p99 us':>9} {'max us':>9}")
+    for name in ("cold", "warm"):
+        samples = time_lookups(index, prefixes)
+        print(f"{name:<8} {len(samples):>8} {statistics.median(samples):>9.1f} "
+              f"{percentile(samples, 0.99):>9.1f} {max(samples):>9.1f}")
+    print(f"cached prefixes: {index.stats()['cached_prefixes']:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Time GET /movies/{id}/comments on a large thread (50k comments by default).
+
+Seeds one movie in DB_URL with a random reply tree, then times the single-query
+fetch + linear tree assembly in crud.get_comments_for_movie and the response
+serialization, reporting the number of SQL statements issued. --legacy also times
+the old per-node lazy loading of Comment.children for comparison.
+
+    python bench/comment_thread.py --comments 50000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import TypeAdapter
+from sqlalchemy import insert, select
+
+import crud
+import models
+import schemas
+from database import Base, SessionLocal, count_statements, engine
+
+comment_list = TypeAdapter(List[schemas.Comment])
+
+
+def seed(db, comments: int, reply_ratio: float, seed_value: int):
+    owner = db.scalar(select(models.User).where(models.User.username == "bench_owner"))
+    if owner is None:
+        owner = models.User(username="bench_owner", full_name="Bench Owner",
+                            email="bench_owner@example.com", hashed_password="x")
+        db.add(owner)
+        db.flush()
+    movie = models.Movie(title="Bench Thread", description="comment thread benchmark", owner_id=owner.id)
+    db.add(movie)
+    db.commit()
+
+    rng = random.Random(seed_value)
+    ids = []
+    for start in range(0, comments, 5000):
+        rows = []
+        for n in range(start, min(start + 5000, comments)):
+            parent = rng.choice(ids) if ids and rng.random() < reply_ratio else None
+            rows.append({"text": f"comment {n}", "movie_id": movie.id, "user_id": owner.id, "parent_comment_id": parent})
+        result = db.execute(insert(models.Comment).returning(models.Comment.id), rows)
+        ids.extend(result.scalars().all())
+        db.commit()
+    return movie.id
+
+
+def timed(fn):
+    with count_statements() as counter:
+        start = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+    return result, elapsed, counter.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--comments", type=int, default=50_000)
+    parser.add_argument("--reply-ratio", type=float, default=0.8, help="share of comments that are replies")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--legacy", action="store_true", help="also time per-node lazy loading")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        movie_id = seed(db, args.comments, args.reply_ratio, args.seed)
+
+        roots, fetch_ms, statements = timed(lambda: crud.get_comments_for_movie(db, movie_id))
+        _, serialize_ms, _ = timed(lambda: comment_list.dump_json(comment_list.validate_python(roots)))
+        print(f"comments: {args.comments}, roots: {len(roots)}")
+        print(f"tree:   fetch+build {fetch_ms:9.1f} ms  serialize {serialize_ms:9.1f} ms  statements {statements}")
+
+        if args.legacy:
+            db.expunge_all()
+
+            def legacy():
+                rows = db.query(models.Comment).filter(models.Comment.movie_id == movie_id).all()
+                return comment_list.dump_json(comment_list.validate_python(rows, from_attributes=True))
+
+            _, legacy_ms, statements = timed(legacy)
+            print(f"legacy: fetch+serialize {legacy_ms:9.1f} ms  statements {statements}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Build time, size and lookup latency of the description TF-IDF index.
+
+Writes a content_index build for --movies synthetic descriptions of 10 to 40 words
+drawn from a --vocabulary word power law (as in real text, a few words are in most
+descriptions), into a temporary directory, then times --lookups
+ContentIndex.similar calls for random movies: the latency of GET
+/movies/{id}/similar-content apart from the one query for the movie rows. The
+recall is the share of the exact top --limit (every posting read) that the
+lookups return within --postings-limit, over --recall-sample movies.
+
+    python bench/content_similarity.py --movies 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from content_index import CONTENT_POSTINGS_LIMIT, ContentIndex, write_index  # noqa: E402
+from datagen import batched, zipf_cum_weights  # noqa: E402
+from recommendations import publish  # noqa: E402
+
+
+def descriptions(count: int, vocabulary: int, rng):
+    words = [f"w{n:x}" for n in range(vocabulary)]
+    cum_weights = zipf_cum_weights(vocabulary, 1.0)
+    for movie_id in range(1, count + 1):
+        yield movie_id, " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(10, 40)))
+
+
+def directory_mb(path: str) -> float:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movies", type=int, default=1_000_000)
+    parser.add_argument("--vocabulary", type=int, default=50_000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--postings-limit", type=int, default=CONTENT_POSTINGS_LIMIT)
+    parser.add_argument("--recall-sample", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        build = write_index(batched(descriptions(args.movies, args.vocabulary, rng), 50_000), directory)
+        publish(directory, build)
+        print(f"movies: {args.movies}, build {time.perf_counter() - start:.1f} s, {directory_mb(build):.0f} MiB on disk")
+
+        index = ContentIndex(directory, postings_limit=args.postings_limit)
+        index.similar(1, args.limit)
+        latencies = []
+        for _ in range(args.lookups):
+            movie_id = rng.randint(1, args.movies)
+            start = time.perf_counter()
+            index.similar(movie_id, args.limit)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+
+        exact = ContentIndex(directory, postings_limit=sys.maxsize)
+        found = expected = 0
+        for _ in range(args.recall_sample):
+            movie_id = rng.randint(1, args.movies)
+            best = {other for other, _ in exact.similar(movie_id, args.limit)}
+            found += len(best & {other for other, _ in index.similar(movie_id, args.limit)})
+            expected += len(best)
+        recall = found / expected if expected else 1.0
+        print(f"{'lookups':<10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'recall':>8}")
+        print(f"{args.lookups:<10} {statistics.median(latencies):>8.2f} {p99:>8.2f} {latencies[-1]:>8.2f} {recall:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
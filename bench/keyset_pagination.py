@@ -0,0 +1,91 @@
+"""Show that keyset pagination of GET /movies/ stays flat as the page number grows.
+
+Fills the movies table in DB_URL up to --rows rows (5M by default, inserted in
+batches) and times crud.get_movies for pages 1 .. 10,000, next to the equivalent
+OFFSET query it replaced.
+
+    python bench/keyset_pagination.py --rows 5000000 --limit 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, insert, select
+
+import crud
+import models
+from database import Base, SessionLocal, engine
+
+PAGES = [1, 10, 100, 1000, 10000]
+
+
+def seed(db, rows: int, batch: int):
+    existing = db.scalar(select(func.count(models.Movie.id)))
+    if existing >= rows:
+        return existing
+    owner = db.scalar(select(models.User).where(models.User.username == "bench_owner"))
+    if owner is None:
+        owner = models.User(username="bench_owner", full_name="Bench Owner",
+                            email="bench_owner@example.com", hashed_password="x")
+        db.add(owner)
+        db.commit()
+    for start in range(existing, rows, batch):
+        count = min(batch, rows - start)
+        db.execute(insert(models.Movie), [
+            {"title": f"Movie {n:08d}", "description": "benchmark movie", "owner_id": owner.id}
+            for n in range(start, start + count)
+        ])
+        db.commit()
+        print(f"\rseeded {start + count}/{rows}", end="", flush=True)
+    print()
+    return rows
+
+
+def timed(fn, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        total = seed(db, args.rows, args.batch)
+        print(f"movies: {total}, page size: {args.limit}")
+        print(f"{'page':>7} {'keyset ms':>10} {'offset ms':>10}")
+        for page in PAGES:
+            offset = (page - 1) * args.limit
+            if offset >= total:
+                break
+            # Cursor setup is not timed, a client would have it from the previous page
+            after = None
+            if offset:
+                last_id = db.scalar(select(models.Movie.id).order_by(models.Movie.id).offset(offset - 1).limit(1))
+                after = (last_id, last_id)
+            keyset = timed(lambda: crud.get_movies(db, limit=args.limit, after=after), args.repeat)
+            offset_ms = timed(
+                lambda: db.execute(select(models.Movie).order_by(models.Movie.id).offset(offset).limit(args.limit)).all(),
+                args.repeat,
+            )
+            print(f"{page:>7} {keyset:>10.3f} {offset_ms:>10.3f}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""Load test the running service with a weighted mix of realistic traffic scenarios.
+
+Seeds users, movies and a deep comment thread through the API, then drives the
+scenarios below against --url, either closed loop (--concurrency clients issuing
+back to back) or open loop (--rate arrivals per second, Poisson, latency measured
+from the scheduled arrival so a slow server cannot hide its queueing). Prints
+p50/p95/p99/max latency, throughput and error rate per request and per scenario,
+and writes the same to --out as JSON so runs can be diffed.
+
+    python bench/load.py --url http://127.0.0.1:8000 --concurrency 100 --duration 30
+    python bench/load.py --start --rate 400 --duration 30 --mix browse=80,rate=20 --out run.json
+
+Scenarios:
+    browse    GET /movies/, follow next_cursor once, GET /movie/{id}
+    login     POST /login
+    rate      a burst of POST /movies/{id}/rate from one user
+    comments  GET /movies/{id}/comments on a deep thread
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from async_vs_sync import percentile, start_server  # noqa: E402
+
+DEFAULT_MIX = "browse=70,login=5,rate=15,comments=10"
+
+
+class Recorder:
+    # Latencies and errors keyed by request ("GET /movie/{id}") or scenario ("scenario:browse")
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name: str, seconds: float, ok: bool):
+        self.latencies[name].append(seconds)
+        if not ok:
+            self.errors[name] += 1
+
+    def summary(self, elapsed: float):
+        report = {}
+        for name in sorted(self.latencies):
+            latencies = self.latencies[name]
+            report[name] = {
+                "requests": len(latencies),
+                "errors": self.errors[name],
+                "error_rate": self.errors[name] / len(latencies),
+                "throughput": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": max(latencies) * 1000,
+            }
+        return report
+
+
+class Dataset:
+    def __init__(self):
+        self.users = []  # (username, password, auth headers)
+        self.movie_ids = []
+        self.thread_movie_id = None
+
+
+async def request(client: httpx.AsyncClient, recorder: Recorder, name: str, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+        recorder.record(name, time.perf_counter() - start, False)
+        return None
+    recorder.record(name, time.perf_counter() - start, response.status_code < 400)
+    return response
+
+
+async def seed(client: httpx.AsyncClient, users: int, movies: int, thread_depth: int):
+    data = Dataset()
+    for _ in range(users):
+        name = f"load_{uuid.uuid4().hex[:12]}"
+        await client.post("/signup", json={
+            "username": name, "password": "loadpass", "full_name": "Load User", "email": f"{name}@example.com"
+        })
+        response = await client.post("/login", data={"username": name, "password": "loadpass"})
+        response.raise_for_status()
+        data.users.append((name, "loadpass", {"Authorization": f"Bearer {response.json()['access_token']}"}))
+
+    headers = data.users[0][2]
+    for i in range(movies):
+        response = await client.post("/movies", json={"title": f"Load Movie {i}", "description": "load test"}, headers=headers)
+        response.raise_for_status()
+        data.movie_ids.append(response.json()["id"])
+
+    # One thread of thread_depth nested replies, a couple of siblings per level
+    data.thread_movie_id = data.movie_ids[0]
+    response = await client.post(f"/movies/{data.thread_movie_id}/comments", json={"text": "root"}, headers=headers)
+    parent = response.json()["id"]
+    for depth in range(thread_depth):
+        for sibling in range(2):
+            await client.post(f"/comments/{parent}/reply", json={"text": f"sibling {depth}.{sibling}"}, headers=headers)
+        response = await client.post(f"/comments/{parent}/reply", json={"text": f"reply {depth}"}, headers=headers)
+        parent = response.json()["id"]
+    return data
+
+
+async def browse(client, recorder, data, rng):
+    response = await request(client, recorder, "GET /movies/", "GET", "/movies/", params={"limit": 20})
+    if response is not None and response.status_code == 200 and response.json()["next_cursor"]:
+        await request(client, recorder, "GET /movies/?after", "GET", "/movies/",
+                      params={"limit": 20, "after": response.json()["next_cursor"]})
+    await request(client, recorder, "GET /movie/{id}", "GET", f"/movie/{rng.choice(data.movie_ids)}")
+
+
+async def login(client, recorder, data, rng):
+    username, password, _ = rng.choice(data.users)
+    await request(client, recorder, "POST /login", "POST", "/login", data={"username": username, "password": password})
+
+
+async def rate(client, recorder, data, rng):
+    _, _, headers = rng.choice(data.users)
+    movie_id = rng.choice(data.movie_ids)
+    for _ in range(rng.randint(3, 10)):
+        await request(client, recorder, "POST /movies/{id}/rate", "POST", f"/movies/{movie_id}/rate",
+                      json={"movie_id": movie_id, "stars": rng.randint(0, 5)}, headers=headers)
+
+
+async def comments(client, recorder, data, rng):
+    await request(client, recorder, "GET /movies/{id}/comments", "GET", f"/movies/{data.thread_movie_id}/comments")
+
+
+SCENARIOS = {"browse": browse, "login": login, "rate": rate, "comments": comments}
+
+
+def parse_mix(value: str):
+    mix = {}
+    for item in filter(None, value.split(",")):
+        name, _, weight = item.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"unknown scenario {name!r}, expected one of {', '.join(SCENARIOS)}")
+        mix[name] = float(weight)
+    return mix
+
+
+async def run_scenario(name, client, recorder, data, rng, scheduled: float):
+    # scheduled is when the scenario should have started, so open loop latency includes queueing
+    ok = True
+    try:
+        await SCENARIOS[name](client, recorder, data, rng)
+    except Exception:
+        ok = False
+    recorder.record(f"scenario:{name}", time.perf_counter() - scheduled, ok)
+
+
+async def closed_loop(client, recorder, data, mix, concurrency: int, duration: float, think: float, seed: int):
+    deadline = time.perf_counter() + duration
+    names, weights = list(mix), list(mix.values())
+
+    async def worker(rng):
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            await run_scenario(name, client, recorder, data, rng, time.perf_counter())
+            if think:
+                await asyncio.sleep(rng.expovariate(1 / think))
+
+    await asyncio.gather(*(worker(random.Random(seed + i)) for i in range(concurrency)))
+
+
+async def open_loop(client, recorder, data, mix, rate: float, duration: float, max_in_flight: int, seed: int):
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    tasks = set()
+    dropped = 0
+    start = time.perf_counter()
+    scheduled = start
+    while scheduled < start + duration:
+        scheduled += rng.expovariate(rate)
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(tasks) >= max_in_flight:
+            dropped += 1
+            continue
+        name = rng.choices(names, weights)[0]
+        task = asyncio.ensure_future(
+            run_scenario(name, client, recorder, data, random.Random(rng.random()), scheduled)
+        )
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return dropped
+
+
+async def run(args):
+    mix = parse_mix(args.mix)
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        data = await seed(client, args.users, args.movies, args.thread_depth)
+        recorder = Recorder()
+        started = time.perf_counter()
+        dropped = 0
+        if args.rate:
+            dropped = await open_loop(client, recorder, data, mix, args.rate, args.duration, args.max_in_flight, args.seed)
+        else:
+            await closed_loop(client, recorder, data, mix, args.concurrency, args.duration, args.think, args.seed)
+        elapsed = time.perf_counter() - started
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {**vars(args), "mix": mix, "model": "open" if args.rate else "closed"},
+        "elapsed_s": elapsed,
+        "dropped_arrivals": dropped,
+        "results": recorder.summary(elapsed),
+    }
+
+
+def print_report(report):
+    print(f"{report['config']['model']} loop, {report['elapsed_s']:.1f}s, dropped arrivals {report['dropped_arrivals']}")
+    print(f"{'name':<30} {'requests':>9} {'err %':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, r in report["results"].items():
+        print(f"{name:<30} {r['requests']:>9} {r['error_rate'] * 100:>7.2f} {r['throughput']:>8.1f} "
+              f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['max_ms']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--start", action="store_true", help="start the app with uvicorn on --port and target it")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="scenario weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=50, help="closed loop clients")
+    parser.add_argument("--think", type=float, default=0.0, help="closed loop mean think time between scenarios, seconds")
+    parser.add_argument("--rate", type=float, default=0.0, help="open loop arrivals per second (0 means closed loop)")
+    parser.add_argument("--max-in-flight", type=int, default=10000, help="open loop arrivals beyond this are dropped")
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--movies", type=int, default=200)
+    parser.add_argument("--thread-depth", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    proc = None
+    if args.start:
+        proc = start_server(os.getenv("USE_ASYNC_DB", "false").lower() in ("1", "true", "yes"), args.port)
+        args.url = f"http://127.0.0.1:{args.port}"
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
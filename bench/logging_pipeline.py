@@ -0,0 +1,87 @@
+"""Compare the caller-side cost of logging with synchronous handlers vs the queue pipeline.
+
+Logs the same request-path lines from several threads through (a) the old
+RotatingFileHandler + StreamHandler set attached directly to the logger and
+(b) logging_config's QueueHandler feeding a background QueueListener, and reports
+mean and p99 time spent inside logger calls on the request threads.
+
+    python bench/logging_pipeline.py --threads 8 --calls 20000
+"""
+import argparse
+import logging
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from logging.handlers import QueueListener, RotatingFileHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logging_config import (
+    LOG_SAMPLE, TEXT_FORMAT, NonBlockingQueueHandler, SamplingFilter, make_handlers, parse_sample_rates,
+)
+
+
+def drive(logger, threads: int, calls: int):
+    samples = [[] for _ in range(threads)]
+
+    def worker(out):
+        for n in range(calls):
+            start = time.perf_counter()
+            if n % 2:
+                logger.info("Movie retrieved successfully")
+            else:
+                logger.info("Movie rated successfully: movie_id=%d, user_id=%d, stars=%d", n, n, 4)
+            out.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(out,)) for out in samples]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    flat = sorted(sample for out in samples for sample in out)
+    return statistics.mean(flat) * 1e6, flat[int(len(flat) * 0.99)] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--calls", type=int, default=20000, help="log calls per thread")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    devnull = open(os.devnull, "w")
+
+    sync_logger = logging.getLogger("bench.sync")
+    sync_logger.propagate = False
+    sync_logger.setLevel(logging.INFO)
+    for handler in (RotatingFileHandler(os.path.join(directory, "sync.log"), maxBytes=1000000, backupCount=3),
+                    logging.StreamHandler(devnull)):
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        sync_logger.addHandler(handler)
+
+    queued_logger = logging.getLogger("bench.queued")
+    queued_logger.propagate = False
+    queued_logger.setLevel(logging.INFO)
+    log_queue = queue.Queue(10000)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE)))
+    queued_logger.addHandler(queue_handler)
+    handlers = make_handlers(os.path.join(directory, "queued.log"), slow_query_log_file="")
+    handlers[1].setStream(devnull)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    print(f"{'pipeline':<10} {'mean us':>9} {'p99 us':>9}")
+    for name, logger in (("sync", sync_logger), ("queued", queued_logger)):
+        mean, p99 = drive(logger, args.threads, args.calls)
+        print(f"{name:<10} {mean:>9.2f} {p99:>9.2f}")
+    listener.stop()
+    print(f"queued records dropped (queue full): {queue_handler.dropped}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""Micro-benchmarks of the hot paths, with stored baselines and a regression check.
+
+Runs offline against an in-memory SQLite seeded with one movie and a comment
+thread, so the numbers measure the code rather than the network or the server.
+Each benchmark is calibrated to run for at least --min-time per round and timed
+over --rounds rounds; the median time per call is what baselines store and what
+compare checks.
+
+    python bench/micro.py run                          # print the table
+    python bench/micro.py run --save                   # store bench/baselines/micro.json
+    python bench/micro.py compare --threshold 10       # exit 1 if a median regressed > 10%
+    python bench/micro.py compare -k comments          # only benchmarks matching "comments"
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from typing import List
+
+# In-memory database and test credentials, set before the app modules read them
+os.environ["DB_URL"] = "sqlite://"
+os.environ.setdefault("SECRET_KEY", "micro-benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("LOG_FILE", os.devnull)
+os.environ.setdefault("SLOW_QUERY_LOG_FILE", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import TypeAdapter  # noqa: E402
+from sqlalchemy import insert, select  # noqa: E402
+from sqlalchemy.orm.attributes import set_committed_value  # noqa: E402
+
+import auth  # noqa: E402
+import crud  # noqa: E402
+import models  # noqa: E402
+import schemas  # noqa: E402
+from database import Base, SessionLocal, engine  # noqa: E402
+from hashing import pwd_context  # noqa: E402
+from pagination import MAX_COMMENT_DEPTH  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "micro.json")
+PASSWORD = "benchpass"
+
+comment_list = TypeAdapter(List[schemas.Comment])
+
+
+def seed(db, comments: int):
+    owner = models.User(username="micro", full_name="Micro Bench", email="micro@example.com",
+                        hashed_password=pwd_context.hash(PASSWORD))
+    db.add(owner)
+    db.flush()
+    movie = models.Movie(title="Micro Movie", description="micro benchmark", owner_id=owner.id)
+    db.add(movie)
+    db.flush()
+    # Ten root comments, every comment after them has up to 4 replies
+    rows = []
+    for n in range(1, comments + 1):
+        parent = (n - 11) // 4 + 1 if n > 10 else None
+        rows.append({"id": n, "text": f"comment {n}", "movie_id": movie.id, "user_id": owner.id, "parent_comment_id": parent})
+    db.execute(insert(models.Comment), rows)
+    db.commit()
+    return owner, movie
+
+
+def comment_rows(db, movie_id: int):
+    # The thread as models.Comment rows, children set without a lazy load, for the
+    # from_attributes validation path
+    rows = db.scalars(select(models.Comment).where(models.Comment.movie_id == movie_id).order_by(models.Comment.id)).all()
+    children = {row.id: [] for row in rows}
+    for row in rows:
+        if row.parent_comment_id is not None:
+            children[row.parent_comment_id].append(row)
+    for row in rows:
+        set_committed_value(row, "children", children[row.id])
+    return [row for row in rows if row.parent_comment_id is None]
+
+
+def benchmarks(db, owner, movie):
+    token = auth.create_access_token(auth.token_claims(owner))
+    loaded_movie = crud.get_movie(db, movie.id)
+    thread = comment_rows(db, movie.id)
+    auth.principal_cache.clear()
+    auth.get_current_user(db, token)  # warm the principal cache, as in steady state
+    return {
+        "crud.get_movie": lambda: crud.get_movie(db, movie.id),
+        "crud.get_comments_for_movie": lambda: crud.get_comments_for_movie(db, movie.id, max_depth=MAX_COMMENT_DEPTH),
+        "schemas.Movie.model_validate": lambda: schemas.Movie.model_validate(loaded_movie),
+        "schemas.Comment tree validate": lambda: comment_list.validate_python(thread),
+        "auth.create_access_token": lambda: auth.create_access_token(auth.token_claims(owner)),
+        "auth.get_current_user (cached)": lambda: auth.get_current_user(db, token),
+        "pwd_context.verify": lambda: pwd_context.verify(PASSWORD, owner.hashed_password),
+    }
+
+
+def measure(fn, rounds: int, min_time: float):
+    # Calibrate the calls per round so timer resolution does not matter, then keep the per call times
+    fn()
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        iterations *= 2 if elapsed < min_time / 10 else max(2, int(min_time / elapsed) + 1)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        samples.append((time.perf_counter() - start) / iterations)
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "mean": statistics.mean(samples),
+        "stddev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "rounds": rounds,
+        "iterations": iterations,
+    }
+
+
+def run(args):
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        owner, movie = seed(db, args.comments)
+        results = {}
+        for name, fn in benchmarks(db, owner, movie).items():
+            if args.k and args.k not in name:
+                continue
+            results[name] = measure(fn, args.rounds, args.min_time)
+            db.expunge_all()
+    finally:
+        db.close()
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()},
+        "comments": args.comments,
+        "results": results,
+    }
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def print_results(report, baseline=None):
+    header = f"{'benchmark':<34} {'median':>11} {'min':>11} {'stddev':>11} {'ops/s':>11}"
+    print(header + (f" {'baseline':>11} {'change':>8}" if baseline else ""))
+    for name, r in report["results"].items():
+        line = (f"{name:<34} {format_time(r['median']):>11} {format_time(r['min']):>11} "
+                f"{format_time(r['stddev']):>11} {1 / r['median']:>11,.0f}")
+        base = (baseline or {}).get("results", {}).get(name)
+        if base:
+            line += f" {format_time(base['median']):>11} {change(r, base):>+7.1f}%"
+        elif baseline:
+            line += f" {'-':>11} {'new':>8}"
+        print(line)
+
+
+def change(result, base) -> float:
+    return (result["median"] / base["median"] - 1) * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("run", "compare"):
+        sub = commands.add_parser(command)
+        sub.add_argument("-k", help="only run benchmarks whose name contains this")
+        sub.add_argument("--rounds", type=int, default=15)
+        sub.add_argument("--min-time", type=float, default=0.02, help="minimum seconds per round")
+        sub.add_argument("--comments", type=int, default=2000, help="size of the benchmarked comment thread")
+        sub.add_argument("--baseline", default=BASELINE)
+    commands.choices["run"].add_argument("--save", action="store_true", help="store the results as the baseline")
+    commands.choices["compare"].add_argument("--threshold", type=float, default=10.0,
+                                             help="fail when a median is this many percent slower than the baseline")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        if not os.path.exists(args.baseline):
+            raise SystemExit(f"no baseline at {args.baseline}, create one with: python bench/micro.py run --save")
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report = run(args)
+        print_results(report, baseline)
+        regressed = [
+            name for name, r in report["results"].items()
+            if name in baseline["results"] and change(r, baseline["results"][name]) > args.threshold
+        ]
+        if regressed:
+            print(f"\nregressed by more than {args.threshold:g}%: {', '.join(regressed)}")
+            sys.exit(1)
+        return
+
+    report = run(args)
+    print_results(report)
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nbaseline saved to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Round trips of the owner-checked PUT and DELETE /movies/{id}, before and after.
+
+Creates --count movies in DB_URL and edits then deletes each of them, once with
+the single UPDATE/DELETE ... RETURNING in crud.update_movie / crud.delete_movie
+and once the way the routes used to (load the movie to check the owner, select
+it again, write through the ORM, refresh). Reports SQL statements per call and
+the median latency, which on a networked database is mostly round trips.
+
+    python bench/owned_writes.py --count 500
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import joinedload
+
+import crud
+import models
+import schemas
+from database import Base, SessionLocal, count_statements, engine
+
+
+def legacy_update(db, movie_id: int, user_id: int, movie_update: schemas.MovieUpdate):
+    movie = db.query(models.Movie).options(joinedload(models.Movie.owner)).filter(models.Movie.id == movie_id).first()
+    if movie is None or movie.owner_id != user_id:
+        return None
+    movie = db.query(models.Movie).filter(models.Movie.id == movie_id).first()
+    movie.title = movie_update.title
+    db.commit()
+    db.refresh(movie)
+    return movie
+
+
+def legacy_delete(db, movie_id: int, user_id: int):
+    movie = db.query(models.Movie).options(joinedload(models.Movie.owner)).filter(models.Movie.id == movie_id).first()
+    if movie is None or movie.owner_id != user_id:
+        return False
+    movie = db.query(models.Movie).filter(models.Movie.id == movie_id).first()
+    db.delete(movie)
+    db.commit()
+    return True
+
+
+def seed(db, count: int):
+    owner = db.scalar(select(models.User).where(models.User.username == "bench_owner"))
+    if owner is None:
+        owner = models.User(username="bench_owner", full_name="Bench Owner",
+                            email="bench_owner@example.com", hashed_password="x")
+        db.add(owner)
+        db.commit()
+    ids = db.scalars(insert(models.Movie).returning(models.Movie.id), [
+        {"title": f"Owned {n}", "description": "owned writes benchmark", "owner_id": owner.id} for n in range(count)
+    ]).all()
+    db.commit()
+    return owner.id, ids
+
+
+def run(name, fn, ids):
+    latencies, statements = [], 0
+    for movie_id in ids:
+        db = SessionLocal()
+        try:
+            with count_statements() as counter:
+                start = time.perf_counter()
+                fn(db, movie_id)
+                latencies.append(time.perf_counter() - start)
+            statements += counter.count
+        finally:
+            db.close()
+    print(f"{name:<18} {statements / len(ids):>12.1f} {statistics.median(latencies) * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=500)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        user_id, legacy_ids = seed(db, args.count)
+        _, ids = seed(db, args.count)
+    finally:
+        db.close()
+
+    update = schemas.MovieUpdate(title="Renamed")
+    print(f"{'path':<18} {'statements':>12} {'median ms':>10}")
+    run("legacy update", lambda db, movie_id: legacy_update(db, movie_id, user_id, update), legacy_ids)
+    run("returning update", lambda db, movie_id: crud.update_movie(db, movie_id, user_id, update), ids)
+    run("legacy delete", lambda db, movie_id: legacy_delete(db, movie_id, user_id), legacy_ids)
+    run("returning delete", lambda db, movie_id: crud.delete_movie(db, movie_id, user_id), ids)
+
+
+if __name__ == "__main__":
+    main()
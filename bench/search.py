@@ -0,0 +1,102 @@
+"""Latency of GET /movies/search on a large movies table, next to a LIKE scan.
+
+Fills the movies table in DB_URL up to --movies rows with datagen (5M by default,
+titles and descriptions drawn from datagen.WORDS) and times crud.search_movies for
+a few kinds of query: a common word, two words, and a rare term (the number in one
+movie's title). Each is timed for the first page and for a page reached through the
+cursor, next to the ILIKE scan that was the only way to find a movie before.
+
+    python bench/search.py --movies 5000000 --limit 10
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, or_, select
+
+import crud
+import datagen
+import models
+from database import Base, SessionLocal, engine
+from pagination import decode_cursor
+from search import SEARCH_SORT, search_page
+
+
+def seed(db, movies: int, batch: int):
+    existing = db.scalar(select(func.count(models.Movie.id)))
+    if existing < movies:
+        missing = movies - existing
+        datagen.generate(users=max(1, missing // 1000), movies=missing, ratings=0, comments=0,
+                         seed=existing, batch=batch)
+    return max(existing, movies)
+
+
+def timed(fn, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def queries(db, rng):
+    word = rng.choice(datagen.WORDS)
+    words = " ".join(rng.sample(datagen.WORDS, 2))
+    movie_id = db.scalar(select(func.max(models.Movie.id)))
+    return [("common word", word), ("two words", words), ("rare term", str(rng.randint(1, movie_id)))]
+
+
+def scan(db, q: str, limit: int):
+    pattern = f"%{q}%"
+    return db.execute(
+        select(models.Movie)
+        .where(or_(models.Movie.title.ilike(pattern), models.Movie.description.ilike(pattern)))
+        .order_by(models.Movie.id)
+        .limit(limit)
+    ).all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movies", type=int, default=5_000_000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--page", type=int, default=10, help="page reached through the cursor")
+    parser.add_argument("--batch", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-scan", action="store_true", help="skip the ILIKE scan, slow on a large table")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        total = seed(db, args.movies, args.batch)
+        print(f"movies: {total}, page size: {args.limit}, dialect: {engine.dialect.name}")
+        print(f"{'query':<12} {'q':<24} {'page 1 ms':>10} {f'page {args.page} ms':>11} {'scan ms':>10}")
+        for kind, q in queries(db, random.Random(args.seed)):
+            first = timed(lambda: crud.search_movies(db, q, limit=args.limit), args.repeat)
+            # Cursor setup is not timed, a client would have it from the previous page
+            after = None
+            for _ in range(args.page - 1):
+                page = search_page(crud.search_movies(db, q, limit=args.limit, after=after), args.limit)
+                if page["next_cursor"] is None:
+                    after = None
+                    break
+                after = decode_cursor(page["next_cursor"], SEARCH_SORT)
+            deep = "-"
+            if after:
+                deep = f"{timed(lambda: crud.search_movies(db, q, limit=args.limit, after=after), args.repeat):.2f}"
+            scan_ms = "-" if args.no_scan else f"{timed(lambda: scan(db, q, args.limit), args.repeat):.2f}"
+            print(f"{kind:<12} {q:<24} {first:>10.2f} {deep:>11} {scan_ms:>10}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Run time and peak memory of the similar-movies job as the ratings grow.
+
+Loads --users, --movies and --ratings synthetic rows (datagen, like generate-data)
+into DB_URL when it holds fewer ratings, then runs similarity.refresh_similarities
+in full, rates --changed movies and runs it incrementally. Reports the seconds of
+each run and the peak resident memory, which should follow --memory-mb and
+--max-pairs rather than the number of ratings (the matrix itself is memory mapped).
+
+    python bench/similar_movies.py --ratings 10000000 --memory-mb 256
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select  # noqa: E402
+
+import crud  # noqa: E402
+import datagen  # noqa: E402
+import models  # noqa: E402
+import schemas  # noqa: E402
+import similarity  # noqa: E402
+from database import Base, SessionLocal, engine  # noqa: E402
+
+
+def peak_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--movies", type=int, default=50_000)
+    parser.add_argument("--ratings", type=int, default=1_000_000)
+    parser.add_argument("--changed", type=int, default=100, help="movies rated before the incremental run")
+    parser.add_argument("--memory-mb", type=int, default=512)
+    parser.add_argument("--max-pairs", type=int, default=5_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        if db.scalar(select(func.count()).select_from(models.Rating)) < args.ratings:
+            datagen.generate(args.users, args.movies, args.ratings, 0, seed=args.seed, report=lambda line: None, db=db)
+        ratings = db.scalar(select(func.count()).select_from(models.Rating))
+        options = {"memory_mb": args.memory_mb, "max_pairs": args.max_pairs, "report": lambda line: None}
+        print(f"ratings: {ratings}, memory_mb: {args.memory_mb}, max_pairs: {args.max_pairs}, dialect: {engine.dialect.name}")
+        print(f"{'run':<12} {'movies':>10} {'seconds':>10} {'peak MiB':>10}")
+        result = similarity.refresh_similarities(db, full=True, **options)
+        print(f"{'full':<12} {result['recomputed']:>10} {result['seconds']:>10.1f} {peak_mb():>10.0f}")
+
+        rng = random.Random(args.seed)
+        user_id = db.scalar(select(func.max(models.User.id)))
+        movie_ids = db.scalars(select(models.Movie.id)).all()
+        for movie_id in rng.sample(movie_ids, min(args.changed, len(movie_ids))):
+            crud.upsert_rating(db, schemas.RatingCreate(movie_id=movie_id, stars=rng.randint(1, 5)), user_id)
+        result = similarity.refresh_similarities(db, **options)
+        print(f"{'incremental':<12} {result['recomputed']:>10} {result['seconds']:>10.1f} {peak_mb():>10.0f}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import argparse
+import os
+
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+
+import content_index
+import crud
+import datagen
+import models
+import recommendations
+import similarity
+from database import SessionLocal, engine
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+
+
+def require_migrated():
+    # The schema belongs to the migrations, a command writing rows needs it at head
+    head = ScriptDirectory.from_config(Config(ALEMBIC_INI)).get_current_head()
+    with engine.connect() as connection:
+        current = MigrationContext.configure(connection).get_current_revision()
+    if current != head:
+        raise SystemExit(f"Database is at revision {current or 'none'}, not {head}: run alembic upgrade head first")
+
+
+def snapshot_session(read_only: bool=False):
+    # The offline jobs count the ratings, then read them, in separate statements: on
+    # PostgreSQL they run in one REPEATABLE READ snapshot, so ratings written meanwhile
+    # wait for the next run instead of failing it
+    if engine.dialect.name != "postgresql":
+        return SessionLocal()
+    return SessionLocal(bind=engine.execution_options(isolation_level="REPEATABLE READ", postgresql_readonly=read_only))
+
+
+def reconcile_ratings(args):
+    db = SessionLocal()
+    try:
+        updated = crud.rebuild_rating_aggregates(db)
+    finally:
+        db.close()
+    print(f"Rebuilt rating aggregates for {updated} movies")
+
+
+def dedupe_ratings(args):
+    # Databases created before the unique (user_id, movie_id) index can hold repeated ratings
+    db = SessionLocal()
+    try:
+        deleted = crud.delete_duplicate_ratings(db)
+        for index in models.Rating.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
+        updated = crud.rebuild_rating_aggregates(db)
+    finally:
+        db.close()
+    print(f"Deleted {deleted} duplicate ratings, rebuilt rating aggregates for {updated} movies")
+
+
+def similar_movies(args):
+    db = snapshot_session()
+    try:
+        result = similarity.refresh_similarities(
+            db, full=args.full, top_k_count=args.top_k, memory_mb=args.memory_mb,
+            max_pairs=args.max_pairs, workdir=args.workdir,
+        )
+    finally:
+        db.close()
+    print(f"Recomputed {result['recomputed']} movies, merged into {result['merged']} lists in {result['seconds']:.1f} s")
+
+
+def train_recommendations(args):
+    db = snapshot_session(read_only=True)
+    try:
+        result = recommendations.train_recommendations(
+            db, factors=args.factors, iterations=args.iterations, regularization=args.regularization,
+            workers=args.workers, top_n=args.top_n, memory_mb=args.memory_mb, seed=args.seed, directory=args.dir,
+        )
+    finally:
+        db.close()
+    print(f"Trained {result['users']} users x {result['movies']} movies, training rmse {result['rmse']:.4f} "
+          f"in {result['seconds']:.1f} s")
+
+
+def build_content_index(args):
+    db = snapshot_session(read_only=True)
+    try:
+        result = content_index.build_content_index(db, directory=args.dir)
+    finally:
+        db.close()
+    print(f"Indexed {result['documents']} movies, {result['postings']} postings in {result['seconds']:.1f} s")
+
+
+def generate_data(args):
+    require_migrated()
+    results = datagen.generate(
+        args.users, args.movies, args.ratings, args.comments,
+        seed=args.seed, batch=args.batch, password=args.password, alpha=args.alpha,
+    )
+    rows = sum(count for _, count, _ in results)
+    seconds = sum(seconds for _, _, seconds in results)
+    print(f"{'total':<10} {rows:>12,} rows {seconds:>9.1f} s {rows / seconds if seconds else 0:>12,.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the movie API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    reconcile = commands.add_parser("reconcile-ratings", help="rebuild Movie rating aggregates from the ratings table")
+    reconcile.set_defaults(func=reconcile_ratings)
+
+    dedupe = commands.add_parser("dedupe-ratings",
+                                 help="keep the latest rating per user and movie and add the unique index")
+    dedupe.set_defaults(func=dedupe_ratings)
+
+    similar = commands.add_parser("similar-movies",
+                                  help="refresh the similar movies lists of the movies rated since the last run")
+    similar.add_argument("--full", action="store_true", help="recompute every movie, after bulk loads")
+    similar.add_argument("--top-k", type=int, default=similarity.SIMILAR_TOP_K, help="movies kept per list")
+    similar.add_argument("--memory-mb", type=int, default=512, help="size of the score arrays of one block")
+    similar.add_argument("--max-pairs", type=int, default=5_000_000,
+                         help="rating pairs joined at a time, and ratings per block")
+    similar.add_argument("--workdir", help="directory of the .npy ratings matrix, a temporary one by default")
+    similar.set_defaults(func=similar_movies)
+
+    train = commands.add_parser("train-recommendations",
+                                help="fit the recommendation model and store every user's top movies")
+    train.add_argument("--factors", type=int, default=recommendations.RECOMMEND_FACTORS)
+    train.add_argument("--iterations", type=int, default=10)
+    train.add_argument("--regularization", type=float, default=0.05, help="times the ratings of the user or movie")
+    train.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="solver processes")
+    train.add_argument("--top-n", type=int, default=recommendations.RECOMMEND_TOP_N, help="movies stored per user")
+    train.add_argument("--memory-mb", type=int, default=256, help="working memory of the solvers together")
+    train.add_argument("--seed", type=int, default=0)
+    train.add_argument("--dir", default=recommendations.RECOMMENDATIONS_DIR,
+                       help="where the model is published, RECOMMENDATIONS_DIR of the API")
+    train.set_defaults(func=train_recommendations)
+
+    content = commands.add_parser("build-content-index",
+                                  help="index the movie descriptions for the similar by description lookups")
+    content.add_argument("--dir", default=content_index.CONTENT_INDEX_DIR,
+                         help="where the index is published, CONTENT_INDEX_DIR of the API")
+    content.set_defaults(func=build_content_index)
+
+    generate = commands.add_parser("generate-data", help="bulk load synthetic users, movies, ratings and comments")
+    generate.add_argument("--users", type=int, default=10_000)
+    generate.add_argument("--movies", type=int, default=100_000)
+    generate.add_argument("--ratings", type=int, default=1_000_000)
+    generate.add_argument("--comments", type=int, default=1_000_000)
+    generate.add_argument("--seed", type=int, default=0, help="same seed and counts give the same data")
+    generate.add_argument("--batch", type=int, default=10_000, help="rows per COPY / executemany batch")
+    generate.add_argument("--password", default="password", help="password of every generated user")
+    generate.add_argument("--alpha", type=float, default=1.1, help="power law exponent of popularity and activity")
+    generate.set_defaults(func=generate_data)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
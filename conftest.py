@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+# Test settings, applied before the app modules read their environment.
+# TEST_DB_URL picks the database: by default an in-memory SQLite (one per xdist worker),
+# or e.g. a Postgres URL, where each test runs in a transaction that is rolled back.
+# The async routes (USE_ASYNC_DB) cannot join that transaction, they get a throwaway
+# SQLite file unless TEST_DB_URL is set, and their writes are committed.
+if os.environ.get("USE_ASYNC_DB", "false").lower() in ("1", "true", "yes"):
+    default_url = f"sqlite:///{tempfile.mkdtemp()}/test.db"
+else:
+    default_url = "sqlite://"
+os.environ["DB_URL"] = os.environ.get("TEST_DB_URL", default_url)
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+# Hash inline, a worker process would not see the cheap bcrypt cost below
+os.environ.setdefault("HASH_WORKERS", "0")
+os.environ.setdefault("LOG_FILE", os.devnull)
+os.environ.setdefault("SLOW_QUERY_LOG_FILE", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# The title index is built from the test transaction on the first lookup instead
+os.environ.setdefault("AUTOCOMPLETE_WARMUP", "false")
+
+from hashing import pwd_context  # noqa: E402
+
+# Minimum bcrypt cost, signup and login tests do not need to be slow
+pwd_context.update(bcrypt__rounds=4)
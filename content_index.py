@@ -0,0 +1,325 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from itertools import islice
+
+import numpy as np
+from sqlalchemy import select
+
+from models import Movie
+from recommendations import CURRENT, publish
+from search import search_terms
+
+# Content-based "similar movies": cosine similarity of the descriptions' TF-IDF vectors,
+# (1 + log tf) * idf, L2 normalized. python cli.py build-content-index writes the index
+# to CONTENT_INDEX_DIR as .npy files: every movie's vector (CSR by movie id) and every
+# term's postings (CSC), each list ordered by weight, best first. API workers memory map
+# the files and switch to a new build on their next lookup.
+#
+# Once a build is loaded, movies created or edited through crud.py go to an in-memory delta
+# of this process, weighted with the build's idf, until a build includes them: a build
+# records the time it started reading (meta.json "snapshot"), the writes recorded before it
+# are dropped from the delta when the build is loaded, later ones are kept. The clocks of
+# the API hosts and of the host running the build should agree. Like the title index,
+# writes from other processes show up with the next build.
+
+CONTENT_INDEX_DIR = os.environ.get("CONTENT_INDEX_DIR", "content_index")
+CONTENT_TOP_K = int(os.environ.get("CONTENT_TOP_K", 20))
+# Postings read per lookup, shared by its terms: rare terms are read in full, the lists of
+# terms that a large part of the catalog uses are cut to their best weighted postings.
+# Bounds the time of a lookup at the price of an approximate top K.
+CONTENT_POSTINGS_LIMIT = int(os.environ.get("CONTENT_POSTINGS_LIMIT", 100_000))
+# Movies the delta of a process holds. Past it, edits only hide the out of date vector of
+# the movie in the build, and a rebuild is logged as due.
+CONTENT_DELTA_LIMIT = int(os.environ.get("CONTENT_DELTA_LIMIT", 10_000))
+# Delta movies scored per lookup, taken from the terms with the fewest delta movies first
+DELTA_CANDIDATES = 1_000
+# Descriptions fetched per round trip while building
+BUILD_CHUNK = 50_000
+INDEX_FILES = ("doc_indptr", "doc_terms", "doc_weights", "post_indptr", "post_docs", "post_weights", "df")
+
+STOP_WORDS = frozenset(
+    "a about after all an and are as at be been but by for from had has have he her his in into is it its "
+    "of on one or she that the their them they this to was were when which while who will with".split()
+)
+
+logger = logging.getLogger("content_index")
+
+
+def tokenize(text) -> list:
+    return [term for term in search_terms(text or "") if len(term) > 1 and term not in STOP_WORDS]
+
+
+def inverse_document_frequency(df, documents: int):
+    # Smoothed, a term of every document still weighs 1
+    return np.log((documents + 1) / (df + 1)) + 1
+
+
+def write_index(chunks, directory: str, snapshot: float=None):
+    # chunks: lists of (movie id, description) in movie id order, read from the database
+    # as of snapshot (time.time(), defaults to now). Returns the build directory, published
+    # by the caller.
+    snapshot = time.time() if snapshot is None else snapshot
+    vocabulary = {}
+    ids, lengths, terms, counts = [], [], [], []
+    for chunk in chunks:
+        chunk_lengths, chunk_terms, chunk_counts = [], [], []
+        for movie_id, description in chunk:
+            tf = Counter(tokenize(description))
+            chunk_lengths.append(len(tf))
+            chunk_terms.extend(vocabulary.setdefault(term, len(vocabulary)) for term in tf)
+            chunk_counts.extend(tf.values())
+        ids.append(np.fromiter((movie_id for movie_id, _ in chunk), dtype=np.int64, count=len(chunk)))
+        lengths.append(np.array(chunk_lengths, dtype=np.int64))
+        terms.append(np.array(chunk_terms, dtype=np.int32))
+        counts.append(np.array(chunk_counts, dtype=np.float64))
+    ids, lengths = np.concatenate(ids or [[]]).astype(np.int64), np.concatenate(lengths or [[]]).astype(np.int64)
+    terms, counts = np.concatenate(terms or [[]]).astype(np.int32), np.concatenate(counts or [[]])
+    n_rows = int(ids.max()) + 1 if len(ids) else 1
+
+    df = np.bincount(terms, minlength=len(vocabulary))
+    docs = np.repeat(ids, lengths)
+    weights = (1 + np.log(counts)) * inverse_document_frequency(df, len(ids))[terms]
+    norms = np.sqrt(np.bincount(docs, weights=np.square(weights), minlength=n_rows))
+    weights = (weights / norms[docs]).astype(np.float32)
+    doc_indptr = np.concatenate(([0], np.cumsum(np.bincount(docs, minlength=n_rows))))
+
+    # A term of a single movie only matches that movie, it has no postings
+    shared = df[terms] > 1
+    order = np.lexsort((-weights[shared], terms[shared]))
+    post_terms = terms[shared][order]
+    post_indptr = np.concatenate(([0], np.cumsum(np.bincount(post_terms, minlength=len(vocabulary)))))
+
+    os.makedirs(directory, exist_ok=True)
+    build = os.path.join(directory, f"model-{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}")
+    os.makedirs(build)
+    arrays = {
+        "doc_indptr": doc_indptr, "doc_terms": terms, "doc_weights": weights,
+        "post_indptr": post_indptr, "post_docs": docs[shared][order].astype(np.int32),
+        "post_weights": weights[shared][order], "df": df,
+    }
+    for name in INDEX_FILES:
+        np.save(os.path.join(build, f"{name}.npy"), arrays[name])
+    with open(os.path.join(build, "terms.json"), "w") as f:
+        json.dump(list(vocabulary), f)
+    with open(os.path.join(build, "meta.json"), "w") as f:
+        json.dump({"documents": len(ids), "postings": len(post_terms), "snapshot": snapshot}, f)
+    return build
+
+
+def build_content_index(db, directory: str=CONTENT_INDEX_DIR, report=print):
+    start = time.perf_counter()
+    # Before the read: every write recorded before it is in the rows
+    snapshot = time.time()
+    rows = db.execute(
+        select(Movie.id, Movie.description).order_by(Movie.id).execution_options(yield_per=BUILD_CHUNK)
+    )
+
+    def chunks():
+        read = 0
+        for chunk in rows.partitions():
+            read += len(chunk)
+            report(f"read {read} movies")
+            yield chunk
+
+    build = write_index(chunks(), directory, snapshot=snapshot)
+    publish(directory, build)
+    with open(os.path.join(build, "meta.json")) as f:
+        meta = json.load(f)
+    return {**meta, "seconds": time.perf_counter() - start}
+
+
+class ContentIndex:
+    # Lookups on the published build plus this process's delta, safe to share between
+    # the threadpool workers that run sync routes
+
+    def __init__(
+        self, directory: str=CONTENT_INDEX_DIR, postings_limit: int=CONTENT_POSTINGS_LIMIT,
+        delta_limit: int=CONTENT_DELTA_LIMIT,
+    ):
+        self.directory = directory
+        self.postings_limit = postings_limit
+        self.delta_limit = delta_limit
+        self._path = None
+        self._arrays = None
+        self._terms = []
+        self._vocabulary = {}
+        self._documents = 0
+        # movie id -> (recorded at, term counts, normalized vector) of movies created or
+        # edited since the build, and term -> ids of those movies
+        self._delta = {}
+        self._delta_postings = {}
+        # movie id -> recorded at, of movies whose vector in the build is out of date
+        # (edited or deleted)
+        self._stale = {}
+        self._delta_full = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        path = os.path.realpath(os.path.join(self.directory, CURRENT))
+        if path == self._path:
+            return
+        with self._lock:
+            if path == self._path:
+                return
+            arrays, terms, documents, snapshot = None, [], 0, 0.0
+            if os.path.isdir(path):
+                # Plain ndarray views of the maps, slicing a np.memmap costs more per lookup
+                arrays = {
+                    name: np.asarray(np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")) for name in INDEX_FILES
+                }
+                with open(os.path.join(path, "terms.json")) as f:
+                    terms = json.load(f)
+                with open(os.path.join(path, "meta.json")) as f:
+                    meta = json.load(f)
+                documents, snapshot = meta["documents"], meta["snapshot"]
+            self._arrays, self._terms, self._documents = arrays, terms, documents
+            self._vocabulary = {term: term_id for term_id, term in enumerate(terms)}
+            # The build read the writes recorded before its snapshot, later ones are kept
+            # and weighted again with the idf of the build
+            for movie_id in [movie_id for movie_id, (recorded, _, _) in self._delta.items() if recorded < snapshot]:
+                self._drop(movie_id)
+            for movie_id, (recorded, counts, _) in self._delta.items():
+                self._delta[movie_id] = (recorded, counts, self._delta_vector(counts))
+            self._stale = {movie_id: recorded for movie_id, recorded in self._stale.items() if recorded >= snapshot}
+            self._delta_full = False
+            self._path = path
+
+    def clear(self):
+        with self._lock:
+            self._path = None
+            self._arrays, self._terms, self._documents = None, [], 0
+            self._vocabulary = {}
+            self._delta.clear()
+            self._delta_postings.clear()
+            self._stale.clear()
+            self._delta_full = False
+
+    def _drop(self, movie_id: int):
+        _, counts, _ = self._delta.pop(movie_id, (None, (), None))
+        for term in counts:
+            ids = self._delta_postings[term]
+            ids.discard(movie_id)
+            if not ids:
+                del self._delta_postings[term]
+
+    def add(self, movie_id: int, description):
+        # New or edited movie. Before a build is loaded there is nothing to update, the
+        # first build reads it.
+        self._load()
+        recorded = time.time()
+        with self._lock:
+            if self._arrays is None:
+                return
+            self._drop(movie_id)
+            self._stale[movie_id] = recorded
+            if len(self._delta) >= self.delta_limit:
+                if not self._delta_full:
+                    logger.warning(
+                        "Content index delta is full (%d movies), run python cli.py build-content-index",
+                        len(self._delta),
+                    )
+                    self._delta_full = True
+                return
+            counts = Counter(tokenize(description))
+            self._delta[movie_id] = (recorded, counts, self._delta_vector(counts))
+            for term in counts:
+                self._delta_postings.setdefault(term, set()).add(movie_id)
+
+    def remove(self, movie_id: int):
+        self._load()
+        recorded = time.time()
+        with self._lock:
+            if self._arrays is None:
+                return
+            self._drop(movie_id)
+            self._stale[movie_id] = recorded
+
+    def _idf(self, term: str) -> float:
+        term_id = self._vocabulary.get(term)
+        df = int(self._arrays["df"][term_id]) if term_id is not None else 0
+        return math.log((self._documents + 1) / (df + 1)) + 1
+
+    def _delta_vector(self, counts: Counter):
+        weights = {term: (1 + math.log(tf)) * self._idf(term) for term, tf in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+        return {term: weight / norm for term, weight in weights.items()} if norm else {}
+
+    def _vector(self, movie_id: int):
+        # term -> weight of the movie, empty when it has no indexed description
+        if movie_id in self._delta:
+            return self._delta[movie_id][2]
+        arrays = self._arrays
+        if arrays is None or movie_id in self._stale or movie_id >= len(arrays["doc_indptr"]) - 1:
+            return {}
+        first, last = arrays["doc_indptr"][movie_id], arrays["doc_indptr"][movie_id + 1]
+        return {
+            self._terms[term_id]: weight
+            for term_id, weight in zip(arrays["doc_terms"][first:last].tolist(), arrays["doc_weights"][first:last].tolist())
+        }
+
+    def _build_scores(self, vector: dict, movie_id: int, limit: int):
+        # Best candidates of the build, (ids, scores): the postings of every term of the
+        # vector, summed per movie with np.bincount
+        arrays = self._arrays
+        if arrays is None:
+            return []
+        post_indptr, post_docs, post_weights = arrays["post_indptr"], arrays["post_docs"], arrays["post_weights"]
+        lists = []  # (postings, first, weight) of the terms in the build
+        for term, weight in vector.items():
+            term_id = self._vocabulary.get(term)
+            if term_id is not None:
+                first = int(post_indptr[term_id])
+                lists.append((int(post_indptr[term_id + 1]) - first, first, weight))
+        rows, weights = [], []
+        budget = self.postings_limit
+        # Shortest lists first, what they leave of the budget goes to the longer ones
+        for left, (postings, first, weight) in zip(range(len(lists), 0, -1), sorted(lists)):
+            take = min(postings, budget // left)
+            rows.append(post_docs[first:first + take])
+            weights.append(post_weights[first:first + take] * np.float32(weight))
+            budget -= take
+        if not rows:
+            return []
+        rows = np.concatenate(rows)
+        if not len(rows):
+            return []
+        scores = np.bincount(rows, weights=np.concatenate(weights))
+        # Not the movie itself, nor movies whose build vector is out of date
+        excluded = [other for other in self._stale.keys() | {movie_id} if other < len(scores)]
+        scores[excluded] = 0
+        # A movie appears once per shared term, the limit x terms best entries hold the
+        # limit best movies
+        take = min(len(rows), limit * len(vector))
+        best = rows[np.argpartition(-scores[rows], take - 1)[:take]]
+        best = np.unique(best)
+        return [(movie, score) for movie, score in zip(best.tolist(), scores[best].tolist()) if score > 0]
+
+    def similar(self, movie_id: int, limit: int=10):
+        # (movie id, cosine similarity) of the most similar descriptions, best first
+        self._load()
+        with self._lock:
+            vector = self._vector(movie_id)
+            if not vector:
+                return []
+            candidates = dict(self._build_scores(vector, movie_id, limit))
+            # Delta movies sharing a term, at most DELTA_CANDIDATES of them
+            others = set()
+            for ids in sorted((self._delta_postings.get(term, ()) for term in vector), key=len):
+                others.update(islice(ids, DELTA_CANDIDATES - len(others)))
+            for other in others - {movie_id}:
+                other_vector = self._delta[other][2]
+                candidates[other] = sum(weight * other_vector.get(term, 0.0) for term, weight in vector.items())
+        ranked = sorted(candidates.items(), key=lambda item: (-item[1], item[0]))
+        return [(other, score) for other, score in ranked if score > 0][:limit]
+
+    def stats(self) -> dict:
+        return {"movies": self._documents, "delta_movies": len(self._delta)}
+
+
+content_index = ContentIndex()
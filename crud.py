@@ -1,9 +1,21 @@
 import models
 import schemas
-from models import Movie, Rating, Comment
+from typing import Optional
+from models import Movie, MovieSimilarity, Rating, Comment, STAR_VALUES
 from schemas import MovieUpdate, RatingCreate
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, joinedload, raiseload
+from sqlalchemy.orm.attributes import set_committed_value
+from autocomplete import title_index
+from content_index import content_index
+from pagination import movies_page_query
+from search import search_movies_query, search_terms
+
+# Loading strategy for movies serialized as schemas.Movie: the owner comes in the same
+# query, ratings and comments are never needed and raise instead of lazy loading
+MOVIE_DETAIL_OPTIONS = (joinedload(Movie.owner), raiseload(Movie.ratings), raiseload(Movie.comments))
 
 
 def create_user(db: Session, user: schemas.UserCreate, hashed_password: str):
@@ -15,7 +27,6 @@ def create_user(db: Session, user: schemas.UserCreate, hashed_password: str):
     )
     db.add(db_user)
     db.commit()
-    db.refresh(db_user)
     return db_user
 
 
@@ -34,62 +45,255 @@ def create_movie(db: Session, movie: schemas.MovieCreate, user_id: int):
     )
     db.add(db_movie)
     db.commit()
-    db.refresh(db_movie)
+    title_index.add(db_movie.id, db_movie.title)
+    content_index.add(db_movie.id, db_movie.description)
     return db_movie
 
 
 def get_movie(db: Session, movie_id: int):
-    return db.query(models.Movie).filter(models.Movie.id == movie_id).first()
+    return db.query(models.Movie).options(*MOVIE_DETAIL_OPTIONS).filter(models.Movie.id == movie_id).first()
 
 
-def get_movies(db: Session, skip: int=0, limit: int=10):
-    return db.query(models.Movie).offset(skip).limit(limit).all()
+def get_movie_json(db: Session, movie_id: int):
+    # schemas.Movie serialized once, so coalesced callers can share the body
+    movie = get_movie(db, movie_id)
+    return schemas.Movie.model_validate(movie).model_dump_json() if movie else None
 
-def get_movie_by_id(db: Session, movie_id: int):
-    return db.query(models.Movie).filter(models.Movie.id == movie_id).first()
 
-def update_movie(db: Session, movie_id: int, movie_update: schemas.MovieUpdate):
-    movie = db.query(models.Movie).filter(models.Movie.id == movie_id).first()
-    if not movie:
-        raise None
-    
-    if movie_update.title is not None:
-        movie.title = movie_update.title
-    if movie_update.description is not None:
-        movie.description = movie_update.description
-    
-    # commit the changes to the database
+def get_movies(db: Session, limit: int=10, after=None, sort: str="id"):
+    # Keyset pagination, returns up to limit + 1 rows (see pagination.movies_page)
+    return db.execute(movies_page_query(limit, after, sort)).scalars().all()
+
+def search_movies(db: Session, q: str, limit: int=10, after=None):
+    # (movie, rank) rows best match first, up to limit + 1 (see search.search_page)
+    terms = search_terms(q)
+    if not terms:
+        return []
+    return db.execute(search_movies_query(db.bind.dialect.name, terms, limit, after)).all()
+
+def movie_titles(db: Session):
+    # (id, title, rating_count) of every movie, what autocomplete.TitleIndex is built from
+    return db.execute(select(Movie.id, Movie.title, Movie.rating_count).execution_options(yield_per=50000)).all()
+
+# Columns of schemas.MovieSummary, rows of them validate without loading Movie objects
+MOVIE_SUMMARY_COLUMNS = (Movie.id, Movie.title, Movie.description, Movie.owner_id, Movie.rating_count, Movie.rating_sum)
+
+def similar_movies_query(movie_id: int, limit: int):
+    # One range of the movie_similarities primary key, joined to the listed movies.
+    # Rows carry the schemas.SimilarMovie fields
+    return (
+        select(*MOVIE_SUMMARY_COLUMNS, MovieSimilarity.score)
+        .join(MovieSimilarity, MovieSimilarity.similar_movie_id == Movie.id)
+        .where(MovieSimilarity.movie_id == movie_id)
+        .order_by(MovieSimilarity.rank)
+        .limit(limit)
+    )
+
+def get_similar_movies(db: Session, movie_id: int, limit: int=10):
+    # Most similar first, the lists are written by similarity.refresh_similarities
+    return db.execute(similar_movies_query(movie_id, limit)).all()
+
+def get_movie_summaries(db: Session, movie_ids):
+    return db.execute(select(*MOVIE_SUMMARY_COLUMNS).where(Movie.id.in_(movie_ids))).all()
+
+def movies_in_order(rows, picks):
+    # Movie summary rows for picks, (movie id, score) pairs, in pick order with their
+    # score. Movies deleted since the picks were computed are left out.
+    by_id = {row.id: row for row in rows}
+    return [{**by_id[movie_id]._mapping, "score": score} for movie_id, score in picks if movie_id in by_id]
+
+def rated_movie_ids(db: Session, user_id: int):
+    # Answered from the (user_id, movie_id) unique index alone
+    return db.scalars(select(Rating.movie_id).where(Rating.user_id == user_id)).all()
+
+def movie_exists(db: Session, movie_id: int) -> bool:
+    # Only asked when an owner-checked write matched nothing, to tell 404 from 403
+    return db.scalar(select(Movie.id).where(Movie.id == movie_id)) is not None
+
+def update_owned_movie(movie_id: int, user_id: int, movie_update: schemas.MovieUpdate):
+    # The owner check is in the WHERE and the new row comes back with RETURNING
+    values = movie_update.model_dump(exclude_none=True) or {"title": Movie.title}
+    return (
+        update(Movie)
+        .where(Movie.id == movie_id, Movie.owner_id == user_id)
+        .values(values)
+        .returning(*Movie.__table__.columns)
+        .execution_options(synchronize_session=False)
+    )
+
+def delete_owned_movie(movie_id: int, user_id: int):
+    # Ratings and comments are detached first (movie_id set to NULL) as the ORM delete did,
+    # only if the movie is the user's. The last statement returns the deleted id.
+    owned = select(Movie.id).where(Movie.id == movie_id, Movie.owner_id == user_id).scalar_subquery()
+    detach = [
+        update(model).where(model.movie_id == owned).values(movie_id=None)
+        .execution_options(synchronize_session=False)
+        for model in (Rating, Comment)
+    ]
+    return detach + [delete(Movie).where(Movie.id == movie_id, Movie.owner_id == user_id).returning(Movie.id)]
+
+def update_movie(db: Session, movie_id: int, user_id: int, movie_update: schemas.MovieUpdate):
+    # One statement, nothing is read first. None when the movie does not exist or
+    # belongs to someone else (see movie_exists)
+    row = db.execute(update_owned_movie(movie_id, user_id, movie_update)).first()
     db.commit()
-    db.refresh(movie)
-    return movie
-
-def delete_movie(db: Session, movie_id: int) -> bool:
-    try:
-        movie = db.query(models.Movie).filter(models.Movie.id == movie_id).first()
-        if not movie:
-            return False
-        db.delete(movie)
-        db.commit()
-        return True
-    except Exception as e:
-        db.rollback()
-        print(f"An error occured in the process of deleting movie{e}")
+    if row is None:
+        return None
+    title_index.add(row.id, row.title, row.rating_count)
+    content_index.add(row.id, row.description)
+    return dict(row._mapping)
+
+def delete_movie(db: Session, movie_id: int, user_id: int) -> bool:
+    # False when the movie does not exist or belongs to someone else
+    *detach, delete_statement = delete_owned_movie(movie_id, user_id)
+    for statement in detach:
+        db.execute(statement)
+    deleted = db.scalar(delete_statement)
+    db.commit()
+    if deleted is None:
         return False
+    title_index.remove(movie_id)
+    content_index.remove(movie_id)
+    return True
+
+
+def star_column(stars: int):
+    return getattr(Movie, f"stars_{stars}")
+
+
+def rating_aggregates_delta(movie_id: int, stars: int, old_stars: Optional[int]=None):
+    # Adjust in SQL so concurrent ratings of the same movie cannot lose updates. A new
+    # rating adds to the count, a changed one moves a count between histogram columns.
+    values = {
+        Movie.rating_sum: Movie.rating_sum + (stars - (old_stars or 0)),
+        star_column(stars): star_column(stars) + 1,
+        Movie.ratings_version: Movie.ratings_version + 1,
+    }
+    if old_stars is None:
+        values[Movie.rating_count] = Movie.rating_count + 1
+    else:
+        values[star_column(old_stars)] = star_column(old_stars) - 1
+    return update(Movie).where(Movie.id == movie_id).values(values).execution_options(synchronize_session=False)
+
+
+def insert_new_rating(dialect: str, rating: schemas.RatingCreate, user_id: int):
+    # Inserts only if the movie exists and the user has not rated it yet, the unique
+    # (user_id, movie_id) index decides under concurrency. Returns the new id, else nothing.
+    rating_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    source = select(
+        literal(rating.stars, Rating.stars.type), literal(rating.comment, Rating.comment.type),
+        Movie.id, literal(user_id, Rating.user_id.type),
+    ).where(Movie.id == rating.movie_id)
+    return (
+        rating_insert(Rating)
+        .from_select(["stars", "comment", "movie_id", "user_id"], source)
+        .on_conflict_do_nothing(index_elements=["user_id", "movie_id"])
+        .returning(Rating.id)
+    )
 
 
-def create_rating(db: Session, rating: schemas.RatingCreate, user_id: int):
-    db_rating = models.Rating(**rating.dict(), user_id=user_id)
-    db.add(db_rating)
+def existing_rating(movie_id: int, user_id: int):
+    # Row locked until commit, a concurrent re-rate waits and then sees these stars
+    return (
+        select(Rating.id, Rating.stars)
+        .where(Rating.movie_id == movie_id, Rating.user_id == user_id)
+        .with_for_update()
+    )
+
+
+def update_rating(rating_id: int, rating: schemas.RatingCreate):
+    return (
+        update(Rating)
+        .where(Rating.id == rating_id)
+        .values(stars=rating.stars, comment=rating.comment)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def rating_summary_query(movie_id: int):
+    return select(
+        Movie.id, Movie.rating_count, Movie.rating_sum, *(star_column(stars) for stars in STAR_VALUES)
+    ).where(Movie.id == movie_id)
+
+
+def rating_summary(row):
+    return {
+        "movie_id": row.id,
+        "rating_count": row.rating_count,
+        "rating_sum": row.rating_sum,
+        "average_rating": row.rating_sum / row.rating_count if row.rating_count else None,
+        "histogram": {stars: getattr(row, f"stars_{stars}") for stars in STAR_VALUES},
+    }
+
+
+def upsert_rating(db: Session, rating: schemas.RatingCreate, user_id: int):
+    # The user's rating of the movie, created or replaced, as a dict with "created".
+    # None when the movie does not exist. Aggregates change by the delta in the same transaction.
+    rating_id = db.scalar(insert_new_rating(db.bind.dialect.name, rating, user_id))
+    old_stars = None
+    if rating_id is None:
+        row = db.execute(existing_rating(rating.movie_id, user_id)).first()
+        if row is None:
+            db.rollback()
+            return None
+        rating_id, old_stars = row
+        db.execute(update_rating(rating_id, rating))
+    if old_stars != rating.stars:
+        db.execute(rating_aggregates_delta(rating.movie_id, rating.stars, old_stars))
+    db.commit()
+    if old_stars is None:
+        title_index.rated(rating.movie_id)
+    return {**rating.model_dump(), "id": rating_id, "user_id": user_id, "created": old_stars is None}
+
+
+def get_rating_summary(db: Session, movie_id: int):
+    row = db.execute(rating_summary_query(movie_id)).first()
+    return rating_summary(row) if row else None
+
+
+def rebuild_rating_aggregates(db: Session) -> int:
+    # Recompute every movie's aggregates from the ratings table in two set-based statements
+    totals = (
+        select(
+            Rating.movie_id,
+            func.count(Rating.id).label("rating_count"),
+            func.sum(Rating.stars).label("rating_sum"),
+            *(func.count(Rating.id).filter(Rating.stars == stars).label(f"stars_{stars}") for stars in STAR_VALUES),
+        )
+        .where(Rating.movie_id.is_not(None))
+        .group_by(Rating.movie_id)
+        .subquery()
+    )
+    columns = ["rating_count", "rating_sum"] + [f"stars_{stars}" for stars in STAR_VALUES]
+    db.execute(update(Movie).values({name: 0 for name in columns}).execution_options(synchronize_session=False))
+    result = db.execute(
+        update(Movie)
+        .where(Movie.id == totals.c.movie_id)
+        .values({name: totals.c[name] for name in columns})
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount
+
+def delete_duplicate_ratings(db: Session) -> int:
+    # Keep the latest rating of each user and movie, needed before the unique index
+    # can be created on a database from before it existed
+    latest = select(func.max(Rating.id)).where(Rating.movie_id.is_not(None)).group_by(Rating.user_id, Rating.movie_id)
+    result = db.execute(
+        delete(Rating)
+        .where(Rating.movie_id.is_not(None), Rating.id.not_in(latest))
+        .execution_options(synchronize_session=False)
+    )
     db.commit()
-    db.refresh(db_rating)
-    return db_rating
+    return result.rowcount
 
 def get_movie_ratings(db: Session, movie_id: int):
-    return db.query(Rating).filter(Rating.movie_id == movie_id).all()
+    return db.query(Rating).options(raiseload("*")).filter(Rating.movie_id == movie_id).all()
 
 def create_comment(db: Session, comment: schemas.CommentCreate, movie_id: int, user_id: int):
     if comment.parent_comment_id is not None:
-        parent_comment = db.query(models.Comment).filter(models.Comment.id == comment.parent_comment_id).first()
+        # The reply route has already loaded the parent, get() finds it in the identity map
+        parent_comment = db.get(models.Comment, comment.parent_comment_id)
         if not parent_comment:
             raise HTTPException(status_code=400, detail="Parent comment not found")
     
@@ -101,11 +305,60 @@ def create_comment(db: Session, comment: schemas.CommentCreate, movie_id: int, u
     )
     db.add(db_comment)
     db.commit()
-    db.refresh(db_comment)
+    # A new comment has no replies yet
+    set_committed_value(db_comment, "children", [])
     return db_comment
 
-def get_comments_for_movie(db: Session, movie_id: int):
-    return db.query(Comment).filter(Comment.movie_id == movie_id).all()
+def comment_thread_query(movie_id: int):
+    # Plain columns, not entities: the tree is built without touching Comment.children
+    return (
+        select(Comment.id, Comment.text, Comment.movie_id, Comment.parent_comment_id)
+        .where(Comment.movie_id == movie_id)
+        .order_by(Comment.id)
+    )
+
+
+def build_comment_tree(rows, max_depth: Optional[int]=None, limit: Optional[int]=None,
+                       replies_limit: Optional[int]=None):
+    # Link every row to its parent in one pass, then cut the tree to the requested
+    # shape walking it breadth first. Returns the root comments only.
+    nodes = {}
+    for row in rows:
+        nodes[row.id] = {
+            "id": row.id,
+            "text": row.text,
+            "movie_id": row.movie_id,
+            "parent_comment_id": row.parent_comment_id,
+            "children": [],
+        }
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node["parent_comment_id"])
+        if parent is None:
+            roots.append(node)
+        else:
+            parent["children"].append(node)
+
+    roots = roots[:limit]
+    level = roots
+    depth = 0
+    while level:
+        next_level = []
+        for node in level:
+            if max_depth is not None and depth >= max_depth:
+                node["children"] = []
+            else:
+                node["children"] = node["children"][:replies_limit]
+                next_level.extend(node["children"])
+        level = next_level
+        depth += 1
+    return roots
+
+
+def get_comments_for_movie(db: Session, movie_id: int, max_depth: Optional[int]=None,
+                           limit: Optional[int]=None, replies_limit: Optional[int]=None):
+    rows = db.execute(comment_thread_query(movie_id)).all()
+    return build_comment_tree(rows, max_depth, limit, replies_limit)
 
 def get_comment_by_id(db: Session, comment_id: int):
     return db.query(Comment).filter(Comment.id == comment_id).first()
@@ -1,4 +1,11 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import re
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
@@ -10,16 +17,125 @@ load_dotenv()
 # Database URL from environment variable
 SQLALCHEMY_DATABASE_URL = os.getenv("DB_URL")
 
+# Serve requests through AsyncSession (asyncpg) instead of the blocking psycopg2 Session
+USE_ASYNC_DB = os.getenv("USE_ASYNC_DB", "false").lower() in ("1", "true", "yes")
+
+# Statements slower than this (milliseconds) are written to the slow query log
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+
+slow_query_logger = logging.getLogger("slow_query")
+
 # SQLAlchemy database engine
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
 # SessionLocal class to create a session for each request
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Committed objects keep their values: serializing a freshly created row must not
+# reload it. INSERT fills the primary key and the Python side defaults cover the rest.
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 # Base class for SQLAlchemy models
 Base = declarative_base()
 
 
+def to_async_url(url: str) -> str:
+    # postgresql://... -> postgresql+asyncpg://..., sqlite:///... -> sqlite+aiosqlite:///...
+    scheme, sep, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect in ("postgres", "postgresql"):
+        return f"postgresql+asyncpg{sep}{rest}"
+    if dialect == "sqlite":
+        return f"sqlite+aiosqlite{sep}{rest}"
+    return url
+
+
+# Async database engine, only created when the async path is enabled
+ASYNC_SQLALCHEMY_DATABASE_URL = os.getenv("ASYNC_DB_URL") or to_async_url(SQLALCHEMY_DATABASE_URL)
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL) if USE_ASYNC_DB else None
+
+# AsyncSessionLocal keeps attributes loaded after commit, lazy loads are not possible on an AsyncSession
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
+
+class StatementCounter:
+    def __init__(self, label: str=None):
+        self.label = label
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.statements = []
+
+
+# Counter of the current request, set by count_statements()
+_statement_counter: ContextVar = ContextVar("statement_counter", default=None)
+
+
+@contextmanager
+def count_statements(label: str=None):
+    # Count and time every SQL statement executed (by any engine) inside the block
+    counter = StatementCounter(label)
+    token = _statement_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _statement_counter.reset(token)
+
+
+# Transaction control is not a query: COMMIT goes through the driver and is never seen here,
+# explicit BEGIN and savepoints (test fixtures, nested transactions) are not counted either
+_TRANSACTION_CONTROL = re.compile(r"^\s*(BEGIN|SAVEPOINT|RELEASE|ROLLBACK)\b", re.IGNORECASE)
+
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(\?|%s|\$\d+|%\(\w+\)s|:\w+)(\s*,\s*(\?|%s|\$\d+|%\(\w+\)s|:\w+))+\s*\)")
+
+
+def normalize_sql(statement: str) -> str:
+    # One line, and expanded IN lists collapsed so the same query always looks the same
+    statement = " ".join(statement.split())
+    return _PLACEHOLDER_LIST.sub("(...)", statement)
+
+
+def parameter_shape(parameters, executemany: bool=False):
+    # Types of the bound parameters, never their values
+    if executemany:
+        return f"{len(parameters)} x {parameter_shape(parameters[0]) if parameters else '()'}"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items()) + "}"
+    return "(" + ", ".join(type(v).__name__ for v in parameters or ()) + ")"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["statement_start"].pop()
+    counter = _statement_counter.get()
+    if counter is not None and not _TRANSACTION_CONTROL.match(statement):
+        counter.count += 1
+        counter.seconds += elapsed
+        counter.statements.append(statement)
+        if elapsed > counter.slowest:
+            counter.slowest = elapsed
+            counter.slowest_statement = statement
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_query_logger.warning(
+            "Slow query %.1f ms [%s]: %s params=%s",
+            elapsed * 1000, counter.label if counter is not None else "-",
+            normalize_sql(statement), parameter_shape(parameters, executemany),
+        )
+
+
+@event.listens_for(Engine, "handle_error")
+def _drop_statement(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get("statement_start"):
+        context.connection.info["statement_start"].pop()
+
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -27,3 +143,9 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# Async dependency
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,183 @@
+import csv
+import io
+import random
+import time
+from collections import defaultdict, deque
+from itertools import accumulate, islice
+
+from sqlalchemy import func, select, text
+
+import crud
+import models
+from database import SessionLocal
+from hashing import pwd_context
+
+# Synthetic data for scale testing. Ids are assigned here (after the current max id of
+# each table) so ratings and comments can reference users and movies without reading
+# them back. Movie popularity and user activity follow a power law, comment threads
+# are mostly replies to the latest comments of a movie, which makes them deep.
+
+WORDS = (
+    "silent river night city last summer dark star broken home lost king red road "
+    "winter dream empire ghost golden hour wild heart iron moon secret garden "
+    "falling sky little war storm blue paradise shadow love island hidden truth"
+).split()
+# Relative frequency of 0..5 stars, real ratings skew high
+STAR_WEIGHTS = (3, 4, 8, 20, 35, 30)
+# Chance that a comment starts a new thread instead of replying
+ROOT_COMMENT_RATE = 0.2
+# Replies go to one of the latest comments of the movie, smaller means deeper threads
+REPLY_WINDOW = 3
+
+
+def zipf_cum_weights(n: int, alpha: float):
+    return list(accumulate(1 / (rank ** alpha) for rank in range(1, n + 1)))
+
+
+def allocate(total: int, n: int, alpha: float, cap: int):
+    # Split total over n buckets proportionally to a power law, no bucket above cap
+    weights = [1 / (rank ** alpha) for rank in range(1, n + 1)]
+    scale = total / sum(weights)
+    counts = [min(cap, int(w * scale)) for w in weights]
+    remainder = total - sum(counts)
+    while remainder > 0:
+        open_buckets = [i for i in range(n) if counts[i] < cap][:remainder]
+        if not open_buckets:
+            break
+        for i in open_buckets:
+            counts[i] += 1
+        remainder -= len(open_buckets)
+    return counts
+
+
+def words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choices(WORDS, k=count))
+
+
+def batched(rows, size: int):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def next_id(db, table) -> int:
+    return (db.scalar(select(func.max(table.c.id))) or 0) + 1
+
+
+class Loader:
+    # Bulk insert through COPY on Postgres, executemany batches elsewhere
+
+    def __init__(self, db, batch: int):
+        self.db = db
+        self.batch = batch
+        self.copy = db.bind.dialect.name == "postgresql"
+
+    def load(self, table, columns, rows) -> int:
+        count = 0
+        for batch in batched(rows, self.batch):
+            if self.copy:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(batch)
+                buffer.seek(0)
+                cursor = self.db.connection().connection.cursor()
+                cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+            else:
+                self.db.execute(table.insert(), [dict(zip(columns, row)) for row in batch])
+            self.db.commit()
+            count += len(batch)
+        return count
+
+    def reset_sequence(self, table):
+        # Ids were given explicitly, move the serial past them
+        if self.copy:
+            self.db.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), (SELECT max(id) FROM {table.name}))"
+            ))
+            self.db.commit()
+
+
+def generate(users: int, movies: int, ratings: int, comments: int, seed: int=0, batch: int=10000,
+             password: str="password", alpha: float=1.1, report=print, db=None):
+    # Loads into db when given (left open), else into a new SessionLocal()
+    rng = random.Random(seed)
+    own_session = db is None
+    if own_session:
+        db = SessionLocal()
+    loader = Loader(db, batch)
+    results = []
+    user_table, movie_table = models.User.__table__, models.Movie.__table__
+    rating_table, comment_table = models.Rating.__table__, models.Comment.__table__
+
+    def timed(name, table, columns, rows):
+        start = time.perf_counter()
+        count = loader.load(table, columns, rows)
+        loader.reset_sequence(table)
+        seconds = time.perf_counter() - start
+        results.append((name, count, seconds))
+        report(f"{name:<10} {count:>12,} rows {seconds:>9.1f} s {count / seconds if seconds else 0:>12,.0f} rows/s")
+
+    try:
+        # One bcrypt hash shared by every generated user, so they can all log in with --password
+        hashed_password = pwd_context.hash(password)
+        first_user = next_id(db, user_table)
+        user_ids = range(first_user, first_user + users)
+        timed("users", user_table, ("id", "username", "full_name", "email", "hashed_password"), (
+            (n, f"user{n:08d}", f"User {n}", f"user{n:08d}@example.com", hashed_password) for n in user_ids
+        ))
+
+        first_movie = next_id(db, movie_table)
+        movie_ids = range(first_movie, first_movie + movies)
+        timed("movies", movie_table, ("id", "title", "description", "owner_id"), (
+            (n, f"{words(rng, rng.randint(1, 4)).title()} {n}", words(rng, rng.randint(10, 40)),
+             rng.choice(user_ids) if users else None)
+            for n in movie_ids
+        ))
+
+        # Popular movies are the low ranks of a shuffled order, so popularity is not by id
+        popular = list(movie_ids)
+        rng.shuffle(popular)
+        movie_weights = zipf_cum_weights(len(popular), alpha)
+
+        def rating_rows():
+            rating_id = next_id(db, rating_table)
+            # Active users rate many movies, most users rate a few, nobody rates a movie twice
+            for user_id, count in zip(user_ids, allocate(ratings, users, alpha, movies)):
+                if count * 2 > movies:
+                    picked = rng.sample(popular, count)
+                else:
+                    seen = set()
+                    while len(seen) < count:
+                        seen.update(rng.choices(popular, cum_weights=movie_weights, k=count - len(seen)))
+                    picked = seen
+                for movie_id in picked:
+                    stars = rng.choices(range(6), STAR_WEIGHTS)[0]
+                    yield rating_id, stars, None, movie_id, user_id
+                    rating_id += 1
+
+        if users and movies:
+            timed("ratings", rating_table, ("id", "stars", "comment", "movie_id", "user_id"), rating_rows())
+
+        def comment_rows():
+            comment_id = next_id(db, comment_table)
+            latest = defaultdict(lambda: deque(maxlen=REPLY_WINDOW))
+            for start in range(0, comments, batch):
+                for movie_id in rng.choices(popular, cum_weights=movie_weights, k=min(batch, comments - start)):
+                    recent = latest[movie_id]
+                    parent = rng.choice(recent) if recent and rng.random() > ROOT_COMMENT_RATE else None
+                    yield comment_id, words(rng, rng.randint(3, 30)), movie_id, rng.choice(user_ids), parent
+                    recent.append(comment_id)
+                    comment_id += 1
+
+        if users and movies:
+            timed("comments", comment_table, ("id", "text", "movie_id", "user_id", "parent_comment_id"), comment_rows())
+
+        start = time.perf_counter()
+        crud.rebuild_rating_aggregates(db)
+        report(f"{'aggregates':<10} {'':>17} {time.perf_counter() - start:>9.1f} s")
+    finally:
+        if own_session:
+            db.close()
+    return results
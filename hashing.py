@@ -0,0 +1,149 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+# Keep this module free of app imports, it is re-imported by every worker process
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Worker processes dedicated to bcrypt, HASH_WORKERS=0 hashes inline on the calling thread
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1))
+# Hashes allowed to wait for a worker before new ones are shed with a 503
+HASH_QUEUE_SIZE = int(os.environ.get("HASH_QUEUE_SIZE", max(HASH_WORKERS, 1) * 4))
+
+
+def _hash(password: str):
+    start = time.perf_counter()
+    return pwd_context.hash(password), time.perf_counter() - start
+
+
+def _verify(password: str, hashed_password: str):
+    start = time.perf_counter()
+    return pwd_context.verify(password, hashed_password), time.perf_counter() - start
+
+
+class HashingService:
+    # Runs bcrypt on a process pool so a login storm cannot pin the request threads.
+    # At most workers + queue_size hashes are admitted, the rest fail fast with a 503.
+
+    def __init__(self, workers: int=HASH_WORKERS, queue_size: int=HASH_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + queue_size)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+        self.completed = 0
+        self.hash_seconds_total = 0.0
+        self.hash_seconds_max = 0.0
+
+    @property
+    def queue_depth(self):
+        return max(0, self.in_flight - max(self.workers, 1))
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _admit(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server busy, try again later",
+                headers={"Retry-After": "1"},
+            )
+        with self._lock:
+            self.in_flight += 1
+
+    def _done(self, seconds=None):
+        with self._lock:
+            self.in_flight -= 1
+            if seconds is not None:
+                self.completed += 1
+                self.hash_seconds_total += seconds
+                self.hash_seconds_max = max(self.hash_seconds_max, seconds)
+        self._slots.release()
+
+    def _run(self, fn, *args):
+        # Inline mode: hash on the calling thread, still admitted and measured
+        self._admit()
+        try:
+            value, seconds = fn(*args)
+        except BaseException:
+            self._done()
+            raise
+        self._done(seconds)
+        return value
+
+    def _submit(self, fn, *args):
+        self._admit()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._done()
+            raise
+
+        def record(done):
+            # Futures cancelled by shutdown() hold no result, their slot is released all the same
+            seconds = None
+            try:
+                if not done.cancelled() and done.exception() is None:
+                    seconds = done.result()[1]
+            finally:
+                self._done(seconds)
+
+        future.add_done_callback(record)
+        return future
+
+    def hash(self, password: str) -> str:
+        if self.workers <= 0:
+            return self._run(_hash, password)
+        return self._submit(_hash, password).result()[0]
+
+    def verify(self, password: str, hashed_password: str) -> bool:
+        if self.workers <= 0:
+            return self._run(_verify, password, hashed_password)
+        return self._submit(_verify, password, hashed_password).result()[0]
+
+    async def hash_async(self, password: str) -> str:
+        if self.workers <= 0:
+            return await asyncio.to_thread(self.hash, password)
+        return (await asyncio.wrap_future(self._submit(_hash, password)))[0]
+
+    async def verify_async(self, password: str, hashed_password: str) -> bool:
+        if self.workers <= 0:
+            return await asyncio.to_thread(self.verify, password, hashed_password)
+        return (await asyncio.wrap_future(self._submit(_verify, password, hashed_password)))[0]
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "hash_seconds_total": self.hash_seconds_total,
+            "hash_seconds_max": self.hash_seconds_max,
+        }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+hashing_service = HashingService()
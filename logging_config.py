@@ -1,13 +1,137 @@
+import atexit
+import copy
+import itertools
+import json
 import logging
-from logging.handlers import RotatingFileHandler
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        RotatingFileHandler("app.log", maxBytes=1000000, backupCount=3),
-        logging.StreamHandler()
-    ]
+import os
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Log records are put on a queue by the request threads and written by a background
+# listener thread, so file I/O, formatting and rotation never run on a request.
+
+LOG_FILE = os.environ.get("LOG_FILE", "app.log")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Statements slower than SLOW_QUERY_MS (see database.py) also go to this file, "" turns it off
+SLOW_QUERY_LOG_FILE = os.environ.get("SLOW_QUERY_LOG_FILE", "slow_query.log")
+# Per-logger levels, e.g. "sqlalchemy.engine=INFO,logging_config=WARNING"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# "json" for one JSON object per line, "text" for the classic format
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# What a request thread does when the queue is full: "drop" the record or "block" until there is room
+LOG_QUEUE_FULL = os.environ.get("LOG_QUEUE_FULL", "drop")
+# Keep 1 in N of high-volume INFO lines, keyed by their message template: "template=N;template=N"
+LOG_SAMPLE = os.environ.get(
+    "LOG_SAMPLE",
+    "Movie retrieved successfully=100;Movies retrieved: %d=100;"
+    "Retrieved %d ratings for movie_id=%d=100;Retrieved %d root comments for movie_id=%d=100",
 )
 
-logger = logging.getLogger(__name__)
\ No newline at end of file
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+EXCEPTION_FORMATTER = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Lets through 1 in N records of each sampled INFO template, never filters warnings or errors
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._counters = {template: itertools.count() for template in rates}
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(record.msg)
+        if rate is None:
+            return True
+        return next(self._counters[record.msg]) % rate == 0
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue, block: bool=False):
+        super().__init__(log_queue)
+        self.block = block
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Like QueueHandler.prepare, the args are merged into the message on the calling
+        # thread, the listener would otherwise format them later, possibly changed since.
+        # The traceback is kept as text, the line itself is formatted by the listener.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = record.exc_text or EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.block:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_sample_rates(value: str):
+    rates = {}
+    for item in filter(None, value.split(";")):
+        template, _, rate = item.rpartition("=")
+        if template and int(rate) > 1:
+            rates[template] = int(rate)
+    return rates
+
+
+def make_handlers(log_file: str=LOG_FILE, log_format: str=LOG_FORMAT, slow_query_log_file: str=SLOW_QUERY_LOG_FILE):
+    formatter = JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [RotatingFileHandler(log_file, maxBytes=1000000, backupCount=3), logging.StreamHandler()]
+    if slow_query_log_file:
+        slow_queries = RotatingFileHandler(slow_query_log_file, maxBytes=1000000, backupCount=3)
+        slow_queries.addFilter(logging.Filter("slow_query"))
+        handlers.append(slow_queries)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def setup_logging():
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for item in filter(None, LOG_LEVELS.split(",")):
+        name, _, level = item.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip())
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue, block=LOG_QUEUE_FULL == "block")
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE)))
+    root.handlers = [queue_handler]
+
+    listener = QueueListener(log_queue, *make_handlers(), respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler, listener
+
+
+queue_handler, listener = setup_logging()
+
+logger = logging.getLogger(__name__)
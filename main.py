@@ -1,34 +1,95 @@
-import crud, schemas, auth
-from typing import Optional, List
-from fastapi import Depends, FastAPI, HTTPException
+import crud, schemas, auth, metrics
+import time
+from typing import Optional, List, Literal
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordRequestForm
-from auth import pwd_context, authenticate_user, create_access_token, get_current_user
-from database import Base, engine, get_db
+from auth import authenticate_user, create_access_token, get_current_user, token_claims
+from database import SessionLocal, get_db, count_statements, USE_ASYNC_DB
+from hashing import hashing_service
 from logging_config import logger
-from fastapi.responses import JSONResponse
+from response_cache import response_cache
+from singleflight import movie_flights
+from pagination import MAX_COMMENT_DEPTH, MAX_PAGE_SIZE, decode_cursor, movies_page
+from search import SEARCH_SORT, search_page
+from autocomplete import AUTOCOMPLETE_MAX_LIMIT, AUTOCOMPLETE_WARMUP, title_index
+from similarity import SIMILAR_TOP_K
+from recommendations import RECOMMEND_TOP_N, recommendation_store
+from content_index import CONTENT_TOP_K, content_index
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from fastapi.exceptions import RequestValidationError
 from starlette.requests import Request
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-Base.metadata.create_all(bind=engine)
-
+# Tables and indexes are created by the migrations: alembic upgrade head
 app = FastAPI()
 
+# Sync routes, served on the threadpool with a blocking Session
+router = APIRouter()
+
+
+@app.on_event("startup")
+def build_title_index():
+    # Otherwise the first autocomplete lookup builds it
+    if not AUTOCOMPLETE_WARMUP:
+        return
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        title_index.build_once(lambda: crud.movie_titles(db))
+        logger.info("Title index built: %d titles in %.1f s", title_index.stats()["titles"], time.perf_counter() - start)
+    except SQLAlchemyError:
+        logger.exception("Title index not built at startup, the first autocomplete lookup will build it")
+    finally:
+        db.close()
+
+
+@app.on_event("shutdown")
+def shutdown_hashing_service():
+    hashing_service.shutdown()
+
+
+# Serve public GETs from the response cache, write routes invalidate it by tag
+@app.middleware("http")
+async def response_cache_middleware(request: Request, call_next):
+    return await response_cache.serve(request, call_next)
+
+
+# Count and time the SQL statements issued while serving each request, so N+1 regressions
+# and slow queries are visible from the response headers (Server-Timing shows up in devtools)
+@app.middleware("http")
+async def sql_statement_counter(request: Request, call_next):
+    start = time.perf_counter()
+    with count_statements(f"{request.method} {request.url.path}") as counter:
+        response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    response.headers["X-SQL-Statements"] = str(counter.count)
+    response.headers["Server-Timing"] = (
+        f'db;dur={counter.seconds * 1000:.1f};desc="{counter.count} statements", '
+        f"db-slowest;dur={counter.slowest * 1000:.1f}, app;dur={elapsed * 1000:.1f}"
+    )
+    return response
+
+
+# Outermost, so the recorded latency includes the cache and every other middleware
+app.add_middleware(metrics.MetricsMiddleware)
+
 
 # Custom Exception Handler for HTTP Exceptions
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request: Request, exc: StarletteHTTPException):
-    logger.error(f"HTTP Exception occurred: {exc.detail} - Status Code: {exc.status_code}")
+    logger.error("HTTP Exception occurred: %s - Status Code: %d", exc.detail, exc.status_code)
     return JSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail},
+        headers=getattr(exc, "headers", None),
     )
 
 # Custom Exception Handler for Request Validation Errors
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    logger.error(f"Validation Error: {exc.errors()} - Body: {await request.json()}")
+    logger.error("Validation Error: %s - Body: %s", exc.errors(), exc.body)
     return JSONResponse(
         status_code=422,
         content={"detail": exc.errors()},
@@ -37,7 +98,7 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 # Custom Exception Handler for Generic Errors
 @app.exception_handler(Exception)
 async def generic_exception_handler(request: Request, exc: Exception):
-    logger.error(f"Unexpected error occurred: {str(exc)}")
+    logger.error("Unexpected error occurred: %s", exc)
     return JSONResponse(
         status_code=500,
         content={"detail": "An unexpected error occurred. Please try again later."},
@@ -47,21 +108,25 @@ async def generic_exception_handler(request: Request, exc: Exception):
 def read_root():
     return {"message": "Welcome to my FastAPI app!"}
 
+# Prometheus scrape endpoint
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # CREATE USERS ENDPOINT
-@app.post("/signup", response_model=schemas.User)
+@router.post("/signup", response_model=schemas.User)
 def signup(user: schemas.UserCreate, db: Session=Depends(get_db)):
     db_user = crud.get_user_by_username(db, user.username)
-    hashed_password = pwd_context.hash(user.password)
     if db_user:
         logger.warning("Attempted signup with existing username: %s", user.username)
         raise HTTPException(status_code=400, detail="Username already registered")
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = hashing_service.hash(user.password)
     new_user = crud.create_user(db=db, user=user, hashed_password=hashed_password)
     logger.info("User signed up successfully: %s", user.username)
     return new_user
 
 # USERS LOGIN ENDPOINT
-@app.post("/login")
+@router.post("/login")
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = authenticate_user(db, form_data.username, form_data.password)
     if not user:
@@ -71,7 +136,7 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
             detail="Incorrect username or password",
             headers= {"WWW-Authenticate": "Bearer"}
         )
-    access_token = create_access_token(data={"sub": user.username})
+    access_token = create_access_token(data=token_claims(user))
     logger.info("User logged in successfully: %s", user.username)
     return {
         "access_token": access_token,
@@ -80,7 +145,7 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
 
 
 # USERS LIST  MOVIE ENDPOINT {AUTHENTICATED ACCESS}
-@app.post("/movies")
+@router.post("/movies")
 def create_movie(movie: schemas.MovieCreate, user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
     try:
         new_movie = crud.create_movie(
@@ -88,6 +153,7 @@ def create_movie(movie: schemas.MovieCreate, user: schemas.User = Depends(get_cu
             movie=movie,
             user_id=user.id
         )
+        response_cache.invalidate("movies")
         logger.info("Movie listed successfully: %s by user %s", movie.title, user.username)
         return new_movie
     except Exception as e:
@@ -96,93 +162,172 @@ def create_movie(movie: schemas.MovieCreate, user: schemas.User = Depends(get_cu
 
 
 # VIEW ALL MOVIES {public access}
-@app.get("/movies/")
-def get_movies(db: Session = Depends(get_db), skip: int = 0, limit: int = 10):
-    movies = crud.get_movies(
-        db
-    )
-    logger.info("Movies retrieved: %d", len(movies))
-    return movies
+@router.get("/movies/", response_model=schemas.MoviePage)
+def get_movies(
+    db: Session = Depends(get_db),
+    after: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    sort: Literal["id", "title"] = "id"
+):
+    cursor = decode_cursor(after, sort) if after else None
+    movies = crud.get_movies(db, limit=limit, after=cursor, sort=sort)
+    page = movies_page(movies, limit, sort)
+    logger.info("Movies retrieved: %d", len(page["items"]))
+    return page
+
+# SEARCH MOVIES by title and description {public access}
+@router.get("/movies/search", response_model=schemas.MoviePage)
+def search_movies(
+    q: str = Query(..., min_length=1, max_length=200),
+    db: Session = Depends(get_db),
+    after: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE)
+):
+    cursor = decode_cursor(after, SEARCH_SORT) if after else None
+    rows = crud.search_movies(db, q, limit=limit, after=cursor)
+    page = search_page(rows, limit)
+    logger.info("Movie search returned %d movies", len(page["items"]))
+    return page
+
+# AUTOCOMPLETE movie titles, most rated first {public access}
+@router.get("/movies/autocomplete", response_model=List[schemas.MovieSuggestion])
+def autocomplete_movies(
+    prefix: str = Query(..., min_length=1, max_length=100),
+    db: Session = Depends(get_db),
+    limit: int = Query(10, ge=1, le=AUTOCOMPLETE_MAX_LIMIT)
+):
+    if not title_index.loaded:
+        title_index.build_once(lambda: crud.movie_titles(db))
+    return title_index.suggest(prefix, limit)
+
+# SIMILAR MOVIES, from the ratings {public access}
+@router.get("/movies/{movie_id}/similar", response_model=List[schemas.SimilarMovie])
+def similar_movies(
+    movie_id: int,
+    db: Session = Depends(get_db),
+    limit: int = Query(10, ge=1, le=SIMILAR_TOP_K)
+):
+    # Empty until the similar-movies job has run for this movie
+    return crud.get_similar_movies(db, movie_id, limit=limit)
+
+# SIMILAR MOVIES by description {public access}
+@router.get("/movies/{movie_id}/similar-content", response_model=List[schemas.SimilarMovie])
+def similar_content(
+    movie_id: int,
+    db: Session = Depends(get_db),
+    limit: int = Query(10, ge=1, le=CONTENT_TOP_K)
+):
+    # Empty for movies without a description in the index
+    picks = content_index.similar(movie_id, limit)
+    if not picks:
+        return []
+    return crud.movies_in_order(crud.get_movie_summaries(db, [other for other, _ in picks]), picks)
+
+# RECOMMENDED MOVIES for the current user, from the last trained model
+@router.get("/me/recommendations", response_model=List[schemas.RecommendedMovie])
+def recommend_movies(
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user),
+    limit: int = Query(10, ge=1, le=RECOMMEND_TOP_N)
+):
+    # Movies rated since the model was trained are left out too
+    rated = set(crud.rated_movie_ids(db, current_user.id))
+    picks = recommendation_store.recommend(current_user.id, rated, limit)
+    if not picks:
+        return []
+    return crud.movies_in_order(crud.get_movie_summaries(db, [movie_id for movie_id, _ in picks]), picks)
 
 # GET A MOVIE {public access}
-@app.get("/movie/{movie_id}", response_model=schemas.Movie)
+@router.get("/movie/{movie_id}", response_model=schemas.Movie)
 def get_movie(movie_id: int, db: Session = Depends(get_db)):
-    movie = crud.get_movie(db, movie_id)
-    if not movie:
+    # Concurrent lookups of the same movie share one fetch and serialization
+    body = movie_flights.do(movie_id, lambda: crud.get_movie_json(db, movie_id))
+    if body is None:
         logger.warning("Attempted getting movie that does not exist")
         raise HTTPException(status_code=404, detail="Movie not found")
     logger.info("Movie retrieved successfully")
-    return movie
+    return Response(body, media_type="application/json")
 
 # Edit a movie (only by the user who listed it)
-@app.put("/movies/{movie_id}", response_model=schemas.Movie)
+@router.put("/movies/{movie_id}", response_model=schemas.Movie)
 def update_movie(
     movie_id: int,
     movie_update: schemas.MovieUpdate,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    movie = crud.get_movie_by_id(db, movie_id)
-    if not movie:
-        logger.warning("Movie not found for update: %d", movie_id)
-        raise HTTPException(status_code=404, detail="Movie not found")
-    if movie.owner_id != current_user.id:
+    movie = crud.update_movie(db=db, movie_id=movie_id, user_id=current_user.id, movie_update=movie_update)
+    if movie is None:
+        if not crud.movie_exists(db, movie_id):
+            logger.warning("Movie not found for update: %d", movie_id)
+            raise HTTPException(status_code=404, detail="Movie not found")
         logger.warning("Unauthorized update attempt by user %s for movie %d", current_user.username, movie_id)
         raise HTTPException(status_code=403, detail="Not authorized to update this movie")
-    updated_movie = crud.update_movie(db=db, movie_id=movie_id, movie_update=movie_update)
+    response_cache.invalidate("movies", f"movie:{movie_id}")
     logger.info("Movie updated successfully: %d by user %s", movie_id, current_user.username)
-    return updated_movie
+    # The updated row has no owner loaded, the owner is the current user
+    return schemas.Movie.model_validate({**movie, "owner": current_user})
 
 
 # Delete a movie (only by the user who listed it)
-@app.delete("/movies/{movie_id}")
+@router.delete("/movies/{movie_id}")
 def delete_movie(
     movie_id: int,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    movie = crud.get_movie_by_id(db, movie_id)
-    if not movie:
-        logger.warning("Movie not found for deletion: %d", movie_id)
-        raise HTTPException(status_code=404, detail="Movie not found")
-    if movie.owner_id != current_user.id:
+    if not crud.delete_movie(db=db, movie_id=movie_id, user_id=current_user.id):
+        if not crud.movie_exists(db, movie_id):
+            logger.warning("Movie not found for deletion: %d", movie_id)
+            raise HTTPException(status_code=404, detail="Movie not found")
         logger.warning("Unauthorized delete attempt by user %s for movie %d", current_user.username, movie_id)
         raise HTTPException(status_code=403, detail="Not authorized to delete movie")
-    
-    if not crud.delete_movie(db=db, movie_id=movie_id):
-        raise HTTPException(status_code=500, detail="failed to delete movie")
+    response_cache.invalidate("movies", f"movie:{movie_id}", f"ratings:{movie_id}", f"comments:{movie_id}")
     logger.info("Movie deleted successfully: %d by user %s", movie_id, current_user.username)
     return {"Movie Deleted Successfully"}
 
 
 # Rate a movie (authenticated access)
 
-@app.post("/movies/{movie_id}/rate", response_model=schemas.Rating)
+@router.post("/movies/{movie_id}/rate", response_model=schemas.RatingResult)
 def rate_movie(
     movie_id: int,
     rating: schemas.RatingCreate,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    db_movie = crud.get_movie(db, movie_id)
-    if not db_movie:
+    # The movie in the URL is authoritative, the body's movie_id is ignored
+    rating = rating.model_copy(update={"movie_id": movie_id})
+    # Rating again replaces the user's earlier rating, checked in one INSERT ... ON CONFLICT
+    db_rating = crud.upsert_rating(db=db, rating=rating, user_id=current_user.id)
+    if db_rating is None:
         logger.warning("Movie not found when attempting to rate: movie_id=%d", movie_id)
         raise HTTPException(status_code=404, detail="Movie not found")
-    
-    # No need to compare rating.movie_id with movie_id if we are passing movie_id directly in the URL
-    db_rating = crud.create_rating(db=db, rating=rating, user_id=current_user.id)
-    logger.info("Movie rated successfully: movie_id=%d, user_id=%d, stars=%d", movie_id, current_user.id, rating.stars)
+    # Only this movie's entries: the list and search pages show its aggregates too, but
+    # clearing them on every rating would leave nothing cached, they expire by TTL
+    response_cache.invalidate(f"movie:{movie_id}", f"ratings:{movie_id}")
+    logger.info("Movie rated successfully: movie_id=%d, user_id=%d, stars=%d, created=%s",
+                movie_id, current_user.id, rating.stars, db_rating["created"])
     return db_rating
 
 # Get ratings for a movie
-@app.get("/movies/{movie_id}/ratings/", response_model=List[schemas.Rating])
+@router.get("/movies/{movie_id}/ratings/", response_model=List[schemas.Rating])
 def get_movie_ratings(movie_id: int, db: Session = Depends(get_db)):
     ratings = crud.get_movie_ratings(db=db, movie_id=movie_id)
     logger.info("Retrieved %d ratings for movie_id=%d", len(ratings), movie_id)
     return ratings
 
+# Get the rating aggregates of a movie, read from the movie row (no scan of ratings)
+@router.get("/movies/{movie_id}/rating-summary", response_model=schemas.RatingSummary)
+def get_rating_summary(movie_id: int, db: Session = Depends(get_db)):
+    summary = crud.get_rating_summary(db=db, movie_id=movie_id)
+    if not summary:
+        logger.warning("Attempted getting rating summary of movie that does not exist: movie_id=%d", movie_id)
+        raise HTTPException(status_code=404, detail="Movie not found")
+    return summary
+
 # Add a comment to a movie (authenticated access)
-@app.post("/movies/{movie_id}/comments", response_model=schemas.Comment)
+@router.post("/movies/{movie_id}/comments", response_model=schemas.Comment)
 def add_comment(
     movie_id: int,
     comment: schemas.CommentCreate,
@@ -194,18 +339,27 @@ def add_comment(
         logger.warning("Attempted to add comment to non-existent movie: movie_id=%d", movie_id)
         raise HTTPException(status_code=404, detail="Movie not found")
     db_comment = crud.create_comment(db=db, comment=comment, movie_id=movie_id, user_id=current_user.id)
+    response_cache.invalidate(f"comments:{movie_id}")
     logger.info("Comment added to movie: movie_id=%d, user_id=%d, comment_id=%d", movie_id, current_user.id, db_comment.id)
     return db_comment
 
-# View comments for a movie (public access)
-@app.get("/movies/{movie_id}/comments", response_model=List[schemas.Comment])
-def view_comments(movie_id: int, db: Session = Depends(get_db)):
-    comments = crud.get_comments_for_movie(db=db, movie_id=movie_id)
-    logger.info("Retrieved %d comments for movie_id=%d", len(comments), movie_id)
+# View comments for a movie (public access), as a tree of root comments
+@router.get("/movies/{movie_id}/comments", response_model=List[schemas.Comment])
+def view_comments(
+    movie_id: int,
+    db: Session = Depends(get_db),
+    max_depth: int = Query(MAX_COMMENT_DEPTH, ge=0, le=MAX_COMMENT_DEPTH),
+    limit: Optional[int] = Query(None, ge=1),
+    replies_limit: Optional[int] = Query(None, ge=1)
+):
+    comments = crud.get_comments_for_movie(
+        db=db, movie_id=movie_id, max_depth=max_depth, limit=limit, replies_limit=replies_limit
+    )
+    logger.info("Retrieved %d root comments for movie_id=%d", len(comments), movie_id)
     return comments
 
 # Add comment to a comment i.e nested comments (authenticated access)
-@app.post("/comments/{comment_id}/reply", response_model=schemas.Comment)
+@router.post("/comments/{comment_id}/reply", response_model=schemas.Comment)
 def reply_to_comment(
     comment_id: int,
     comment: schemas.CommentCreate,
@@ -217,6 +371,17 @@ def reply_to_comment(
         logger.warning("Attempted to reply to non-existent comment: comment_id=%d", comment_id)
         raise HTTPException(status_code=404, detail="parent comment not found")
     
+    # The comment in the URL is the parent, whatever the body says
+    comment = comment.model_copy(update={"parent_comment_id": comment_id})
     db_comment = crud.create_comment(db=db, comment=comment, movie_id=parent_comment.movie_id, user_id=current_user.id)
+    response_cache.invalidate(f"comments:{db_comment.movie_id}")
     logger.info("Reply added to comment: parent_comment_id=%d, user_id=%d, reply_comment_id=%d", comment_id, current_user.id, db_comment.id)
     return db_comment
+
+
+# Serve the async (AsyncSession) variants of the routes when USE_ASYNC_DB is set
+if USE_ASYNC_DB:
+    import async_routes
+    app.include_router(async_routes.router)
+else:
+    app.include_router(router)
@@ -0,0 +1,175 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from starlette.routing import Match
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RouteMetrics:
+    __slots__ = ("count", "seconds", "buckets", "statuses")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.statuses = defaultdict(int)
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware recording per-route counts, latency, in-flight requests and
+    # status codes. It only runs on the event loop thread, so the counters need no lock.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        global in_flight
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            in_flight -= 1
+            key = (scope["method"], route_path(scope))
+            metrics = routes.get(key)
+            if metrics is None:
+                metrics = routes[key] = RouteMetrics()
+            metrics.count += 1
+            metrics.seconds += elapsed
+            metrics.buckets[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            metrics.statuses[status] += 1
+
+
+def route_path(scope) -> str:
+    # Label by route template, never by raw path, so the number of series stays bounded.
+    # Responses served by the cache middleware never reach the router, match them here.
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    for route in getattr(scope.get("app"), "routes", ()):
+        if route.matches(scope)[0] == Match.FULL:
+            return route.path
+    return "<unmatched>"
+
+
+# (method, route path) -> RouteMetrics
+routes = {}
+in_flight = 0
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+def _pool_gauges(prefix: str, pool):
+    # QueuePool has all four, other pool classes (SQLite in-memory, NullPool) may not,
+    # SingletonThreadPool even has a plain "size" attribute
+    gauges = {}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            gauges[f"{prefix}_{name}"] = method()
+    return gauges
+
+
+def collect():
+    # Gauges and counters owned by other modules: DB pools, bcrypt pool, caches, logging
+    from auth import principal_cache
+    from autocomplete import title_index
+    from content_index import content_index
+    from database import async_engine, engine
+    from hashing import hashing_service
+    from logging_config import queue_handler
+    from response_cache import response_cache
+    from singleflight import movie_flights
+
+    hashing = hashing_service.stats()
+    principals = principal_cache.stats()
+    responses = response_cache.stats()
+    titles = title_index.stats()
+    contents = content_index.stats()
+    gauges = {
+        **_pool_gauges("db_pool", engine.pool),
+        **(_pool_gauges("db_async_pool", async_engine.pool) if async_engine is not None else {}),
+        "password_hash_in_flight": hashing["in_flight"],
+        "password_hash_queue_depth": hashing["queue_depth"],
+        "password_hash_duration_seconds_max": hashing["hash_seconds_max"],
+        "principal_cache_entries": principals["size"],
+        "response_cache_entries": responses["entries"],
+        "response_cache_bytes": responses["bytes"],
+        "movie_lookups_in_flight": movie_flights.stats()["in_flight"],
+        "autocomplete_titles": titles["titles"],
+        "autocomplete_cached_prefixes": titles["cached_prefixes"],
+        "content_index_movies": contents["movies"],
+        "content_index_delta_movies": contents["delta_movies"],
+    }
+    counters = {
+        "password_hash_rejected_total": hashing["rejected"],
+        "principal_cache_hits_total": principals["hits"],
+        "principal_cache_misses_total": principals["misses"],
+        "principal_cache_evictions_total": principals["evictions"],
+        "response_cache_hits_total": responses["hits"],
+        "response_cache_misses_total": responses["misses"],
+        "response_cache_evictions_total": responses["evictions"],
+        "response_cache_invalidations_total": responses["invalidations"],
+        "movie_lookups_collapsed_total": movie_flights.collapsed,
+        "log_records_dropped_total": queue_handler.dropped,
+    }
+    summaries = {
+        "password_hash_duration_seconds": (hashing["hash_seconds_total"], hashing["completed"]),
+    }
+    return gauges, counters, summaries
+
+
+def render() -> str:
+    # Prometheus text exposition format (version 0.0.4), one block per metric family
+    items = sorted(routes.items())
+    lines = ["# TYPE http_requests_total counter"]
+    for (method, path), metrics in items:
+        lines.append(f"http_requests_total{_labels(method=method, route=path)} {metrics.count}")
+
+    lines.append("# TYPE http_responses_total counter")
+    for (method, path), metrics in items:
+        for status, count in sorted(metrics.statuses.items()):
+            lines.append(f"http_responses_total{_labels(method=method, route=path, status=status)} {count}")
+
+    lines.append("# TYPE http_request_duration_seconds histogram")
+    for (method, path), metrics in items:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), metrics.buckets):
+            cumulative += count
+            lines.append(f"http_request_duration_seconds_bucket{_labels(method=method, route=path, le=bound)} {cumulative}")
+        lines.append(f"http_request_duration_seconds_sum{_labels(method=method, route=path)} {metrics.seconds}")
+        lines.append(f"http_request_duration_seconds_count{_labels(method=method, route=path)} {metrics.count}")
+
+    lines.append("# TYPE http_requests_in_flight gauge")
+    lines.append(f"http_requests_in_flight {in_flight}")
+
+    gauges, counters, summaries = collect()
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    for name, value in counters.items():
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+    for name, (total, count) in summaries.items():
+        lines.append(f"# TYPE {name} summary")
+        lines.append(f"{name}_sum {total}")
+        lines.append(f"{name}_count {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,47 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+import models
+from database import Base, SQLALCHEMY_DATABASE_URL, engine
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+
+def configure(dialect_name: str, **kwargs):
+    # SQLite cannot ALTER most things, batch mode rebuilds the table instead
+    # The full-text search objects are raw DDL, not in the metadata
+    context.configure(
+        target_metadata=Base.metadata, render_as_batch=dialect_name == "sqlite",
+        include_name=models.include_in_autogenerate, **kwargs
+    )
+
+
+def run_migrations_offline():
+    # alembic upgrade head --sql: print the SQL for DB_URL instead of running it
+    configure(engine.dialect.name, url=SQLALCHEMY_DATABASE_URL, literal_binds=True, dialect_opts={"paramstyle": "named"})
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    # Callers such as the tests can pass their own connection in config.attributes
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        configure(connection.dialect.name, connection=connection)
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+    with engine.connect() as connection:
+        configure(connection.dialect.name, connection=connection)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
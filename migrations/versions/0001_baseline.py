@@ -0,0 +1,81 @@
+"""Baseline: the four tables of the original app, as Base.metadata.create_all built them
+
+Revision ID: 0001_baseline
+Revises:
+Create Date: 2026-10-18
+
+A database created by that create_all is already at this revision:
+alembic stamp 0001_baseline, then alembic upgrade head. What the models gained before
+migrations existed is added by the 0001a, 0001b and 0001c revisions.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001_baseline"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("username", sa.String(), nullable=False),
+        sa.Column("full_name", sa.String(), nullable=False),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("hashed_password", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("email"),
+        sa.UniqueConstraint("username"),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+
+    op.create_table(
+        "movies",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("title", sa.String(), nullable=False),
+        sa.Column("description", sa.String(), nullable=False),
+        sa.Column("owner_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["owner_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_movies_id", "movies", ["id"])
+
+    op.create_table(
+        "ratings",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("stars", sa.Integer(), nullable=False),
+        sa.Column("comment", sa.String(), nullable=True),
+        sa.Column("movie_id", sa.Integer(), nullable=True),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["movie_id"], ["movies.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_ratings_id", "ratings", ["id"])
+
+    op.create_table(
+        "comments",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("text", sa.String(), nullable=False),
+        sa.Column("movie_id", sa.Integer(), nullable=True),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("parent_comment_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["movie_id"], ["movies.id"]),
+        sa.ForeignKeyConstraint(["parent_comment_id"], ["comments.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_comments_id", "comments", ["id"])
+
+
+def downgrade() -> None:
+    op.drop_table("comments")
+    op.drop_table("ratings")
+    op.drop_table("movies")
+    op.drop_table("users")
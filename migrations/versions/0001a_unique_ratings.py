@@ -0,0 +1,39 @@
+"""One rating per user and movie: drop the duplicates, then the unique index
+
+Revision ID: 0001a_unique_ratings
+Revises: 0001_baseline
+Create Date: 2026-10-18
+
+The index arrived before migrations existed, the rating upsert's ON CONFLICT needs it.
+Keeps the latest rating of each user and movie like crud.delete_duplicate_ratings
+(python cli.py dedupe-ratings), then creates the index in the same transaction, so no
+duplicate can be written in between. It sits before 0002 so that a database migrated
+when the baseline still created the index counts it as applied.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001a_unique_ratings"
+down_revision: Union[str, Sequence[str], None] = "0001_baseline"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The table as of this revision, not the current model
+    ratings = sa.table("ratings", sa.column("id"), sa.column("movie_id"), sa.column("user_id"))
+    latest = (
+        sa.select(sa.func.max(ratings.c.id))
+        .where(ratings.c.movie_id.is_not(None))
+        .group_by(ratings.c.user_id, ratings.c.movie_id)
+    )
+    op.execute(ratings.delete().where(ratings.c.movie_id.is_not(None), ratings.c.id.not_in(latest)))
+    op.create_index("uq_ratings_user_movie", "ratings", ["user_id", "movie_id"], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index("uq_ratings_user_movie", table_name="ratings")
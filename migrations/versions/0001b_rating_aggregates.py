@@ -0,0 +1,52 @@
+"""Rating aggregates stored on movies, filled from the existing ratings
+
+Revision ID: 0001b_rating_aggregates
+Revises: 0001a_unique_ratings
+Create Date: 2026-10-18
+
+The columns arrived before migrations existed, this revision adds them to a database
+stamped at 0001_baseline. It sits before 0002 so that a database migrated when the
+baseline still created them counts it as applied, and after 0001a so that the deleted
+duplicate ratings are not counted. The backfill is the UPDATE ... FROM of
+crud.rebuild_rating_aggregates (python cli.py reconcile-ratings), the new columns already
+hold 0 for movies without ratings.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001b_rating_aggregates"
+down_revision: Union[str, Sequence[str], None] = "0001a_unique_ratings"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = ["rating_count", "rating_sum"] + [f"stars_{stars}" for stars in range(6)]
+
+
+def upgrade() -> None:
+    for name in COLUMNS:
+        op.add_column("movies", sa.Column(name, sa.Integer(), server_default="0", nullable=False))
+
+    # The tables as of this revision, not the current models
+    movies = sa.table("movies", sa.column("id"), *(sa.column(name) for name in COLUMNS))
+    ratings = sa.table("ratings", sa.column("id"), sa.column("stars"), sa.column("movie_id"))
+    totals = (
+        sa.select(
+            ratings.c.movie_id,
+            sa.func.count(ratings.c.id).label("rating_count"),
+            sa.func.sum(ratings.c.stars).label("rating_sum"),
+            *(sa.func.count(ratings.c.id).filter(ratings.c.stars == stars).label(f"stars_{stars}") for stars in range(6)),
+        )
+        .where(ratings.c.movie_id.is_not(None))
+        .group_by(ratings.c.movie_id)
+        .subquery()
+    )
+    op.execute(movies.update().where(movies.c.id == totals.c.movie_id).values({name: totals.c[name] for name in COLUMNS}))
+
+
+def downgrade() -> None:
+    for name in reversed(COLUMNS):
+        op.drop_column("movies", name)
@@ -0,0 +1,31 @@
+"""Index movies (title, id), the keyset pagination of ?sort=title seeks on it
+
+Revision ID: 0001c_movie_title_index
+Revises: 0001b_rating_aggregates
+Create Date: 2026-10-18
+
+The index arrived before migrations existed. It sits before 0002 so that a database
+migrated when the baseline still created it counts it as applied. Built with CREATE
+INDEX CONCURRENTLY on Postgres, like 0002.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001c_movie_title_index"
+down_revision: Union[str, Sequence[str], None] = "0001b_rating_aggregates"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # A failed concurrent build leaves an INVALID index behind, drop it before running this again
+    with op.get_context().autocommit_block():
+        op.create_index("ix_movies_title_id", "movies", ["title", "id"], postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_movies_title_id", table_name="movies", postgresql_concurrently=True)
@@ -0,0 +1,41 @@
+"""Index the foreign key columns the app filters and joins on
+
+Revision ID: 0002_foreign_key_indexes
+Revises: 0001c_movie_title_index
+Create Date: 2026-10-18
+
+On Postgres the indexes are built with CREATE INDEX CONCURRENTLY, outside a
+transaction, so reads and writes carry on while a large table is indexed.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002_foreign_key_indexes"
+down_revision: Union[str, Sequence[str], None] = "0001c_movie_title_index"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (name, table, columns)
+INDEXES = [
+    ("ix_movies_owner_id", "movies", ["owner_id"]),
+    ("ix_ratings_movie_id", "ratings", ["movie_id"]),
+    ("ix_comments_movie_id_id", "comments", ["movie_id", "id"]),
+    ("ix_comments_parent_comment_id", "comments", ["parent_comment_id"]),
+    ("ix_comments_user_id", "comments", ["user_id"]),
+]
+
+
+def upgrade() -> None:
+    # A failed concurrent build leaves an INVALID index behind, drop it before running this again
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
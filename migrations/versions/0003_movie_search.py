@@ -0,0 +1,66 @@
+"""Full-text search on movie titles and descriptions
+
+Revision ID: 0003_movie_search
+Revises: 0002_foreign_key_indexes
+Create Date: 2026-10-18
+
+Postgres: a generated tsvector column and its GIN index. Adding a stored generated
+column rewrites the movies table under an exclusive lock, plan it for a quiet time on
+a large table; the index is then built concurrently. SQLite: an FTS5 table over movies,
+filled from the existing rows and kept in step by triggers.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003_movie_search"
+down_revision: Union[str, Sequence[str], None] = "0002_foreign_key_indexes"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    dialect = op.get_context().dialect.name
+    if dialect == "postgresql":
+        op.execute(
+            "ALTER TABLE movies ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('english', title), 'A') || setweight(to_tsvector('english', description), 'B')"
+            ") STORED"
+        )
+        with op.get_context().autocommit_block():
+            op.execute("CREATE INDEX CONCURRENTLY ix_movies_search_vector ON movies USING gin (search_vector)")
+    elif dialect == "sqlite":
+        op.execute(
+            "CREATE VIRTUAL TABLE movies_fts USING fts5("
+            "title, description, content='movies', content_rowid='id', tokenize='porter unicode61')"
+        )
+        op.execute("INSERT INTO movies_fts (movies_fts) VALUES ('rebuild')")
+        op.execute(
+            "CREATE TRIGGER movies_fts_insert AFTER INSERT ON movies BEGIN "
+            "INSERT INTO movies_fts (rowid, title, description) VALUES (new.id, new.title, new.description); END"
+        )
+        op.execute(
+            "CREATE TRIGGER movies_fts_delete AFTER DELETE ON movies BEGIN "
+            "INSERT INTO movies_fts (movies_fts, rowid, title, description) "
+            "VALUES ('delete', old.id, old.title, old.description); END"
+        )
+        op.execute(
+            "CREATE TRIGGER movies_fts_update AFTER UPDATE OF title, description ON movies BEGIN "
+            "INSERT INTO movies_fts (movies_fts, rowid, title, description) "
+            "VALUES ('delete', old.id, old.title, old.description); "
+            "INSERT INTO movies_fts (rowid, title, description) VALUES (new.id, new.title, new.description); END"
+        )
+
+
+def downgrade() -> None:
+    dialect = op.get_context().dialect.name
+    if dialect == "postgresql":
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_movies_search_vector")
+        op.execute("ALTER TABLE movies DROP COLUMN search_vector")
+    elif dialect == "sqlite":
+        for trigger in ("movies_fts_insert", "movies_fts_delete", "movies_fts_update"):
+            op.execute(f"DROP TRIGGER {trigger}")
+        op.execute("DROP TABLE movies_fts")
@@ -0,0 +1,45 @@
+"""Precomputed similar movies and the ratings version they were computed from
+
+Revision ID: 0004_movie_similarities
+Revises: 0003_movie_search
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004_movie_similarities"
+down_revision: Union[str, Sequence[str], None] = "0003_movie_search"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("movies", sa.Column("ratings_version", sa.Integer(), server_default="0", nullable=False))
+    op.create_table(
+        "movie_similarities",
+        sa.Column("movie_id", sa.Integer(), nullable=False),
+        sa.Column("rank", sa.Integer(), nullable=False),
+        sa.Column("similar_movie_id", sa.Integer(), nullable=False),
+        sa.Column("score", sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(["movie_id"], ["movies.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["similar_movie_id"], ["movies.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("movie_id", "rank"),
+    )
+    op.create_index("ix_movie_similarities_similar_movie_id", "movie_similarities", ["similar_movie_id"])
+    op.create_table(
+        "similarity_state",
+        sa.Column("movie_id", sa.Integer(), nullable=False),
+        sa.Column("ratings_version", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["movie_id"], ["movies.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("movie_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("similarity_state")
+    op.drop_table("movie_similarities")
+    op.drop_column("movies", "ratings_version")
@@ -1,7 +1,10 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import DDL, Column, Float, Integer, String, ForeignKey, Index, event
 from sqlalchemy.orm import relationship, backref
 from database import Base
 
+# Allowed star values of a rating, one histogram column per value on Movie
+STAR_VALUES = range(0, 6)
+
 
 class User(Base):
     __tablename__ = "users"
@@ -24,13 +27,30 @@ class Movie(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     title = Column(String, nullable=False)
     description = Column(String, nullable=False)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+
+    # Rating aggregates, kept in step with the ratings table by crud.upsert_rating
+    rating_count = Column(Integer, nullable=False, default=0, server_default="0")
+    rating_sum = Column(Integer, nullable=False, default=0, server_default="0")
+    # Star histogram, one counter per star value (see STAR_VALUES)
+    stars_0 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_1 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_2 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_3 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_4 = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_5 = Column(Integer, nullable=False, default=0, server_default="0")
+    # Bumped whenever the movie's ratings change, similarity.py recomputes the movies
+    # whose version moved since its last run (see SimilarityState)
+    ratings_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     # Relationships
     owner = relationship("User", back_populates="movies")
     ratings = relationship("Rating", back_populates="movie")
     comments = relationship("Comment", back_populates="movie")
 
+    # Keyset pagination on ?sort=title seeks on (title, id)
+    __table_args__ = (Index("ix_movies_title_id", "title", "id"),)
+
 
 class Rating(Base):
     __tablename__ = "ratings"
@@ -38,13 +58,17 @@ class Rating(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     stars = Column(Integer, nullable=False)
     comment = Column(String, nullable=True)
-    movie_id = Column(Integer, ForeignKey("movies.id"))
+    # The ratings list, the aggregate rebuild and movie deletes filter on movie_id
+    movie_id = Column(Integer, ForeignKey("movies.id"), index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
 
     # Relationships
     movie = relationship("Movie", back_populates="ratings")
     user = relationship("User", back_populates="ratings")
 
+    # One rating per user and movie, rating again replaces it (see crud.upsert_rating)
+    __table_args__ = (Index("uq_ratings_user_movie", "user_id", "movie_id", unique=True),)
+
 
 class Comment(Base):
     __tablename__ = "comments"
@@ -52,8 +76,8 @@ class Comment(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     text = Column(String, nullable=False)
     movie_id = Column(Integer, ForeignKey("movies.id"))
-    user_id = Column(Integer, ForeignKey("users.id"))
-    parent_comment_id = Column(Integer, ForeignKey('comments.id'), nullable=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    parent_comment_id = Column(Integer, ForeignKey('comments.id'), nullable=True, index=True)
     
     movie = relationship("Movie", back_populates="comments")
     user = relationship("User", back_populates="comments")
@@ -65,5 +89,67 @@ class Comment(Base):
         backref=backref("children", cascade="all, delete-orphan")
     )
 
+    # A movie's thread is read with WHERE movie_id = ? ORDER BY id (crud.comment_thread_query)
+    __table_args__ = (Index("ix_comments_movie_id_id", "movie_id", "id"),)
+
     def __repr__(self):
-        return f"<Comment(id={self.id}, text={self.text}, movie_id={self.movie_id}, parent_comment_id={self.parent_comment_id})>"
\ No newline at end of file
+        return f"<Comment(id={self.id}, text={self.text}, movie_id={self.movie_id}, parent_comment_id={self.parent_comment_id})>"
+
+
+
+class MovieSimilarity(Base):
+    # Top neighbours of each movie by item-item cosine similarity of their ratings,
+    # written by similarity.py. GET /movies/{id}/similar reads one movie_id range.
+    __tablename__ = "movie_similarities"
+
+    movie_id = Column(Integer, ForeignKey("movies.id", ondelete="CASCADE"), primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    # Indexed: an incremental run looks up which movies list a changed movie
+    similar_movie_id = Column(Integer, ForeignKey("movies.id", ondelete="CASCADE"), nullable=False, index=True)
+    score = Column(Float, nullable=False)
+
+
+class SimilarityState(Base):
+    # Movie.ratings_version the stored neighbours of a movie were computed from
+    __tablename__ = "similarity_state"
+
+    movie_id = Column(Integer, ForeignKey("movies.id", ondelete="CASCADE"), primary_key=True)
+    ratings_version = Column(Integer, nullable=False)
+
+# Full-text search over movie titles and descriptions (see search.py), created with the
+# movies table and by migration 0003. Postgres: a generated tsvector column with a GIN
+# index. SQLite: an FTS5 table over movies, kept in step by triggers.
+SEARCH_DDL = {
+    "postgresql": [
+        "ALTER TABLE movies ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', title), 'A') || setweight(to_tsvector('english', description), 'B')"
+        ") STORED",
+        "CREATE INDEX ix_movies_search_vector ON movies USING gin (search_vector)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE movies_fts USING fts5("
+        "title, description, content='movies', content_rowid='id', tokenize='porter unicode61')",
+        "CREATE TRIGGER movies_fts_insert AFTER INSERT ON movies BEGIN "
+        "INSERT INTO movies_fts (rowid, title, description) VALUES (new.id, new.title, new.description); END",
+        "CREATE TRIGGER movies_fts_delete AFTER DELETE ON movies BEGIN "
+        "INSERT INTO movies_fts (movies_fts, rowid, title, description) "
+        "VALUES ('delete', old.id, old.title, old.description); END",
+        "CREATE TRIGGER movies_fts_update AFTER UPDATE OF title, description ON movies BEGIN "
+        "INSERT INTO movies_fts (movies_fts, rowid, title, description) "
+        "VALUES ('delete', old.id, old.title, old.description); "
+        "INSERT INTO movies_fts (rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    ],
+}
+# Names of the search objects, which are not in the metadata (see include_in_autogenerate)
+SEARCH_OBJECTS = ("search_vector", "ix_movies_search_vector", "movies_fts")
+
+for dialect, statements in SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Movie.__table__, "after_create", DDL(statement).execute_if(dialect=dialect))
+event.listen(Movie.__table__, "before_drop", DDL("DROP TABLE IF EXISTS movies_fts").execute_if(dialect="sqlite"))
+
+
+def include_in_autogenerate(name, type_, parent_names) -> bool:
+    # Alembic include_name hook: leave the search objects (and the FTS5 shadow tables) alone
+    return not (name or "").startswith(SEARCH_OBJECTS)
+
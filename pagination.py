@@ -0,0 +1,82 @@
+import base64
+import json
+import math
+import os
+
+from fastapi import HTTPException
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import raiseload
+
+from models import Movie
+
+# Hard cap on the page size of list endpoints
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 100))
+
+# Deepest reply level returned by GET /movies/{id}/comments, pydantic refuses to
+# serialize models nested much beyond 250 levels
+MAX_COMMENT_DEPTH = int(os.environ.get("MAX_COMMENT_DEPTH", 100))
+
+# Sort keys allowed for keyset pagination, Movie.id is always the tiebreak
+MOVIE_SORT_KEYS = {
+    "id": Movie.id,
+    "title": Movie.title,
+}
+
+
+# JSON types the cursor key of each sort may hold, anything else never reaches the query
+CURSOR_KEY_TYPES = {
+    "id": (int,),
+    "title": (str,),
+    # search.SEARCH_SORT, the rank of the last match
+    "rank": (int, float),
+}
+
+
+def valid_key(key, types) -> bool:
+    # bool is an int to isinstance, it is never a valid key. JSON also decodes NaN and
+    # Infinity, no rank compares sensibly to them.
+    if isinstance(key, bool) or not isinstance(key, types):
+        return False
+    return not isinstance(key, float) or math.isfinite(key)
+
+
+def encode_cursor(sort: str, key, last_id: int) -> str:
+    payload = json.dumps([sort, key, last_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort, key, last_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort != sort or not valid_key(last_id, (int,)):
+        raise HTTPException(status_code=400, detail="Cursor does not match sort order")
+    if sort in CURSOR_KEY_TYPES and not valid_key(key, CURSOR_KEY_TYPES[sort]):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key, last_id
+
+
+def movies_page_query(limit: int, after=None, sort: str="id"):
+    # Fetch one extra row so the caller knows whether there is a next page
+    sort_column = MOVIE_SORT_KEYS[sort]
+    # Pages are serialized as schemas.MovieSummary, no relationship is ever needed
+    query = select(Movie).options(raiseload("*"))
+    if sort == "id":
+        if after is not None:
+            query = query.where(Movie.id > after[1])
+        return query.order_by(Movie.id).limit(limit + 1)
+    if after is not None:
+        query = query.where(tuple_(sort_column, Movie.id) > tuple_(*after))
+    return query.order_by(sort_column, Movie.id).limit(limit + 1)
+
+
+def movies_page(movies, limit: int, sort: str="id"):
+    # Trim the look-ahead row and build the cursor for the next page
+    next_cursor = None
+    if len(movies) > limit:
+        movies = movies[:limit]
+        last = movies[-1]
+        next_cursor = encode_cursor(sort, getattr(last, sort), last.id)
+    return {"items": movies, "next_cursor": next_cursor}
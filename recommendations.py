@@ -0,0 +1,211 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import als
+from similarity import RatingsMatrix
+
+# Personalized recommendations from an alternating least squares factorization of the
+# ratings: stars ~ user_factors[user] . item_factors[movie], with weighted-lambda
+# regularization. python cli.py train-recommendations fits the factors and stores the
+# RECOMMEND_TOP_N best movies of every user (rated movies left out) as .npy files in
+# RECOMMENDATIONS_DIR. API workers memory map the files, so every process shares one
+# copy of the pages, and pick up a new model when the job publishes one.
+
+RECOMMENDATIONS_DIR = os.environ.get("RECOMMENDATIONS_DIR", "recommendations")
+RECOMMEND_FACTORS = int(os.environ.get("RECOMMEND_FACTORS", 32))
+RECOMMEND_TOP_N = int(os.environ.get("RECOMMEND_TOP_N", 50))
+# Link to the directory of the model being served
+CURRENT = "current"
+MODEL_FILES = ("user_factors", "item_factors", "top_movies", "top_scores")
+
+
+def row_ranges(indptr, parts: int):
+    # Splits the rows into up to parts ranges of about the same number of ratings
+    n_rows = len(indptr) - 1
+    cuts = np.searchsorted(indptr, np.linspace(0, indptr[-1], parts + 1)[1:-1])
+    bounds = np.unique(np.concatenate(([0], np.clip(cuts, 0, n_rows), [n_rows])))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+class Trainer:
+    # Runs the row ranges of a step in-process, or on a pool of worker processes
+    # that map the same files
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = None
+        if workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def map(self, fn, paths, ranges, *args):
+        if self._executor is None:
+            return [fn(paths, start, end, *args) for start, end in ranges]
+        futures = [self._executor.submit(fn, paths, start, end, *args) for start, end in ranges]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+def top_movies(user_factors, item_factors, indptr, indices, movies, scores, chunk: int, rated_items):
+    # Fills movies and scores (users x top_n) with the best movies of every user by
+    # predicted stars, the user's rated movies and movies nobody rated left out.
+    # Padded with -1 when fewer are left.
+    n_users, n_movies = len(user_factors), len(item_factors)
+    k = min(movies.shape[1], n_movies)
+    movies[:] = -1
+    for first in range(0, n_users, chunk):
+        last = min(first + chunk, n_users)
+        predicted = np.asarray(user_factors[first:last]) @ np.asarray(item_factors).T
+        predicted[:, ~rated_items] = -np.inf
+        counts = np.diff(indptr[first:last + 1])
+        predicted[np.repeat(np.arange(last - first), counts), indices[indptr[first]:indptr[last]]] = -np.inf
+        best = np.argpartition(-predicted, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(predicted, best, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best, best_scores = np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+        keep = np.isfinite(best_scores)
+        movies[first:last, :k] = np.where(keep, best, -1)
+        scores[first:last, :k] = np.where(keep, best_scores, 0)
+    return movies, scores
+
+
+def publish(directory: str, build: str, keep: int=2):
+    # Points CURRENT at the new model in one rename, then drops all but the keep newest.
+    # A worker still mapping a dropped model keeps reading it until it reloads.
+    link = os.path.join(directory, CURRENT)
+    os.symlink(os.path.basename(build), link + ".tmp")
+    os.replace(link + ".tmp", link)
+    builds = sorted(name for name in os.listdir(directory) if name.startswith("model-"))
+    for name in builds[:-keep]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def train_recommendations(db, factors: int=RECOMMEND_FACTORS, iterations: int=10, regularization: float=0.05,
+                          workers: int=1, top_n: int=RECOMMEND_TOP_N, memory_mb: int=256, seed: int=0,
+                          directory: str=RECOMMENDATIONS_DIR, report=print):
+    start = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="ratings-", dir=directory)
+    build = os.path.join(directory, f"model-{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}")
+    os.makedirs(build)
+    trainer = Trainer(workers)
+    try:
+        matrix = RatingsMatrix(db, workdir)
+        # The ratings are all on disk, end the read transaction and its snapshot
+        db.rollback()
+        np.save(os.path.join(workdir, "by_user_indptr.npy"), matrix.user_ptr)
+        np.save(os.path.join(workdir, "by_movie_indptr.npy"), matrix.movie_ptr)
+        user_factors = open_memmap(os.path.join(build, "user_factors.npy"), "w+", np.float32, (matrix.n_users, factors))
+        item_factors = open_memmap(os.path.join(build, "item_factors.npy"), "w+", np.float32, (matrix.n_movies, factors))
+        item_factors[:] = np.random.default_rng(seed).normal(0, 0.1, (matrix.n_movies, factors))
+        item_factors.flush()
+
+        def step(major: str, out: str, fixed: str):
+            return {
+                "indptr": os.path.join(workdir, f"{major}_indptr.npy"),
+                "indices": os.path.join(workdir, f"{major}_indices.npy"),
+                "stars": os.path.join(workdir, f"{major}_stars.npy"),
+                "out": os.path.join(build, f"{out}.npy"),
+                "fixed": os.path.join(build, f"{fixed}.npy"),
+            }
+
+        users_step = step("by_user", "user_factors", "item_factors")
+        items_step = step("by_movie", "item_factors", "user_factors")
+        user_ranges = row_ranges(matrix.user_ptr, workers * 4)
+        item_ranges = row_ranges(matrix.movie_ptr, workers * 4)
+        # Ratings per chunk: their factor vectors, gathered and zero padded (float64), fill the memory
+        max_ratings = max(1, memory_mb * 2**20 // (workers * 8 * factors * 4))
+        rmse = 0.0
+        for iteration in range(1, iterations + 1):
+            trainer.map(als.solve_rows, users_step, user_ranges, regularization, max_ratings)
+            trainer.map(als.solve_rows, items_step, item_ranges, regularization, max_ratings)
+            errors = trainer.map(als.squared_error, users_step, user_ranges, max_ratings)
+            total = sum(error for error, _ in errors)
+            count = sum(count for _, count in errors)
+            rmse = (total / count) ** 0.5 if count else 0.0
+            report(f"iteration {iteration}/{iterations}: training rmse {rmse:.4f}")
+
+        # Users per chunk: scores, their negation and the int64 partition of chunk x movies
+        chunk = max(1, memory_mb * 2**20 // (16 * max(matrix.n_movies, 1)))
+        movies = open_memmap(os.path.join(build, "top_movies.npy"), "w+", np.int32, (matrix.n_users, top_n))
+        scores = open_memmap(os.path.join(build, "top_scores.npy"), "w+", np.float32, (matrix.n_users, top_n))
+        top_movies(user_factors, item_factors, matrix.user_ptr, matrix.user_movies, movies, scores, chunk,
+                   np.diff(matrix.movie_ptr) > 0)
+        for array in (user_factors, item_factors, movies, scores):
+            array.flush()
+        del user_factors, item_factors, movies, scores
+        publish(directory, build)
+    except BaseException:
+        shutil.rmtree(build, ignore_errors=True)
+        raise
+    finally:
+        trainer.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"users": matrix.n_users, "movies": matrix.n_movies, "rmse": rmse, "seconds": time.perf_counter() - start}
+
+
+class Model:
+    def __init__(self, path: str):
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in MODEL_FILES}
+        self.user_factors = arrays["user_factors"]
+        self.item_factors = arrays["item_factors"]
+        self.top_movies = arrays["top_movies"]
+        self.top_scores = arrays["top_scores"]
+        # Movies nobody had rated keep zero factors, they are never recommended
+        self.known_items = self.item_factors.any(axis=1)
+
+
+class RecommendationStore:
+    # The published model, memory mapped. Follows CURRENT, a new model is loaded by the
+    # first lookup after the job publishes it.
+
+    def __init__(self, directory: str=RECOMMENDATIONS_DIR):
+        self.directory = directory
+        self._path = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def model(self):
+        path = os.path.realpath(os.path.join(self.directory, CURRENT))
+        if path != self._path:
+            with self._lock:
+                if path != self._path:
+                    self._model = Model(path) if os.path.isdir(path) else None
+                    self._path = path
+        return self._model
+
+    def recommend(self, user_id: int, exclude, limit: int):
+        # (movie id, predicted stars) best first, without the movies in exclude. The
+        # stored list is used while it lasts, once the user has rated too many of its
+        # movies they are scored again from the factors.
+        model = self.model()
+        if model is None or user_id >= len(model.top_movies):
+            return []
+        stored = [
+            (movie_id, score) for movie_id, score in zip(model.top_movies[user_id].tolist(), model.top_scores[user_id].tolist())
+            if movie_id >= 0 and movie_id not in exclude
+        ]
+        if len(stored) >= limit or not model.user_factors[user_id].any():
+            return stored[:limit]
+        scores = model.item_factors @ model.user_factors[user_id]
+        scores[~model.known_items] = -np.inf
+        excluded = [movie_id for movie_id in exclude if movie_id < len(scores)]
+        scores[excluded] = -np.inf
+        k = min(limit, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(movie_id, float(scores[movie_id])) for movie_id in best.tolist() if np.isfinite(scores[movie_id])]
+
+
+recommendation_store = RecommendationStore()
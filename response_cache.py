@@ -0,0 +1,194 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Size cap of the in-process response cache, and how long a response may be served from it
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 30))
+
+# Public GET routes that are cached, with the tags their responses depend on.
+# Write routes invalidate by tag: "movies" (the list), "movie:<id>", "ratings:<id>", "comments:<id>".
+# Ratings leave "movies" alone, the rating aggregates on list and search pages may be up to
+# RESPONSE_CACHE_TTL seconds old.
+CACHE_RULES = [
+    (re.compile(r"^/movies/$"), lambda m: ["movies"]),
+    (re.compile(r"^/movies/search$"), lambda m: ["movies"]),
+    # Lists from the offline jobs of cli.py, a new run is served once the TTL expires
+    (re.compile(r"^/movies/(\d+)/similar$"), lambda m: ["movies"]),
+    (re.compile(r"^/movies/(\d+)/similar-content$"), lambda m: ["movies"]),
+    (re.compile(r"^/movie/(\d+)$"), lambda m: [f"movie:{m[1]}"]),
+    (re.compile(r"^/movies/(\d+)/ratings/$"), lambda m: [f"ratings:{m[1]}"]),
+    (re.compile(r"^/movies/(\d+)/rating-summary$"), lambda m: [f"movie:{m[1]}", f"ratings:{m[1]}"]),
+    (re.compile(r"^/movies/(\d+)/comments$"), lambda m: [f"comments:{m[1]}"]),
+]
+
+
+def cache_tags(path: str):
+    for pattern, tags in CACHE_RULES:
+        match = pattern.match(path)
+        if match:
+            return tags(match)
+    return None
+
+
+def cache_key(request: Request) -> str:
+    # Same route and same params (in any order) share an entry
+    params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    return f"{request.url.path}?{params}"
+
+
+class CacheBackend:
+    # Storage interface of the response cache. Values are (body, content type) pairs,
+    # a Redis compatible backend only has to implement these methods.
+
+    def get(self, key: str):
+        raise NotImplementedError
+
+    def set(self, key: str, value, tags):
+        raise NotImplementedError
+
+    def invalidate_tags(self, tags):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    # LRU bounded by the total size of the cached bodies, entries expire after ttl seconds
+
+    def __init__(self, max_bytes: int=RESPONSE_CACHE_MAX_BYTES, ttl: float=RESPONSE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tags = defaultdict(set)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        value, expires_at, tags, size = self._entries.pop(key)
+        self.bytes -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value, tags):
+        size = len(key) + len(value[0])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, tuple(tags), size)
+            self.bytes += size
+            for tag in tags:
+                self._tags[tag].add(key)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+class ResponseCache:
+    def __init__(self, backend: CacheBackend, enabled: bool=True):
+        self.backend = backend
+        self.enabled = enabled
+        # Bumped on every invalidation, a response computed across one is not stored
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _generation(self, tags):
+        with self._lock:
+            return tuple(self._generations[tag] for tag in tags)
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] += 1
+            self.invalidations += 1
+        self.backend.invalidate_tags(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    async def serve(self, request: Request, call_next):
+        tags = cache_tags(request.url.path) if self.enabled and request.method == "GET" else None
+        if tags is None:
+            return await call_next(request)
+
+        key = cache_key(request)
+        cached = self.backend.get(key)
+        if cached is not None:
+            self.hits += 1
+            body, media_type = cached
+            return Response(body, media_type=media_type, headers={"X-Cache": "HIT"})
+
+        self.misses += 1
+        generation = self._generation(tags)
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        if self._generation(tags) == generation:
+            self.backend.set(key, (body, response.headers.get("content-type")), tags)
+        headers = dict(response.headers)
+        headers["X-Cache"] = "MISS"
+        return Response(body, status_code=response.status_code, headers=headers)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            **self.backend.stats(),
+        }
+
+
+response_cache = ResponseCache(MemoryBackend(), enabled=RESPONSE_CACHE_TTL > 0)
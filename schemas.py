@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr, field_validator, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, EmailStr, field_validator, computed_field, ConfigDict
+from typing import Dict, List, Optional
 
 
 # User Schemas
@@ -32,14 +32,44 @@ class MovieCreate(MovieBase):
     pass
 
 
-class Movie(MovieBase):
+class MovieSummary(MovieBase):
     id: int
     owner_id: int
+    rating_count: int = 0
+    rating_sum: int = 0
+
+    @computed_field
+    @property
+    def average_rating(self) -> Optional[float]:
+        return self.rating_sum / self.rating_count if self.rating_count else None
+
+
+class Movie(MovieSummary):
     owner: User
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class MoviePage(BaseModel):
+    items: List[MovieSummary]
+    next_cursor: Optional[str] = None
+
+
+class SimilarMovie(MovieSummary):
+    score: float
+
+
+class RecommendedMovie(MovieSummary):
+    # Predicted stars
+    score: float
+
+
+class MovieSuggestion(BaseModel):
+    id: int
+    title: str
+    rating_count: int
+
+
 class MovieUpdate(BaseModel):
     title: Optional[str] = None
     description: Optional[str] = None
@@ -58,6 +88,14 @@ class RatingCreate(BaseModel):
             raise ValueError('Stars must be between 0 and 5')
         return v
 
+class RatingSummary(BaseModel):
+    movie_id: int
+    rating_count: int
+    rating_sum: int
+    average_rating: Optional[float] = None
+    histogram: Dict[int, int]
+
+
 class Rating(BaseModel):
     id: int
     stars: int
@@ -67,6 +105,10 @@ class Rating(BaseModel):
 
     model_config = ConfigDict(from_attributes=True)
 
+class RatingResult(Rating):
+    # False when the user had rated the movie before and the rating was replaced
+    created: bool
+
 # Comment Schemas
 
 
@@ -0,0 +1,64 @@
+import re
+
+from sqlalchemy import Double, and_, cast, func, literal_column, or_, select, table, column
+from sqlalchemy.orm import raiseload
+
+from models import Movie
+from pagination import encode_cursor
+
+# Full-text search over Movie.title and Movie.description, ranked best first with the
+# movie id as tiebreak. Postgres matches the generated search_vector column (GIN index),
+# SQLite the movies_fts FTS5 table (see models.SEARCH_DDL). Every term must match.
+
+# Text search configuration of the tsvector column on Postgres
+SEARCH_CONFIG = "english"
+# bm25 column weights on SQLite, as the A/B weights on Postgres: title matches count more
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+# Cursor tag of search pages, see pagination.decode_cursor
+SEARCH_SORT = "rank"
+
+
+def search_terms(q: str):
+    # Words only, so no user input reaches the tsquery / FTS5 query syntax
+    return re.findall(r"\w+", q.lower())
+
+
+def ranked_matches(dialect: str, terms):
+    # (query selecting Movie and its rank, rank expression), higher rank is better
+    if dialect == "postgresql":
+        search_vector = literal_column("movies.search_vector")
+        # Inline regconfig, asyncpg would send a bound config name as varchar
+        tsquery = func.plainto_tsquery(literal_column(f"'{SEARCH_CONFIG}'::regconfig"), " ".join(terms))
+        # float8, the value in the cursor must compare equal to the recomputed rank
+        rank = cast(func.ts_rank(search_vector, tsquery), Double)
+        return select(Movie, rank.label("rank")).where(search_vector.op("@@")(tsquery)), rank
+    fts = table("movies_fts", column("rowid"))
+    match = " ".join(f'"{term}"' for term in terms)
+    rank = -func.bm25(literal_column("movies_fts"), TITLE_WEIGHT, DESCRIPTION_WEIGHT)
+    query = (
+        select(Movie, rank.label("rank"))
+        .join(fts, fts.c.rowid == Movie.id)
+        .where(literal_column("movies_fts").op("MATCH")(match))
+    )
+    return query, rank
+
+
+def search_movies_query(dialect: str, terms, limit: int, after=None):
+    # Keyset pagination on (rank desc, id), one extra row like pagination.movies_page_query
+    query, rank = ranked_matches(dialect, terms)
+    query = query.options(raiseload("*"))
+    if after is not None:
+        after_rank, after_id = after
+        query = query.where(or_(rank < after_rank, and_(rank == after_rank, Movie.id > after_id)))
+    return query.order_by(rank.desc(), Movie.id).limit(limit + 1)
+
+
+def search_page(rows, limit: int):
+    # rows are (movie, rank) pairs, the cursor carries the rank and id of the last one
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        movie, rank = rows[-1]
+        next_cursor = encode_cursor(SEARCH_SORT, rank, movie.id)
+    return {"items": [movie for movie, _ in rows], "next_cursor": next_cursor}
@@ -0,0 +1,292 @@
+import os
+import shutil
+import tempfile
+import time
+from itertools import chain
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from sqlalchemy import delete, exists, func, insert, select
+
+from models import Movie, MovieSimilarity, Rating, SimilarityState
+
+# Item-item "similar movies": cosine similarity of the movies' star vectors over users,
+# top SIMILAR_TOP_K neighbours per movie stored in movie_similarities.
+#
+# The user x movie ratings matrix is streamed from the database into .npy memmaps, once
+# ordered by user (CSR) and once by movie (CSC), so it never has to fit in memory. Movies
+# are then scored in blocks: the dot products of a block with every movie are gathered
+# through the users who rated both, in slices of at most max_pairs (user, movie) pairs,
+# into a block x movies array sized from memory_mb.
+#
+# An incremental run recomputes the movies whose Movie.ratings_version moved since
+# their last run and merges their new scores into the lists of the other movies, block
+# by block, so its memory follows memory_mb as a full run's does. A
+# movie that drops out of another movie's list is not replaced by the next best one
+# (only K are stored), so lists can shrink until the next full run.
+
+SIMILAR_TOP_K = int(os.environ.get("SIMILAR_TOP_K", 20))
+# Rows fetched per round trip while streaming the ratings
+STREAM_CHUNK = 100_000
+# Movies per write of the merged lists of not recomputed movies
+MERGE_CHUNK = 1000
+# Most movies scored together, keeps the IN lists of one block's writes short
+MAX_BLOCK = 5000
+
+
+def id_ranges(starts, ends):
+    # Concatenation of the ranges [starts[k], ends[k]), vectorized
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum(), dtype=np.int64)
+
+
+def pairs(rows):
+    # Two-column int rows as a (2, len(rows)) array, without numpy probing every Row
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)).reshape(-1, 2).T
+
+
+class RatingsMatrix:
+    # Sparse user x movie stars, as CSR (by user) and CSC (by movie) arrays on disk.
+    # Users and movies are indexed by their id.
+
+    def __init__(self, db, workdir: str):
+        self.workdir = workdir
+        ratings = select(Rating).where(Rating.movie_id.is_not(None), Rating.user_id.is_not(None)).subquery()
+        self.n_users = (db.scalar(select(func.max(ratings.c.user_id))) or 0) + 1
+        self.n_movies = (db.scalar(select(func.max(ratings.c.movie_id))) or 0) + 1
+        self.user_ptr, self.user_movies, self.user_stars = self._load(
+            db, "by_user", ratings.c.user_id, ratings.c.movie_id, ratings.c.stars, self.n_users)
+        self.movie_ptr, self.movie_users, self.movie_stars = self._load(
+            db, "by_movie", ratings.c.movie_id, ratings.c.user_id, ratings.c.stars, self.n_movies)
+        # Euclidean norm of each movie's star vector
+        self.norms = np.zeros(self.n_movies)
+        squares = select(ratings.c.movie_id, func.sum(ratings.c.stars * ratings.c.stars)).group_by(ratings.c.movie_id)
+        for rows in db.execute(squares).partitions(STREAM_CHUNK):
+            keys, values = pairs(rows)
+            self.norms[keys] = np.sqrt(values)
+
+    def _load(self, db, name: str, major, minor, stars, size: int):
+        # indptr in memory (one entry per id), indices and values memory mapped
+        counts = np.zeros(size, dtype=np.int64)
+        for rows in db.execute(select(major, func.count()).group_by(major)).partitions(STREAM_CHUNK):
+            keys, values = pairs(rows)
+            counts[keys] = values
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        nnz = int(indptr[-1])
+        indices = open_memmap(os.path.join(self.workdir, f"{name}_indices.npy"), "w+", np.int32, (max(nnz, 1),))
+        values = open_memmap(os.path.join(self.workdir, f"{name}_stars.npy"), "w+", np.float32, (max(nnz, 1),))
+        offset = 0
+        # Only the major order matters, an index on it serves the scan
+        result = db.execute(select(minor, stars).order_by(major).execution_options(yield_per=STREAM_CHUNK))
+        for rows in result.partitions():
+            chunk_indices, chunk_stars = pairs(rows)
+            indices[offset:offset + len(rows)] = chunk_indices
+            values[offset:offset + len(rows)] = chunk_stars
+            offset += len(rows)
+        if offset != nnz:
+            raise RuntimeError(f"ratings changed while reading them ({offset} rows, {nnz} counted)")
+        return indptr, indices, values
+
+    def scores(self, block, max_pairs: int):
+        # Cosine similarity of the movies in block with every movie, (len(block), n_movies)
+        dots = np.zeros((len(block), self.n_movies), dtype=np.float32)
+        # (row in block, user, stars) for every rating of the block's movies
+        starts, ends = self.movie_ptr[block], self.movie_ptr[block + 1]
+        rows = np.repeat(np.arange(len(block)), ends - starts)
+        positions = id_ranges(starts, ends)
+        users, stars = np.asarray(self.movie_users[positions]), np.asarray(self.movie_stars[positions])
+        # ... each joined to every rating of that user, max_pairs pairs at a time
+        user_starts, user_ends = self.user_ptr[users], self.user_ptr[users + 1]
+        cumulative = np.cumsum(user_ends - user_starts)
+        cuts = np.searchsorted(cumulative, np.arange(max_pairs, cumulative[-1] if len(cumulative) else 0, max_pairs))
+        for part in np.split(np.arange(len(users)), np.unique(cuts)):
+            if not len(part):
+                continue
+            pair_positions = id_ranges(user_starts[part], user_ends[part])
+            lengths = user_ends[part] - user_starts[part]
+            # Parts follow the block order, their cells are one contiguous run of rows of dots
+            cells = np.repeat(rows[part] * self.n_movies, lengths) + self.user_movies[pair_positions]
+            first = rows[part[0]] * self.n_movies
+            sums = np.bincount(
+                cells - first, weights=np.repeat(stars[part], lengths) * self.user_stars[pair_positions])
+            dots.ravel()[first:first + len(sums)] += sums
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarity = dots / (self.norms[block, None] * self.norms[None, :])
+        similarity[~np.isfinite(similarity)] = 0
+        similarity[np.arange(len(block)), block] = 0
+        return similarity
+
+
+def top_k(similarity, k: int):
+    # Per row: (columns, scores) of the k best positive scores, best first
+    k = min(k, similarity.shape[1])
+    best = np.sort(np.argpartition(-similarity, k - 1, axis=1)[:, :k], axis=1)
+    # Ties in id order
+    order = np.argsort(-np.take_along_axis(similarity, best, axis=1), axis=1, kind="stable")
+    best = np.take_along_axis(best, order, axis=1)
+    return [
+        [(int(column), float(row[column])) for column in columns if row[column] > 0]
+        for row, columns in zip(similarity, best)
+    ]
+
+
+def write_lists(db, lists):
+    # lists: movie id -> [(similar movie id, score)], replaces the stored lists of those movies
+    db.execute(
+        delete(MovieSimilarity).where(MovieSimilarity.movie_id.in_(list(lists))).execution_options(synchronize_session=False)
+    )
+    rows = [
+        {"movie_id": movie_id, "rank": rank, "similar_movie_id": similar_id, "score": score}
+        for movie_id, neighbours in lists.items()
+        for rank, (similar_id, score) in enumerate(neighbours)
+    ]
+    if rows:
+        db.execute(insert(MovieSimilarity), rows)
+
+
+def blocks(movies, counts, size: int, max_ratings: int):
+    # Consecutive slices of movies, at most size movies and max_ratings ratings each
+    # (a movie with more ratings than that is a block of its own)
+    first = 0
+    while first < len(movies):
+        totals = np.cumsum(counts[movies[first:first + size]])
+        last = first + max(1, int(np.searchsorted(totals, max_ratings, side="right")))
+        yield movies[first:last]
+        first = last
+
+
+def block_size(n_movies: int, memory_mb: int) -> int:
+    # Scoring and ranking a block holds about 32 bytes per cell of block x movies
+    # (float32 dots and scores, float64 partial sums, int64 top-k partition)
+    return max(1, min(MAX_BLOCK, memory_mb * 2**20 // (32 * max(n_movies, 1))))
+
+
+def merge_block(db, movies, similarity, threshold, is_dirty, top_k_count: int):
+    # Merges the new scores of a block of recomputed movies (sorted ids) into the stored
+    # lists of the movies that were not recomputed: where a score beats the list's lowest,
+    # or where the list holds the movie already. Returns the ids of the merged lists.
+    candidates = np.where((similarity > threshold) & ~is_dirty, similarity, 0)
+    listed = db.execute(
+        select(MovieSimilarity.movie_id, MovieSimilarity.similar_movie_id)
+        .where(MovieSimilarity.similar_movie_id.in_(movies.tolist()))
+    ).all()
+    listing = np.zeros(0, dtype=np.int64)
+    if listed:
+        listing, listed_movies = pairs(listed)
+        keep = listing < len(is_dirty)
+        keep[keep] = ~is_dirty[listing[keep]]
+        listing, rows = listing[keep], np.searchsorted(movies, listed_movies[keep])
+        candidates[rows, listing] = similarity[rows, listing]
+    # Only the K best of the block per list can enter it, K x movies entries at most
+    k = min(top_k_count, len(movies))
+    best = np.argpartition(-candidates, k - 1, axis=0)[:k]
+    scores = np.take_along_axis(candidates, best, axis=0)
+    del candidates
+    ranks, others = np.nonzero(scores > 0)
+    rows, scores = best[ranks, others], scores[ranks, others]
+    order = np.argsort(others, kind="stable")
+    others, rows, scores = others[order], rows[order], scores[order]
+
+    # Lists holding a block movie are rewritten even with no new score, to drop its old one
+    recomputed = set(movies.tolist())
+    merged = np.union1d(others, listing)
+    for first in range(0, len(merged), MERGE_CHUNK):
+        chunk = merged[first:first + MERGE_CHUNK]
+        stored = {movie_id: {} for movie_id in chunk.tolist()}
+        for movie_id, similar_id, score in db.execute(
+            select(MovieSimilarity.movie_id, MovieSimilarity.similar_movie_id, MovieSimilarity.score)
+            .where(MovieSimilarity.movie_id.in_(chunk.tolist()))
+        ):
+            # Entries of this block's movies are replaced by their new scores
+            if similar_id not in recomputed:
+                stored[movie_id][similar_id] = score
+        starts = np.searchsorted(others, chunk)
+        ends = np.searchsorted(others, chunk, side="right")
+        lists = {}
+        for movie_id, start, end in zip(chunk.tolist(), starts.tolist(), ends.tolist()):
+            new = dict(zip(movies[rows[start:end]].tolist(), scores[start:end].tolist()))
+            ranked = sorted({**stored[movie_id], **new}.items(), key=lambda item: (-item[1], item[0]))
+            lists[movie_id] = [(similar_id, score) for similar_id, score in ranked if score > 0][:top_k_count]
+        write_lists(db, lists)
+    return merged
+
+
+def read_versions(db, statement, size: int, missing: int):
+    # id -> version as an array indexed by movie id, ids past size are not rated
+    versions = np.full(size, missing, dtype=np.int64)
+    for rows in db.execute(statement).partitions(STREAM_CHUNK):
+        ids, values = pairs(rows)
+        keep = ids < size
+        versions[ids[keep]] = values[keep]
+    return versions
+
+
+def refresh_similarities(db, full: bool=False, top_k_count: int=SIMILAR_TOP_K, memory_mb: int=512,
+                         max_pairs: int=5_000_000, block: int=None, workdir: str=None, report=print):
+    start = time.perf_counter()
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="similarity-")
+    try:
+        # The versions are read before the ratings: a rating arriving in between makes
+        # the movie dirty again for the next run, it is never marked done too early
+        n_movies = (db.scalar(select(func.max(Movie.id))) or 0) + 1
+        versions = read_versions(db, select(Movie.id, Movie.ratings_version), n_movies, 0)
+        matrix = RatingsMatrix(db, workdir)
+        versions = versions[:matrix.n_movies]
+        done = read_versions(
+            db, select(SimilarityState.movie_id, SimilarityState.ratings_version), matrix.n_movies, -1)
+        counts = np.diff(matrix.movie_ptr)
+        rated = np.flatnonzero(counts)
+        dirty = rated if full else rated[done[rated] != versions[rated]]
+        is_dirty = np.zeros(matrix.n_movies, dtype=bool)
+        is_dirty[dirty] = True
+
+        # Lowest stored score of every full list, a new score below it cannot enter the list
+        threshold = np.zeros(matrix.n_movies, dtype=np.float32)
+        if not full:
+            lowest = db.execute(
+                select(MovieSimilarity.movie_id, func.min(MovieSimilarity.score))
+                .group_by(MovieSimilarity.movie_id)
+                .having(func.count() >= top_k_count)
+            ).all()
+            for movie_id, score in lowest:
+                if movie_id < matrix.n_movies:
+                    threshold[movie_id] = score
+
+        size = block or block_size(matrix.n_movies, memory_mb)
+        merged = np.zeros(matrix.n_movies, dtype=bool)
+        scored = 0
+        for movies in blocks(dirty, counts, size, max_pairs):
+            similarity = matrix.scores(movies, max_pairs)
+            write_lists(db, dict(zip(movies.tolist(), top_k(similarity, top_k_count))))
+            db.execute(
+                delete(SimilarityState).where(SimilarityState.movie_id.in_(movies.tolist()))
+                .execution_options(synchronize_session=False)
+            )
+            db.execute(insert(SimilarityState), [
+                {"movie_id": movie_id, "ratings_version": int(versions[movie_id])} for movie_id in movies.tolist()
+            ])
+            if not full:
+                merged[merge_block(db, movies, similarity, threshold, is_dirty, top_k_count)] = True
+            db.commit()
+            del similarity
+            scored += len(movies)
+            report(f"scored {scored}/{len(dirty)} movies")
+
+        # Lists of and entries for movies without ratings any more, or deleted (SQLite
+        # does not enforce the ON DELETE CASCADE)
+        db.execute(delete(MovieSimilarity).where(
+            ~exists().where(Rating.movie_id == MovieSimilarity.movie_id)
+            | ~exists().where(Rating.movie_id == MovieSimilarity.similar_movie_id)
+        ).execution_options(synchronize_session=False))
+        db.execute(
+            delete(SimilarityState).where(~exists().where(Movie.id == SimilarityState.movie_id))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    seconds = time.perf_counter() - start
+    return {"recomputed": len(dirty), "merged": int(merged.sum()), "seconds": seconds}
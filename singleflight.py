@@ -0,0 +1,73 @@
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Collapses concurrent calls with the same key into one: the first caller runs the
+    # function, callers arriving while it is in flight wait for and share its result.
+    # do() serves the threadpool (sync routes), do_async() the event loop (async routes).
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self.leaders = 0
+        self.collapsed = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.collapsed += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, fn):
+        # fn is a coroutine function. It runs as its own task so a cancelled caller
+        # does not cancel the result the others are waiting for, it must not use anything
+        # scoped to the first caller's request, such as its session.
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+            self.leaders += 1
+        else:
+            self.collapsed += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "leaders": self.leaders,
+            "collapsed": self.collapsed,
+            "in_flight": len(self._calls) + len(self._tasks),
+        }
+
+
+# Coalesces concurrent GET /movie/{id} lookups, keyed by movie id
+movie_flights = SingleFlight()
@@ -1,226 +1,999 @@
-import pytest, os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import pytest, os, threading, logging, uuid, json, queue, sys, asyncio
+from concurrent.futures import ThreadPoolExecutor
+import crud, database, datagen, schemas, similarity
+import numpy as np
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, event, func, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
 from fastapi.testclient import TestClient
-from database import Base, get_db
-from fastapi import HTTPException
+from database import Base, USE_ASYNC_DB, get_db
 from main import app
+from auth import create_access_token, principal_cache, token_claims
+from autocomplete import TitleIndex, title_index
+from content_index import build_content_index, content_index
+from recommendations import recommendation_store, train_recommendations
+from logging_config import JsonFormatter, NonBlockingQueueHandler
+from hashing import HashingService, hashing_service, pwd_context
+from response_cache import response_cache
+from pagination import encode_cursor
+from singleflight import SingleFlight
 import models
 
-# PostgreSQL setup
+# Test database, chosen in conftest.py: in-memory SQLite by default, TEST_DB_URL otherwise
 SQLALCHEMY_DATABASE_URL = os.getenv("DB_URL")
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if SQLALCHEMY_DATABASE_URL == "sqlite://":
+    # One connection shared by every thread, each new one would be an empty database
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=StaticPool, connect_args={"check_same_thread": False})
+else:
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
-# Override the get_db dependency to use the test database
-def override_get_db():
-    db = TestingSessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+if engine.dialect.name == "sqlite":
+    # pysqlite starts transactions on its own and breaks SAVEPOINT, let SQLAlchemy emit BEGIN
+    @event.listens_for(engine, "connect")
+    def _sqlite_autocommit(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _sqlite_begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+Base.metadata.create_all(bind=engine)
+
+# The async routes have their own engine and cannot join the test transaction
+ROLLBACK = not USE_ASYNC_DB
+
+PASSWORD = "testpass"
+# Hashed once at the cheap bcrypt cost set in conftest.py, fixture users skip signup
+HASHED_PASSWORD = pwd_context.hash(PASSWORD)
 
-app.dependency_overrides[get_db] = override_get_db
 
 @pytest.fixture(scope="module")
 def client():
     with TestClient(app) as c:
         yield c
 
-@pytest.fixture(scope="module")
-def setup_database():
-    Base.metadata.create_all(bind=engine)
-    yield
+
+@pytest.fixture(autouse=True)
+def db():
+    # Each test runs in a transaction rolled back at the end. Requests join it, their
+    # commits only release a savepoint, so no test sees another test's data.
+    connection = engine.connect()
+    transaction = connection.begin() if ROLLBACK else None
+    # Same session settings as database.SessionLocal
+    session_options = {
+        "bind": connection, "join_transaction_mode": "create_savepoint", "autoflush": False, "expire_on_commit": False,
+    }
+
+    def override_get_db():
+        db = Session(**session_options)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    principal_cache.clear()
+    response_cache.clear()
+    title_index.clear()
+    content_index.clear()
+    # Without expire_on_commit, fixture objects stay readable after commit without starting
+    # a new transaction, an open read transaction would lock out the async routes on SQLite
+    session = Session(**session_options)
+    try:
+        yield session
+    finally:
+        session.close()
+        if transaction is not None:
+            transaction.rollback()
+        connection.close()
+        app.dependency_overrides.pop(get_db, None)
+        principal_cache.clear()
+        response_cache.clear()
+
+
+@pytest.fixture
+def make_user(db):
+    def make_user(username=None):
+        username = username or f"user_{uuid.uuid4().hex[:12]}"
+        user = models.User(
+            username=username, full_name="Test User", email=f"{username}@example.com", hashed_password=HASHED_PASSWORD
+        )
+        db.add(user)
+        db.commit()
+        return user
+    return make_user
+
+
+@pytest.fixture
+def user(make_user):
+    return make_user()
+
+
+@pytest.fixture
+def headers(user):
+    return {"Authorization": f"Bearer {create_access_token(token_claims(user))}"}
+
+
+@pytest.fixture
+def make_movie(db, user):
+    def make_movie(title="Test Movie", owner=None):
+        movie = models.Movie(title=title, description="A test movie description", owner_id=(owner or user).id)
+        db.add(movie)
+        db.commit()
+        return movie
+    return make_movie
+
+
+@pytest.fixture
+def movie(make_movie):
+    return make_movie()
 
 
 # TEST CREATE USERS ENDPOINT
 @pytest.mark.parametrize("username, password, full_name, email", [("testuser", "testpass", "Test User", "testuser@example.com")])
-def test_signup(client, setup_database, username, password, full_name, email):
+def test_signup(client, username, password, full_name, email):
     response = client.post("/signup", json={"username": username, "password": password, "full_name": full_name, "email": email})
     assert response.status_code == 200
     data = response.json()
     assert data["username"] == username
 
+    response = client.post("/signup", json={"username": username, "password": password, "full_name": full_name, "email": email})
+    assert response.status_code == 400
+
+
+# TEST signup is shed with a 503 when the hashing pool is saturated
+def test_signup_sheds_when_hashing_saturated(client, monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(hashing_service, "_slots", slots)
+    rejected = hashing_service.rejected
+    response = client.post("/signup", json={"username": "shed", "password": "shedpass", "full_name": "Shed User", "email": "shed@example.com"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert hashing_service.rejected == rejected + 1
+
+
+# TEST hashes still queued at shutdown give their admission slots back
+def test_hashing_shutdown_releases_cancelled_slots():
+    service = HashingService(workers=1, queue_size=1)
+    started, release = threading.Event(), threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(5)
+        return "hashed", 0.5
+
+    service._executor = ThreadPoolExecutor(max_workers=1)
+    running = service._submit(blocking)
+    started.wait(5)
+    queued = service._submit(blocking)
+    service.shutdown()
+    release.set()
+    running.result(5)
+    assert queued.cancelled()
+    assert service.in_flight == 0 and service.completed == 1
+    assert service._slots.acquire(blocking=False) and service._slots.acquire(blocking=False)
+
 
 # TEST USERS LOGIN ENDPOINT
-@pytest.mark.parametrize("username, password", [("testuser", "testpass")])
-def test_login(client, setup_database, username, password):
-    response = client.post("/login", data={"username": username, "password": password})
+@pytest.mark.parametrize("password, status_code", [(PASSWORD, 200), ("wrongpass", 401)])
+def test_login(client, user, password, status_code):
+    response = client.post("/login", data={"username": user.username, "password": password})
+    assert response.status_code == status_code
+    if status_code == 200:
+        data = response.json()
+        assert "access_token" in data
+        assert data["token_type"] == "bearer"
+
+
+# TEST authenticated principals are cached between requests
+def test_principal_cache(client, headers):
+    hits, misses = principal_cache.hits, principal_cache.misses
+
+    movie_data = {"title": "Cached Principal Movie", "description": "principal cache"}
+    assert client.post("/movies", json=movie_data, headers=headers).status_code == 200
+    assert client.post("/movies", json=movie_data, headers=headers).status_code == 200
+    assert principal_cache.misses == misses + 1
+    assert principal_cache.hits == hits + 1
+
+
+# TEST writes are one INSERT each, nothing is read back after the commit
+@pytest.mark.parametrize("path, payload, statements", [
+    ("/movies", {"title": "One Statement", "description": "insert only"}, "1"),
+    ("/movies/{movie_id}/comments", {"text": "movie lookup and insert"}, "2"),
+    ("/comments/{comment_id}/reply", {"text": "parent lookup and insert"}, "2"),
+    ("/movies/{movie_id}/rate", {"movie_id": 0, "stars": 4}, "2"),
+])
+def test_write_statement_count(client, movie, headers, path, payload, statements):
+    comment = client.post(f"/movies/{movie.id}/comments", json={"text": "parent"}, headers=headers).json()
+    response = client.post(path.format(movie_id=movie.id, comment_id=comment["id"]), json=payload, headers=headers)
     assert response.status_code == 200
-    data = response.json()
-    assert "access_token" in data
-    assert data["token_type"] == "bearer"
+    assert response.json()["id"]
+    assert response.headers["X-SQL-Statements"] == statements
 
 
 # TEST USERS LIST  MOVIE ENDPOINT {AUTHENTICATED ACCESS}
-@pytest.mark.parametrize("username, password", [("testuser", "testpass")])
-def test_create_movie(client, setup_database, username, password):
-    response = client.post("/login", data={"username": username, "password": password})
-    assert response.status_code == 200
-    token = response.json()["access_token"]
-
+def test_create_movie(client, headers):
     # Create a movie
     movie_data = {"title": "Test Movie 2", "description": "A test movie description 2"}
-    response = client.post("/movies", json=movie_data, headers={"Authorization": f"Bearer {token}"})
+    response = client.post("/movies", json=movie_data, headers=headers)
     assert response.status_code == 200
     data = response.json()
     assert data["title"] == "Test Movie 2"
 
 
 # TEST VIEW ALL MOVIES {public access}
-@pytest.mark.parametrize("username, password", [("testuser", "testpass")])
-def test_view_all_movies(client, setup_database, username, password):
-    # Login to get a token
-    response = client.post("/login", data={"username": username, "password": password})
-    assert response.status_code == 200
-    print("============")
-    token = response.json()["access_token"]
-
+def test_view_all_movies(client, movie):
     # View all movies without authentication (public access)
-    response = client.get("/movies/")
+    response = client.get("/movies/", params={"limit": 100})
     assert response.status_code == 200
-    movies = response.json()
+    movies = response.json()["items"]
     assert len(movies) > 0  # Ensure there are movies in the database
 
     # Verify one of the movies is the one created earlier
-    assert any(movie["title"] == "Test Movie for Deletion" for movie in movies)
+    assert any(item["id"] == movie.id and item["title"] == movie.title for item in movies)
+
+
+# TEST keyset pagination of all movies {public access}
+@pytest.mark.parametrize("limit", [1, 2])
+def test_movies_pagination(client, make_movie, limit):
+    for n in range(5):
+        make_movie(title=f"Paged Movie {n}")
+    seen = []
+    after = None
+    while True:
+        params = {"limit": limit}
+        if after:
+            params["after"] = after
+        response = client.get("/movies/", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= limit
+        seen.extend(movie["id"] for movie in page["items"])
+        after = page["next_cursor"]
+        if after is None:
+            break
+    assert len(seen) >= 5
+    assert seen == sorted(seen)
+    assert len(seen) == len(set(seen))
+
+
+def test_movies_pagination_limits(client):
+    assert client.get("/movies/", params={"limit": 100000}).status_code == 422
+    assert client.get("/movies/", params={"after": "not-a-cursor"}).status_code == 400
+
+
+# TEST a tampered cursor key is a 400, not a query error
+@pytest.mark.parametrize("sort, key", [("title", ["x"]), ("title", 5), ("id", {"a": 1}), ("id", "1"), ("id", True)])
+def test_movies_pagination_tampered_cursor(client, sort, key):
+    response = client.get("/movies/", params={"sort": sort, "after": encode_cursor(sort, key, 1)})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
 
 
 # TEST GET A MOVIE {public access}
-@pytest.mark.parametrize("movie_id", [1])  # Assuming the movie ID to be tested
-def test_get_specific_movie(client, setup_database, movie_id):
+def test_get_specific_movie(client, movie):
     # Get a specific movie by ID (public access)
-    response = client.get(f"/movie/{movie_id}")
+    response = client.get(f"/movie/{movie.id}")
     assert response.status_code == 200
     data = response.json()
-    assert data["id"] == movie_id
+    assert data["id"] == movie.id
     assert "title" in data
     assert "description" in data
 
 
-# TEST Edit a movie (only by the user who listed it)
-@pytest.mark.parametrize("username, password", [("testuser4", "testpass4")])
-def test_edit_movie(client, setup_database, username, password):
-    # Login to get a token
-    response = client.post("/login", data={"username": username, "password": password})
+# TEST movie reads load the owner in the same statement (no N+1 lazy loads)
+def test_movie_reads_statement_count(client, movie):
+    response = client.get(f"/movie/{movie.id}")
     assert response.status_code == 200
-    token = response.json()["access_token"]
+    assert response.json()["owner"]["id"] == response.json()["owner_id"]
+    assert response.headers["X-SQL-Statements"] == "1"
 
+    response = client.get("/movies/", params={"limit": 50})
+    assert response.status_code == 200
+    assert response.headers["X-SQL-Statements"] == "1"
+
+
+# TEST public reads are cached and writes invalidate them
+def test_response_cache(client, headers):
+    movie = client.post("/movies", json={"title": "Cached", "description": "cache me"}, headers=headers).json()
+
+    first = client.get(f"/movie/{movie['id']}")
+    second = client.get(f"/movie/{movie['id']}")
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.headers["X-SQL-Statements"] == "0"
+    assert second.json() == first.json()
+
+    client.put(f"/movies/{movie['id']}", json={"title": "Cached again"}, headers=headers)
+    response = client.get(f"/movie/{movie['id']}")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.json()["title"] == "Cached again"
+
+    # A rating invalidates the movie, the list stays cached until its TTL
+    assert client.get("/movies/").headers["X-Cache"] == "MISS"
+    client.post(f"/movies/{movie['id']}/rate", json={"movie_id": movie["id"], "stars": 3}, headers=headers)
+    assert client.get(f"/movie/{movie['id']}").json()["rating_count"] == 1
+    assert client.get("/movies/").headers["X-Cache"] == "HIT"
+    assert response_cache.stats()["hits"] >= 1
+
+
+# TEST per-route request metrics are exposed in Prometheus format, cache hits included
+def test_metrics(client, movie):
+    client.get(f"/movie/{movie.id}")
+    client.get(f"/movie/{movie.id}")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/movie/{movie_id}"}' in response.text
+    assert 'http_responses_total{method="GET",route="/movie/{movie_id}",status="200"}' in response.text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/movie/{movie_id}",le="+Inf"}' in response.text
+    assert "password_hash_in_flight" in response.text
+    assert "response_cache_hits_total" in response.text
+
+
+# TEST per-request SQL timing header and the slow query log
+def test_server_timing_and_slow_query_log(client, movie, monkeypatch, caplog):
+    monkeypatch.setattr(database, "SLOW_QUERY_MS", 0)
+    with caplog.at_level(logging.WARNING, logger="slow_query"):
+        response = client.get(f"/movie/{movie.id}")
+    assert response.status_code == 200
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+    assert 'desc="1 statements"' in response.headers["Server-Timing"]
+    assert any(f"GET /movie/{movie.id}" in record.getMessage() for record in caplog.records)
+    assert database.normalize_sql("SELECT *\n FROM t WHERE id IN (?, ?, ?)") == "SELECT * FROM t WHERE id IN (...)"
+    assert database.parameter_shape({"id": 1, "title": "x"}) == "{id: int, title: str}"
+
+
+# TEST queued log records carry their message as formatted when logged
+def test_queue_handler_merges_args():
+    log_queue = queue.Queue()
+    handler = NonBlockingQueueHandler(log_queue)
+    genres = ["drama"]
+    handler.handle(logging.LogRecord("app", logging.INFO, __file__, 1, "Genres: %s", (genres,), None))
+    genres.append("comedy")
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        handler.handle(logging.LogRecord("app", logging.ERROR, __file__, 1, "Failed %d", (1,), sys.exc_info()))
+    record, failure = log_queue.get_nowait(), log_queue.get_nowait()
+    assert (record.msg, record.args) == ("Genres: ['drama']", None)
+    assert failure.exc_info is None
+    entry = json.loads(JsonFormatter().format(failure))
+    assert entry["message"] == "Failed 1" and "ValueError: boom" in entry["exc_info"]
+
+
+# TEST a cancelled first lookup does not fail the lookups waiting on its fetch
+@pytest.mark.skipif(not USE_ASYNC_DB, reason="async routes only")
+def test_movie_flight_survives_cancelled_leader(client, make_movie, monkeypatch):
+    import async_crud, async_routes
+    movie = make_movie(title="Flight")
+    fetch = async_crud.get_movie_json
+
+    async def scenario():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_fetch(db, movie_id):
+            started.set()
+            await release.wait()
+            return await fetch(db, movie_id)
+
+        monkeypatch.setattr(async_crud, "get_movie_json", slow_fetch)
+        leader = asyncio.ensure_future(async_routes.get_movie(movie.id))
+        await started.wait()
+        follower = asyncio.ensure_future(async_routes.get_movie(movie.id))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        response = await follower
+        return leader.cancelled(), json.loads(response.body)
+
+    cancelled, body = client.portal.call(scenario)
+    assert cancelled
+    assert body["title"] == "Flight"
+
+
+# TEST concurrent identical lookups share one call
+def test_single_flight_collapses_concurrent_calls():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return "movie"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do(1, fetch))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while flights.collapsed < 7:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ["movie"] * 8
+    assert flights.stats() == {"leaders": 1, "collapsed": 7, "in_flight": 0}
+
+
+# TEST Edit a movie (only by the user who listed it)
+def test_edit_movie(client, movie, headers, make_user):
     # Edit a movie (only by the user who listed it)
-    movie_id = 2  # Assuming the movie ID to be tested
     response = client.put(
-        f"/movies/{movie_id}",
+        f"/movies/{movie.id}",
         json={"title": "Updated Title", "description": "Updated Description"},
-        headers={"Authorization": f"Bearer {token}"}
+        headers=headers
     )
     assert response.status_code == 200
     data = response.json()
     assert data["title"] == "Updated Title"
     assert data["description"] == "Updated Description"
 
+    assert data["owner"]["id"] == movie.owner_id
+
+    # Owner check and new row in the same UPDATE ... RETURNING (the principal is cached by now)
+    response = client.put(f"/movies/{movie.id}", json={"title": "Updated Again"}, headers=headers)
+    assert response.json()["title"] == "Updated Again"
+    assert response.json()["description"] == "Updated Description"
+    assert response.headers["X-SQL-Statements"] == "1"
+
+    other = {"Authorization": f"Bearer {create_access_token(token_claims(make_user()))}"}
+    response = client.put(f"/movies/{movie.id}", json={"title": "Not Mine"}, headers=other)
+    assert response.status_code == 403
+    assert client.put("/movies/999999", json={"title": "Missing"}, headers=headers).status_code == 404
+
 
 # Delete a movie (only by the user who listed it)
-@pytest.mark.parametrize("username, password", [("testuser4", "testpass4")])
-def test_delete_movie(client, setup_database, username, password):
-    response = client.post("/login", data={"username": username, "password": password})
-    assert response.status_code == 200
-    token = response.json()["access_token"]
+def test_delete_movie(client, movie, headers, make_user):
+    other = {"Authorization": f"Bearer {create_access_token(token_claims(make_user()))}"}
+    assert client.delete(f"/movies/{movie.id}", headers=other).status_code == 403
+    assert client.delete("/movies/999999", headers=headers).status_code == 404
 
-    # Delete a movie
-    movie_id = 2  # Use an existing movie ID or create one in the setup
-    response = client.delete(f"/movies/{movie_id}", headers={"Authorization": f"Bearer {token}"})
+    client.post(f"/movies/{movie.id}/rate", json={"movie_id": movie.id, "stars": 4}, headers=headers)
+    response = client.delete(f"/movies/{movie.id}", headers=headers)
     assert response.status_code == 200
     assert response.json() == ["Movie Deleted Successfully"]
+    assert client.get(f"/movie/{movie.id}").status_code == 404
 
 
 # TEST Rate a movie (authenticated access)
-@pytest.mark.parametrize("username, password, movie_id, stars, comment", [
-    ("testuser", "testpass", 1, 5, "Great movie!")  # Assuming movie ID 1 and a 5-star rating with a comment
-])
-def test_rate_movie(client, setup_database, username, password, movie_id, stars, comment):
-    # Login to get a token
-    response = client.post("/login", data={"username": username, "password": password})
-    assert response.status_code == 200
-    token = response.json()["access_token"]
-
+@pytest.mark.parametrize("stars, comment", [(5, "Great movie!")])
+def test_rate_movie(client, movie, headers, stars, comment):
     # Rate the movie with the authenticated user
-    rating_data = {"movie_id": movie_id, "stars": stars, "comment": comment}
-    response = client.post(
-        f"/movies/{movie_id}/rate",
-        json=rating_data,
-        headers={"Authorization": f"Bearer {token}"}
-    )
-    
+    rating_data = {"movie_id": movie.id, "stars": stars, "comment": comment}
+    response = client.post(f"/movies/{movie.id}/rate", json=rating_data, headers=headers)
+
     # Check the response
     assert response.status_code == 200
     data = response.json()
-    assert data["movie_id"] == movie_id
+    assert data["movie_id"] == movie.id
     assert data["user_id"] is not None  # Ensure a user ID is associated with the rating
     assert data["stars"] == stars
     assert data["comment"] == comment
 
 
+# TEST rating again replaces the user's rating and moves the aggregates by the difference
+def test_rate_movie_again(client, movie, headers):
+    first = client.post(f"/movies/{movie.id}/rate", json={"movie_id": movie.id, "stars": 2}, headers=headers)
+    assert first.json()["created"] is True
+
+    second = client.post(f"/movies/{movie.id}/rate", json={"movie_id": movie.id, "stars": 5, "comment": "better"},
+                         headers=headers)
+    assert second.status_code == 200
+    assert second.json()["created"] is False
+    assert second.json()["id"] == first.json()["id"]
+    assert second.headers["X-SQL-Statements"] == "4"
+    # Same stars again, nothing to add to the aggregates
+    third = client.post(f"/movies/{movie.id}/rate", json={"movie_id": movie.id, "stars": 5}, headers=headers)
+    assert third.headers["X-SQL-Statements"] == "3"
+
+    ratings = client.get(f"/movies/{movie.id}/ratings/").json()
+    assert [(rating["stars"], rating["comment"]) for rating in ratings] == [(5, None)]
+    summary = client.get(f"/movies/{movie.id}/rating-summary").json()
+    assert (summary["rating_count"], summary["rating_sum"]) == (1, 5)
+    assert summary["histogram"] == {"0": 0, "1": 0, "2": 0, "3": 0, "4": 0, "5": 1}
+
+
+def test_rate_missing_movie(client, headers):
+    response = client.post("/movies/999999/rate", json={"movie_id": 999999, "stars": 3}, headers=headers)
+    assert response.status_code == 404
+
+
 # TEST Get ratings for a movie
-@pytest.mark.parametrize("movie_id", [1])  # Assuming the movie ID to be tested
-def test_get_movie_ratings(client, setup_database, movie_id):
-    response = client.get(f"/movies/{movie_id}/ratings/")
+def test_get_movie_ratings(client, movie, headers):
+    client.post(f"/movies/{movie.id}/rate", json={"movie_id": movie.id, "stars": 4}, headers=headers)
+    response = client.get(f"/movies/{movie.id}/ratings/")
     assert response.status_code == 200
     ratings = response.json()
     assert isinstance(ratings, list)  # Ensure it returns a list of ratings
-    if ratings:  # If there are ratings
-        assert all('stars' in rating for rating in ratings)  # Check that 'stars' field is in each rating
-        assert all('user_id' in rating for rating in ratings)  # Check that 'user_id' field is in each rating
+    assert len(ratings) == 1
+    assert all('stars' in rating for rating in ratings)  # Check that 'stars' field is in each rating
+    assert all('user_id' in rating for rating in ratings)  # Check that 'user_id' field is in each rating
+
+
+# TEST rating summary matches the ratings of the movie
+@pytest.mark.parametrize("stars", [[5, 3, 3, 0]])
+def test_rating_summary(client, movie, headers, stars):
+    for value in stars:
+        client.post(f"/movies/{movie.id}/rate", json={"movie_id": movie.id, "stars": value}, headers=headers)
+    ratings = client.get(f"/movies/{movie.id}/ratings/").json()
+    response = client.get(f"/movies/{movie.id}/rating-summary")
+    assert response.status_code == 200
+    summary = response.json()
+    assert summary["rating_count"] == len(ratings)
+    assert summary["rating_sum"] == sum(rating["stars"] for rating in ratings)
+    assert sum(summary["histogram"].values()) == len(ratings)
+    assert response.headers["X-SQL-Statements"] == "1"
 
+    movie = client.get(f"/movie/{movie.id}").json()
+    assert movie["rating_count"] == summary["rating_count"]
+    assert movie["average_rating"] == summary["average_rating"]
+
+
+def test_rating_summary_not_found(client):
+    assert client.get("/movies/999999/rating-summary").status_code == 404
 
-# TEST Add a comment to a movie (authenticated access)
-@pytest.mark.parametrize("username, password, movie_id, text", [
-    ("testuser", "testpass", 1, "This is a test comment for the movie")  # Assuming movie ID 1
-])
-def test_add_comment_to_movie(client, setup_database, username, password, movie_id, text):
-    # Login to get a token
-    response = client.post("/login", data={"username": username, "password": password})
-    assert response.status_code == 200
-    token = response.json()["access_token"]
 
+# TEST Add a comment to a movie (authenticated access)
+@pytest.mark.parametrize("text", ["This is a test comment for the movie"])
+def test_add_comment_to_movie(client, movie, headers, text):
     # Add a comment to the movie
     comment_data = {"text": text}
-    response = client.post(
-        f"/movies/{movie_id}/comments",
-        json=comment_data,
-        headers={"Authorization": f"Bearer {token}"}
-    )
+    response = client.post(f"/movies/{movie.id}/comments", json=comment_data, headers=headers)
     assert response.status_code == 200
     data = response.json()
     assert data["text"] == text
-    assert data["movie_id"] == movie_id
+    assert data["movie_id"] == movie.id
 
 
 # TEST View comments for a movie (public access)
-@pytest.mark.parametrize("movie_id", [1])
-def test_view_comments_for_movie(client, setup_database, movie_id):
-    response = client.get(f"/movies/{movie_id}/comments")
+def test_view_comments_for_movie(client, movie, headers):
+    client.post(f"/movies/{movie.id}/comments", json={"text": "a comment"}, headers=headers)
+    response = client.get(f"/movies/{movie.id}/comments")
     assert response.status_code == 200
     comments = response.json()
     assert isinstance(comments, list)
-    if comments:
-        assert all('text' in comment for comment in comments)
-        assert all('id' in comment for comment in comments)
-        assert all('movie_id' in comment for comment in comments)
-        assert all('parent_comment_id' in comment for comment in comments)
-        assert all('children' in comment for comment in comments)  # If you include 'children' in the response
-    else:
-        assert comments == []
+    assert len(comments) == 1
+    assert all('text' in comment for comment in comments)
+    assert all('id' in comment for comment in comments)
+    assert all('movie_id' in comment for comment in comments)
+    assert all('parent_comment_id' in comment for comment in comments)
+    assert all('children' in comment for comment in comments)  # If you include 'children' in the response
 
 
 # TEST View nested comments (public access)
-@pytest.mark.parametrize("movie_id", [1])  # Assuming the movie ID to be tested
-def test_view_nested_comments(client, setup_database, movie_id):
-    response = client.get(f"/movies/{movie_id}/comments")
+def test_view_nested_comments(client, movie, headers):
+    root = client.post(f"/movies/{movie.id}/comments", json={"text": "root"}, headers=headers).json()
+    client.post(f"/comments/{root['id']}/reply", json={"text": "reply"}, headers=headers)
+    response = client.get(f"/movies/{movie.id}/comments")
     assert response.status_code == 200
     comments = response.json()
     assert isinstance(comments, list)  # Ensure it returns a list of comments
-    if comments:  # If there are comments
-        for comment in comments:
-            assert "children" in comment  # Check if nested comments exist
-            if comment["children"]:
-                assert isinstance(comment["children"], list)  # Nested comments should be a list
+    for comment in comments:
+        assert "children" in comment  # Check if nested comments exist
+        assert isinstance(comment["children"], list)  # Nested comments should be a list
+    assert comments[0]["children"][0]["text"] == "reply"
+
+
+# TEST comment threads come back as a tree of roots built from one query
+def test_comment_thread(client, movie, headers):
+    movie_id = movie.id
+    root = client.post(f"/movies/{movie_id}/comments", json={"text": "thread root"}, headers=headers).json()
+    reply = client.post(f"/comments/{root['id']}/reply", json={"text": "first reply"}, headers=headers).json()
+    assert reply["parent_comment_id"] == root["id"]
+    nested = client.post(f"/comments/{reply['id']}/reply", json={"text": "nested reply"}, headers=headers).json()
+
+    response = client.get(f"/movies/{movie_id}/comments")
+    assert response.status_code == 200
+    assert response.headers["X-SQL-Statements"] == "1"
+    comments = response.json()
+    assert all(comment["parent_comment_id"] is None for comment in comments)
+    thread = next(comment for comment in comments if comment["id"] == root["id"])
+    assert thread["children"][0]["id"] == reply["id"]
+    assert thread["children"][0]["children"][0]["id"] == nested["id"]
+
+    comments = client.get(f"/movies/{movie_id}/comments", params={"max_depth": 1}).json()
+    thread = next(comment for comment in comments if comment["id"] == root["id"])
+    assert thread["children"][0]["children"] == []
+
+    client.post(f"/movies/{movie_id}/comments", json={"text": "second root"}, headers=headers)
+    comments = client.get(f"/movies/{movie_id}/comments", params={"limit": 1, "max_depth": 0}).json()
+    assert len(comments) == 1
+    assert comments[0]["children"] == []
+
+
+# TEST the synthetic data generator splits ratings over users as a power law, within the cap
+@pytest.mark.parametrize("total, n, cap", [(1000, 50, 100), (500, 10, 50), (0, 5, 10)])
+def test_datagen_allocate(total, n, cap):
+    counts = datagen.allocate(total, n, 1.1, cap)
+    assert sum(counts) == min(total, n * cap)
+    assert max(counts) <= cap
+    assert counts == sorted(counts, reverse=True)
+
+
+# TEST search ranks title matches first, pages by rank and follows edits and deletes
+def test_search_movies(client, db, make_movie, headers):
+    word = f"zeta{uuid.uuid4().hex[:8]}"
+    in_description = make_movie(title="Unrelated")
+    in_description.description = f"mentions {word} once"
+    db.commit()
+    in_title = make_movie(title=f"The {word.title()} Affair")
+    make_movie(title="Nothing To See")
+
+    response = client.get("/movies/search", params={"q": f"{word}!"})
+    assert response.status_code == 200
+    assert [movie["id"] for movie in response.json()["items"]] == [in_title.id, in_description.id]
+
+    first = client.get("/movies/search", params={"q": word, "limit": 1}).json()
+    second = client.get("/movies/search", params={"q": word, "limit": 1, "after": first["next_cursor"]}).json()
+    assert [movie["id"] for movie in first["items"] + second["items"]] == [in_title.id, in_description.id]
+    assert second["next_cursor"] is None
+
+    client.put(f"/movies/{in_title.id}", json={"title": "Renamed"}, headers=headers)
+    client.delete(f"/movies/{in_description.id}", headers=headers)
+    assert client.get("/movies/search", params={"q": word}).json()["items"] == []
+
+
+# TEST a search cursor with a tampered rank is a 400, not a query error
+@pytest.mark.parametrize("rank", ["high", [1.5], None, True, float("nan")])
+def test_search_movies_tampered_cursor(client, rank):
+    response = client.get("/movies/search", params={"q": "space", "after": encode_cursor("rank", rank, 1)})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
+@pytest.mark.parametrize("params, status", [({"q": "?!"}, 200), ({"q": ""}, 422), ({"q": "x", "after": "bad"}, 400)])
+def test_search_movies_input(client, params, status):
+    response = client.get("/movies/search", params=params)
+    assert response.status_code == status
+    if status == 200:
+        assert response.json() == {"items": [], "next_cursor": None}
+
+
+# TEST autocomplete suggests by title prefix, most rated first, and follows the writes
+def test_autocomplete(client, db, make_movie, headers):
+    prefix = f"Auto{uuid.uuid4().hex[:8]}"
+    quiet = make_movie(title=f"{prefix} Quiet")
+    popular = make_movie(title=f"{prefix.lower()}  Popular")
+    popular.rating_count = 3
+    db.commit()
+    make_movie(title=f"Not {prefix}")
+
+    def suggest(text):
+        response = client.get("/movies/autocomplete", params={"prefix": text})
+        assert response.status_code == 200
+        return [movie["title"] for movie in response.json()]
+
+    assert suggest(prefix.upper()) == [popular.title, quiet.title]
+    assert suggest(f"{prefix} q") == [quiet.title]
+
+    created = client.post("/movies", json={"title": f"{prefix} New", "description": "new"}, headers=headers).json()
+    for stars in (4, 5):
+        client.post(f"/movies/{created['id']}/rate", json={"movie_id": created["id"], "stars": stars}, headers=headers)
+    assert suggest(prefix) == [popular.title, f"{prefix} New", quiet.title]
+
+    client.put(f"/movies/{created['id']}", json={"title": "Renamed"}, headers=headers)
+    client.delete(f"/movies/{quiet.id}", headers=headers)
+    assert suggest(prefix) == [popular.title]
+    assert suggest("renamed")[:1] == ["Renamed"]
+
+
+# TEST the first lookup builds the index once, on a worker thread rather than the event loop
+def test_autocomplete_builds_off_the_event_loop(client, make_movie, monkeypatch):
+    make_movie(title="Threaded")
+    title_index.clear()
+    build = title_index.build
+    loops = []
+
+    def recording_build(rows):
+        try:
+            loops.append(asyncio.get_running_loop())
+        except RuntimeError:
+            loops.append(None)
+        build(rows)
+
+    monkeypatch.setattr(title_index, "build", recording_build)
+    for _ in range(2):
+        response = client.get("/movies/autocomplete", params={"prefix": "thread"})
+        assert [movie["title"] for movie in response.json()] == ["Threaded"]
+    assert loops == [None]
+
+
+# TEST writes made while a build reads its rows are applied to the built index
+def test_title_index_writes_during_build():
+    index = TitleIndex()
+    index.add(9, "Before Any Build")
+    index.start_build()
+    index.add(5, "Late Arrival")
+    index.remove(1)
+    index.rated(2, 4)
+    index.build([(1, "Gone Movie", 0), (2, "Kept Movie", 1)])
+    assert [movie["id"] for movie in index.suggest("late")] == [5]
+    assert index.suggest("gone") == [] and index.suggest("before") == []
+    assert index.suggest("kept")[0]["rating_count"] == 5
+    index.add(6, "Later Still")
+    assert [movie["id"] for movie in index.suggest("later")] == [6]
+
+
+# TEST cached suggestions of large prefixes are dropped when a title change can affect them
+def test_title_index_cache():
+    index = TitleIndex(scan_limit=1, max_limit=2)
+    index.build([(1, "Star A", 5), (2, "Star B", 3), (3, "Star C", 1)])
+    assert [movie["id"] for movie in index.suggest("st")] == [1, 2]
+    assert index.stats()["cached_prefixes"] == 1
+    index.rated(3)
+    assert index.stats()["cached_prefixes"] == 1
+    index.rated(3, 3)
+    assert [movie["id"] for movie in index.suggest("st")] == [1, 3]
+    index.remove(1)
+    index.add(4, "Starling", 9)
+    assert [movie["id"] for movie in index.suggest("star")] == [4, 3]
+    assert [movie["id"] for movie in index.suggest("star ")] == [3, 2]
+
+
+# TEST similar movies come from the precomputed lists, most similar first, in one lookup
+def test_similar_movies(client, db, make_movie, make_user, headers, tmp_path):
+    target, close, far, unrated = (make_movie(title=title) for title in ("Target", "Close", "Far", "Unrated"))
+    fans = [make_user() for _ in range(3)]
+    for fan, stars in zip(fans, (5, 4, 1)):
+        db.add_all([
+            models.Rating(movie_id=target.id, user_id=fan.id, stars=stars),
+            models.Rating(movie_id=close.id, user_id=fan.id, stars=stars),
+        ])
+    db.add(models.Rating(movie_id=far.id, user_id=fans[2].id, stars=5))
+    db.commit()
+    assert client.get(f"/movies/{target.id}/similar").json() == []
+
+    similarity.refresh_similarities(db, workdir=str(tmp_path), report=lambda line: None)
+    response_cache.clear()  # the job does not invalidate, cached lists expire after RESPONSE_CACHE_TTL
+    response = client.get(f"/movies/{target.id}/similar")
+    assert response.status_code == 200
+    assert response.headers["X-SQL-Statements"] == "1"
+    assert [(movie["id"], round(movie["score"], 4)) for movie in response.json()] == [(close.id, 1.0), (far.id, 0.1543)]
+    assert client.get(f"/movies/{target.id}/similar", params={"limit": 1}).json()[0]["title"] == "Close"
+    assert client.get(f"/movies/{unrated.id}/similar").json() == []
+
+
+def cosine_scores(db):
+    # Dense cosine similarity of every pair of movies, the reference for the batch job
+    ratings = np.array(db.execute(
+        select(models.Rating.user_id, models.Rating.movie_id, models.Rating.stars)
+        .where(models.Rating.user_id.is_not(None), models.Rating.movie_id.is_not(None))
+    ).all())
+    matrix = np.zeros((ratings[:, 0].max() + 1, ratings[:, 1].max() + 1))
+    matrix[ratings[:, 0], ratings[:, 1]] = ratings[:, 2]
+    norms = np.linalg.norm(matrix, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.nan_to_num(matrix.T @ matrix / np.outer(norms, norms))
+    np.fill_diagonal(scores, 0)
+    return scores
+
+
+def stored_lists(db):
+    lists = {}
+    rows = db.execute(select(models.MovieSimilarity).order_by(models.MovieSimilarity.movie_id, models.MovieSimilarity.rank))
+    for row in rows.scalars():
+        lists.setdefault(row.movie_id, []).append((row.similar_movie_id, row.score))
+    return lists
+
+
+# TEST the batch job matches a dense computation, in small blocks and pair slices too, and an
+# incremental run after new ratings only stores current scores
+@pytest.mark.parametrize("block, max_pairs", [(None, 5_000_000), (1, 1), (7, 100)])
+def test_refresh_similarities(db, tmp_path, block, max_pairs):
+    datagen.generate(users=30, movies=40, ratings=400, comments=0, seed=2, batch=250, report=lambda line: None, db=db)
+    options = {"top_k_count": 5, "block": block, "max_pairs": max_pairs, "workdir": str(tmp_path), "report": lambda line: None}
+    similarity.refresh_similarities(db, full=True, **options)
+    scores = cosine_scores(db)
+    lists = stored_lists(db)
+    for movie_id in db.scalars(select(models.Rating.movie_id).where(models.Rating.movie_id.is_not(None)).distinct()):
+        expected = sorted(scores[movie_id][scores[movie_id] > 0], reverse=True)[:5]
+        assert [score for _, score in lists.get(movie_id, [])] == pytest.approx(expected, abs=1e-5)
+
+    # New ratings bump the movies' ratings_version, only those are recomputed
+    movie_ids = db.scalars(select(models.Movie.id).order_by(models.Movie.id).limit(3)).all()
+    user_id = db.scalar(select(func.max(models.User.id)))
+    for movie_id in movie_ids:
+        crud.upsert_rating(db, schemas.RatingCreate(movie_id=movie_id, stars=5), user_id)
+    result = similarity.refresh_similarities(db, **options)
+    assert result["recomputed"] == len(movie_ids)
+    scores = cosine_scores(db)
+    lists = stored_lists(db)
+    for movie_id, neighbours in lists.items():
+        assert [score for _, score in neighbours] == sorted((score for _, score in neighbours), reverse=True)
+        assert [score for _, score in neighbours] == pytest.approx([scores[movie_id, other] for other, _ in neighbours], abs=1e-5)
+    for movie_id in movie_ids:
+        expected = sorted(scores[movie_id][scores[movie_id] > 0], reverse=True)[:5]
+        assert [score for _, score in lists.get(movie_id, [])] == pytest.approx(expected, abs=1e-5)
+    assert similarity.refresh_similarities(db, **options)["recomputed"] == 0
+
+
+# TEST recommendations come from the trained model, best first, without the user's rated movies
+@pytest.mark.parametrize("workers", [1, 2])
+def test_recommendations(client, db, user, headers, make_user, tmp_path, monkeypatch, workers):
+    datagen.generate(users=30, movies=40, ratings=400, comments=0, seed=3, batch=250, report=lambda line: None, db=db)
+    movie_ids = db.scalars(select(models.Movie.id).order_by(models.Movie.id).limit(5)).all()
+    db.add_all([models.Rating(movie_id=movie_id, user_id=user.id, stars=5) for movie_id in movie_ids])
+    db.commit()
+    result = train_recommendations(db, factors=4, iterations=5, workers=workers, top_n=10, directory=str(tmp_path),
+                                   report=lambda line: None)
+    stars = np.array(db.scalars(select(models.Rating.stars).where(models.Rating.movie_id.is_not(None))).all())
+    assert result["rmse"] < stars.std()
+    db.commit()  # ends the read transaction, it would lock out the async routes on SQLite
+    monkeypatch.setattr(recommendation_store, "directory", str(tmp_path))
+
+    response = client.get("/me/recommendations", headers=headers)
+    assert response.status_code == 200
+    recommended = response.json()
+    assert 0 < len(recommended) <= 10
+    assert not {movie["id"] for movie in recommended} & set(movie_ids)
+    assert [movie["score"] for movie in recommended] == sorted((movie["score"] for movie in recommended), reverse=True)
+
+    # Rated since training, left out; the stored list runs out and the factors take over
+    first = recommended[0]["id"]
+    client.post(f"/movies/{first}/rate", json={"movie_id": first, "stars": 4}, headers=headers)
+    again = client.get("/me/recommendations", params={"limit": 10}, headers=headers).json()
+    assert first not in {movie["id"] for movie in again}
+    assert [movie["id"] for movie in again][:len(recommended) - 1] == [movie["id"] for movie in recommended[1:]]
+
+    newcomer = make_user()
+    newcomer_headers = {"Authorization": f"Bearer {create_access_token(token_claims(newcomer))}"}
+    assert client.get("/me/recommendations", headers=newcomer_headers).json() == []
+    assert client.get("/me/recommendations").status_code == 401
+
+
+# TEST similar movies by description, from the built index and from the movies written since
+def test_similar_content(client, db, headers, tmp_path, monkeypatch):
+    space, pirate, heist = (f"{word}{uuid.uuid4().hex[:6]}" for word in ("space", "pirate", "heist"))
+
+    def create(description):
+        return client.post("/movies", json={"title": "Untitled", "description": description}, headers=headers).json()["id"]
+
+    def similar(movie_id):
+        response_cache.clear()
+        response = client.get(f"/movies/{movie_id}/similar-content")
+        assert response.status_code == 200
+        return [movie["id"] for movie in response.json()]
+
+    voyage = create(f"The {space} {pirate} crew sails the {space} between stars")
+    raiders = create(f"{pirate} raiders of {space}")
+    crew = create(f"A {pirate} crew")
+    bank = create(f"A {heist} in a quiet bank, the {heist} of the century")
+    assert similar(voyage) == []  # no build yet
+
+    monkeypatch.setattr(content_index, "directory", str(tmp_path))
+    build_content_index(db, directory=str(tmp_path), report=lambda line: None)
+    db.commit()  # ends the read transaction, it would lock out the async routes on SQLite
+    assert similar(voyage) == [raiders, crew]
+    assert similar(bank) == []
+    response = client.get(f"/movies/{voyage}/similar-content", params={"limit": 1})
+    assert response.headers["X-SQL-Statements"] == "1"
+    assert [(movie["id"], movie["title"]) for movie in response.json()] == [(raiders, "Untitled")]
+    assert 0 < response.json()[0]["score"] <= 1
+
+    later = create(f"{space} {pirate} {space}")
+    client.put(f"/movies/{raiders}", json={"description": f"Another {heist}"}, headers=headers)
+    client.delete(f"/movies/{crew}", headers=headers)
+    assert similar(voyage) == [later]
+    assert similar(bank) == [raiders]
+    assert client.get("/movies/999999999/similar-content").json() == []
+
+
+# TEST writes recorded after a build started reading are kept when the build is loaded, and the
+# delta stops growing at its limit
+def test_content_index_delta(client, db, headers, tmp_path, monkeypatch, caplog):
+    space, pirate, heist = (f"{word}{uuid.uuid4().hex[:6]}" for word in ("space", "pirate", "heist"))
+
+    def create(description):
+        return client.post("/movies", json={"title": "Untitled", "description": description}, headers=headers).json()["id"]
+
+    voyage = create(f"The {space} of {pirate}")
+    raiders = create(f"{pirate} {space} {space}")
+    crew = create(f"A {pirate}")
+    bank = create(f"A {heist}")
+    monkeypatch.setattr(content_index, "directory", str(tmp_path))
+    build_content_index(db, directory=str(tmp_path), report=lambda line: None)
+    db.commit()
+    assert [movie for movie, _ in content_index.similar(voyage)] == [raiders, crew]
+
+    def write_during_read(line):
+        # The next build has read the rows and is not published yet
+        content_index.add(raiders, f"{heist} {heist}")
+        content_index.remove(crew)
+
+    build_content_index(db, directory=str(tmp_path), report=write_during_read)
+    db.commit()
+    assert content_index.similar(voyage) == []
+    assert [movie for movie, _ in content_index.similar(bank)] == [raiders]
+
+    monkeypatch.setattr(content_index, "delta_limit", 1)
+    with caplog.at_level(logging.WARNING, logger="content_index"):
+        content_index.add(voyage, f"A {heist}")
+    assert "delta is full" in caplog.text
+    assert content_index.stats()["delta_movies"] == 1
+    assert content_index.similar(voyage) == []
+    assert [movie for movie, _ in content_index.similar(bank)] == [raiders]
+
+
+def migrate(migration_engine, fn, revision: str):
+    config = Config()
+    config.set_main_option("script_location", os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations"))
+    with migration_engine.connect() as connection:
+        config.attributes["connection"] = connection
+        fn(config, revision)
+
+
+# TEST the migrations build exactly the schema of the models
+def test_migrations_match_models(tmp_path):
+    migration_engine = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    migrate(migration_engine, command.upgrade, "head")
+    with migration_engine.connect() as connection:
+        context = MigrationContext.configure(connection, opts={"include_name": models.include_in_autogenerate})
+        assert compare_metadata(context, Base.metadata) == []
+    migrate(migration_engine, command.downgrade, "base")
+    migration_engine.dispose()
+
+
+# TEST a database from before migrations, stamped at the baseline, is upgraded with its data:
+# duplicate ratings dropped, aggregates filled, later indexes created
+def test_migrations_upgrade_baseline_data(tmp_path):
+    migration_engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    migrate(migration_engine, command.upgrade, "0001_baseline")
+    with migration_engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO users (id, username, full_name, email, hashed_password) VALUES "
+            "(1, 'a', 'A', 'a@example.com', 'x'), (2, 'b', 'B', 'b@example.com', 'x')"
+        ))
+        connection.execute(text("INSERT INTO movies (id, title, description, owner_id) VALUES (1, 'M', 'D', 1), (2, 'N', 'D', 1)"))
+        # User 1 rated movie 1 twice, the latest rating is kept
+        connection.execute(text("INSERT INTO ratings (id, stars, movie_id, user_id) VALUES (1, 4, 1, 1), (2, 2, 1, 2), (3, 5, 1, 1)"))
+    migrate(migration_engine, command.upgrade, "head")
+    with migration_engine.connect() as connection:
+        assert connection.execute(text("SELECT id FROM ratings ORDER BY id")).scalars().all() == [2, 3]
+        assert connection.execute(text("SELECT name FROM sqlite_master WHERE name = 'ix_movies_title_id'")).scalar()
+        rows = connection.execute(text(
+            "SELECT id, rating_count, rating_sum, stars_2, stars_4, stars_5 FROM movies ORDER BY id"
+        )).all()
+        with pytest.raises(IntegrityError):
+            connection.execute(text("INSERT INTO ratings (stars, movie_id, user_id) VALUES (3, 1, 2)"))
+    assert [tuple(row) for row in rows] == [(1, 2, 7, 1, 0, 1), (2, 0, 0, 0, 0, 0)]
+    migration_engine.dispose()
+
+
+def query_plan(db, statement) -> str:
+    sql = str(statement.compile(dialect=db.bind.dialect, compile_kwargs={"literal_binds": True}))
+    if db.bind.dialect.name == "postgresql":
+        # Tiny tables are cheaper to scan, ask whether the index can be used at all
+        db.execute(text("SET LOCAL enable_seqscan = off"))
+        return "\n".join(db.execute(text(f"EXPLAIN {sql}")).scalars())
+    return "\n".join(row[-1] for row in db.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+
+
+# TEST the lookups of the read and write paths are index searches on a generated dataset
+@pytest.mark.parametrize("query, index", [
+    (lambda movie_id, user_id, comment_id: select(models.Rating).where(models.Rating.movie_id == movie_id),
+     "ix_ratings_movie_id"),
+    (lambda movie_id, user_id, comment_id: crud.existing_rating(movie_id, user_id), "uq_ratings_user_movie"),
+    (lambda movie_id, user_id, comment_id: crud.comment_thread_query(movie_id), "ix_comments_movie_id_id"),
+    (lambda movie_id, user_id, comment_id: select(models.Comment).where(models.Comment.parent_comment_id == comment_id),
+     "ix_comments_parent_comment_id"),
+    (lambda movie_id, user_id, comment_id: select(models.Comment).where(models.Comment.user_id == user_id),
+     "ix_comments_user_id"),
+    (lambda movie_id, user_id, comment_id: select(models.Movie).where(models.Movie.owner_id == user_id),
+     "ix_movies_owner_id"),
+])
+def test_query_uses_index(db, query, index):
+    datagen.generate(users=20, movies=50, ratings=300, comments=500, seed=1, batch=250, report=lambda line: None, db=db)
+    movie_id, user_id, comment_id = (db.scalar(select(func.max(table.id))) for table in (models.Movie, models.User, models.Comment))
+    plan = query_plan(db, query(movie_id, user_id, comment_id))
+    assert index in plan
+    # The thread comes back in index order, no separate sort
+    assert "TEMP B-TREE" not in plan and "Sort" not in plan